@@ -0,0 +1,139 @@
+"""Load test of `/send_record`, `wsgi:app` on gunicorn versus `asgi:app` on uvicorn.
+
+Both servers forward the records to a local ShowAds stand-in with a fixed
+latency. The load generator keeps `--concurrency` requests in flight.
+
+Usage::
+
+    PYTHONPATH=src python -m benchmarks.bench_asgi --requests 5000 --concurrency 1000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+from benchmarks.mock_show_ads import MockShowAdsServer
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Server on port {port} did not start.")
+
+
+async def load(
+    url: str, requests: int, concurrency: int
+) -> tuple[float, list[float], int]:
+    """Send the requests, return the elapsed time, latencies and errors."""
+    latencies: list[float] = []
+    errors = 0
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def one(i: int):
+            nonlocal errors
+            start = time.perf_counter()
+            try:
+                async with session.post(
+                    f"{url}/send_record",
+                    json={"name": "Load", "age": 30, "cookie": f"c{i}", "banner_id": 1},
+                ) as res:
+                    await res.read()
+                    if res.status != 202:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        return time.perf_counter() - start, latencies, errors
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--gunicorn-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    with MockShowAdsServer(
+        latency=args.latency
+    ) as server, tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "API_URL": server.url,
+            "PROJECT_KEY": "project-key",
+            "FAILED_RECORDS_DIRPATH": tmp,
+            "PYTHONPATH": str(SRC_DIR),
+        }
+        servers = {
+            f"wsgi:app (gunicorn, {args.gunicorn_workers} sync workers)": [
+                "gunicorn",
+                *("-w", str(args.gunicorn_workers), "--backlog", "4096"),
+                *("--chdir", str(SRC_DIR), "wsgi:app"),
+            ],
+            "asgi:app (uvicorn, 1 process)": [
+                "uvicorn",
+                *("--app-dir", str(SRC_DIR), "--log-level", "warning"),
+                *("--backlog", "4096", "asgi:app"),
+            ],
+        }
+        print(
+            f"{'server':<42} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}"
+        )
+        for name, command in servers.items():
+            port = free_port()
+            if command[0] == "gunicorn":
+                command = [*command, "-b", f"127.0.0.1:{port}"]
+            else:
+                command = [*command, "--port", str(port)]
+            proc = subprocess.Popen(
+                [sys.executable, "-m", *command], env=env, stderr=subprocess.DEVNULL
+            )
+            try:
+                wait_for_port(port)
+                elapsed, latencies, errors = asyncio.run(
+                    load(f"http://127.0.0.1:{port}", args.requests, args.concurrency)
+                )
+            finally:
+                proc.terminate()
+                proc.wait()
+            print(
+                f"{name:<42} {args.requests / elapsed:>8.0f} "
+                f"{percentile(latencies, 0.5) * 1000:>8.0f} "
+                f"{percentile(latencies, 0.99) * 1000:>8.0f} {errors:>7}"
+            )
+
+
+if __name__ == "__main__":
+    main()
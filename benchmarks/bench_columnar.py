@@ -0,0 +1,72 @@
+"""Per-row versus columnar parsing and validation of a synthetic CSV file.
+
+Usage::
+
+    PYTHONPATH=src python -m benchmarks.bench_columnar --rows 10000000
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from data_connector.columnar import read_columns, validate_columns
+from data_connector.record import ValidationPolicy
+from data_connector.utils import parse_file
+
+
+def generate_csv(path: Path, rows: int, seed: int = 0):
+    """Write `rows` synthetic records, roughly a third of them invalid."""
+    rnd = random.Random(seed)
+    names = ["K M Valid", "Jane Doe", "John Smith", "Prof. J F"]
+    with open(path, "w") as f:
+        f.write("Name,Age,Cookie,BannerId\n")
+        for i in range(rows):
+            name = rnd.choice(names)
+            f.write(f"{name},{rnd.randint(10, 90)},cookie-{i},{rnd.randint(0, 120)}\n")
+
+
+def per_row(path: Path) -> tuple[int, int]:
+    policy = ValidationPolicy.from_args()
+    with open(path, "rb") as f:
+        accepted = sum(1 for _ in parse_file(f, policy))
+    return accepted, sum(policy.rejections.values())
+
+
+def columnar(path: Path) -> tuple[int, int]:
+    accepted = rejected = 0
+    policy = ValidationPolicy.from_args()
+    with open(path, "rb") as f:
+        for cols in read_columns(f):
+            result = validate_columns(cols, policy)
+            accepted += len(result.accepted)
+            rejected += len(result.rejected)
+    return accepted, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # the per-row path logs every rejected row
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "synthetic.csv"
+        generate_csv(path, args.rows, args.seed)
+        print(f"{'path':>10} {'accepted':>10} {'rejected':>10} {'seconds':>8} {'rows/s':>10}")
+        for name, func in [("per-row", per_row), ("columnar", columnar)]:
+            start = time.perf_counter()
+            accepted, rejected = func(path)
+            elapsed = time.perf_counter() - start
+            rate = (accepted + rejected) / elapsed
+            print(f"{name:>10} {accepted:>10} {rejected:>10} {elapsed:>8.2f} {rate:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
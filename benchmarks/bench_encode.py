@@ -0,0 +1,63 @@
+"""Cost of encoding a 1000-record bulk, previous path versus the encoder.
+
+The previous path built a dict per record and let `requests` call
+`json.dumps` on every attempt; the encoder serializes the bulk once.
+
+Usage::
+
+    PYTHONPATH=src python -m benchmarks.bench_encode --bulks 1000 --attempts 3
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import timeit
+
+from data_connector import encoder
+from data_connector.encoder import encode_bulk
+from data_connector.record import Record, RecordBatch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bulks", type=int, default=1000)
+    parser.add_argument(
+        "--attempts", type=int, default=1, help="Requests sent per bulk."
+    )
+    args = parser.parse_args()
+
+    records = [
+        Record("Customer", 30, f"5f0c6a3e-{i:08d}", i % 100) for i in range(1000)
+    ]
+    batch = RecordBatch.from_records(records)
+    orjson = encoder.orjson
+
+    def previous():
+        for _ in range(args.attempts):
+            json.dumps({"Data": [r.transform_data() for r in records]}).encode()
+
+    def encoded(backend, compress: bool):
+        def run():
+            encoder.orjson = backend
+            encode_bulk(batch, compress)
+
+        return run
+
+    cases = [("previous", previous)]
+    if orjson is not None:
+        cases += [
+            ("orjson", encoded(orjson, False)),
+            ("orjson+gzip", encoded(orjson, True)),
+        ]
+    cases += [("stdlib", encoded(None, False)), ("stdlib+gzip", encoded(None, True))]
+
+    print(f"{'encoder':>12} {'us/bulk':>10}")
+    for name, func in cases:
+        elapsed = timeit.timeit(func, number=args.bulks)
+        print(f"{name:>12} {elapsed / args.bulks * 1e6:>10.1f}")
+    encoder.orjson = orjson
+
+
+if __name__ == "__main__":
+    main()
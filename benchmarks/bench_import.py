@@ -0,0 +1,64 @@
+"""Import time of the CLI and of the app, measured by `python -X importtime`.
+
+Every module is imported in a fresh interpreter `--runs` times; the best run
+is reported with the modules that took the most time on their own.
+
+Usage::
+
+    PYTHONPATH=src python -m benchmarks.bench_import --runs 5 --top 10
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import subprocess
+import sys
+
+# standalone CLI, the Flask app and the ASGI app
+MODULES = ("data_connector.commands", "data_connector.api", "data_connector.asgi")
+
+
+def import_times(module: str) -> dict[str, tuple[int, int]]:
+    """Import a module in a fresh interpreter.
+
+    :param str module: The module.
+    :return: Self and cumulative time (in microseconds) of every imported
+        module, by its name.
+    :rtype: dict[str, tuple[int, int]]
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, "PYTHONPATH": os.getenv("PYTHONPATH", "src")},
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        own, cumulative, name = line.removeprefix("import time:").split("|")
+        if own.strip().isdigit():
+            times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.runs)]
+        best = min(runs, key=lambda times: times[module][1])
+        print(f"{module}: {best[module][1] / 1000:.1f} ms, {len(best)} modules")
+        slowest = sorted(best.items(), key=lambda item: item[1][0], reverse=True)
+        for name, (own, _) in slowest[: args.top]:
+            print(f"  {own / 1000:>8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Memory of a `list[Record]` bulk versus a column-wise `RecordBatch`.
+
+Usage::
+
+    PYTHONPATH=src python -m benchmarks.bench_record_batch --records 1000000
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import time
+import tracemalloc
+from typing import Callable
+
+from data_connector.record import Record, RecordBatch
+from data_connector.utils import batched, batched_records
+
+BULK_SIZE = 1000
+
+
+def records(count: int):
+    # the strings are created per row, same as when a file is parsed
+    for i in range(count):
+        yield Record(f"Customer {i % 7}", 30, f"cookie-{i}", i % 100)
+
+
+def list_bulks(count: int) -> int:
+    """Previous path: a list of records and a dict per record in the payload."""
+    sent = 0
+    for bulk in batched(records(count), BULK_SIZE):
+        payload = json.dumps({"Data": [r.transform_data() for r in bulk]}).encode()
+        sent += len(bulk) if payload else 0
+    return sent
+
+
+def batch_bulks(count: int) -> int:
+    sent = 0
+    for bulk in batched_records(records(count), BULK_SIZE):
+        payload = bulk.to_json()
+        sent += len(bulk) if payload else 0
+    return sent
+
+
+def held_list(count: int) -> int:
+    """Whole upload held as objects, as before the streaming pipeline."""
+    return len(list(records(count)))
+
+
+def held_batch(count: int) -> int:
+    return len(RecordBatch.from_records(records(count)))
+
+
+def measure(func: Callable[[int], int], count: int) -> tuple[float, int]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(count)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    print(f"{'case':>12} {'seconds':>8} {'peak KiB':>10}")
+    for name, func in [
+        ("list bulks", list_bulks),
+        ("batch bulks", batch_bulks),
+        ("held list", held_list),
+        ("held batch", held_batch),
+    ]:
+        elapsed, peak = measure(func, args.records)
+        print(f"{name:>12} {elapsed:>8.2f} {peak / 1024:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
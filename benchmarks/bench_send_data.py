@@ -0,0 +1,44 @@
+"""Throughput of `send_data` as the number of in-flight bulks goes up.
+
+Usage::
+
+    PYTHONPATH=src python -m benchmarks.bench_send_data --records 100000 --latency 0.05
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+
+from benchmarks.mock_show_ads import MockShowAdsServer
+from data_connector.record import Record
+from data_connector.show_ads_api_wrapper import ShowAdsClient, send_data, set_client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32]
+    )
+    args = parser.parse_args()
+
+    with MockShowAdsServer(latency=args.latency) as server:
+        set_client(ShowAdsClient(server.url, "project-key"))
+        print(f"{'concurrency':>12} {'sent':>10} {'seconds':>8} {'rows/s':>10}")
+        for concurrency in args.concurrency:
+            records = (
+                Record("benchmark", 30, f"cookie-{i}", i % 100)
+                for i in range(args.records)
+            )
+            start = time.perf_counter()
+            sent = send_data(records, concurrency)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{concurrency:>12} {sent:>10} {elapsed:>8.2f} {sent / elapsed:>10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
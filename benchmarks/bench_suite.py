@@ -0,0 +1,466 @@
+"""End-to-end benchmark suite against a local ShowAds stand-in.
+
+Every scenario runs on synthetic CSV files of each requested size, in a fresh
+process, so its peak RSS is not inflated by the previous runs:
+
+- `parse_file` - parsing and validation of the file,
+- `send_data` - sending already valid records,
+- `cli` - the `upload-file` command,
+- `record_endpoint` - `/send_record` requests, one per row (at most
+  `--max-record-requests` of them),
+- `bulk_endpoint` - upload of the file to `/send_record/bulk`.
+
+The Flask app is served by the Werkzeug server on a local port and the
+ShowAds stand-in runs in the parent process. The latencies are those of the
+upstream bulks (client side, including the retries), of the HTTP requests for
+`record_endpoint`, and are not reported for `parse_file`.
+
+The results are printed as a table and can be stored as JSON with
+`--output`; a previous output passed as `--baseline` is compared with the new
+results, a drop of the throughput by more than `--tolerance` fails the run.
+
+Usage::
+
+    PYTHONPATH=src python -m benchmarks.bench_suite --rows 10000 1000000 10000000
+    PYTHONPATH=src python -m benchmarks.bench_suite --error-rate 0.05 --retry-after 0
+    PYTHONPATH=src python -m benchmarks.bench_suite --output new.json --baseline old.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+import requests
+
+from benchmarks.bench_columnar import generate_csv
+from benchmarks.mock_show_ads import MockShowAdsServer
+from data_connector.record import Record, RecordBatch, ValidationPolicy
+from data_connector.show_ads_api_wrapper import ShowAdsClient, send_data, set_client
+from data_connector.utils import parse_file
+
+SCENARIOS = ("parse_file", "send_data", "cli", "record_endpoint", "bulk_endpoint")
+
+
+class TimedShowAdsClient(ShowAdsClient):
+    """Client that records the duration of every bulk it sends."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies: list[float] = []
+        self._latencies_lock = threading.Lock()
+
+    def send_bulk(
+        self,
+        bulk_id: int,
+        lof_records: RecordBatch | list[Record],
+        spill: bool = True,
+    ) -> int:
+        start = time.perf_counter()
+        try:
+            return super().send_bulk(bulk_id, lof_records, spill)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._latencies_lock:
+                self.latencies.append(elapsed)
+
+
+class MultipartBody:
+    """Multipart body of a file upload, read from the disk in blocks.
+
+    `requests` reads a file passed in `files=` into memory; a file-like
+    object with a length is sent as it is read instead.
+    """
+
+    boundary = "benchmark-boundary"
+
+    def __init__(self, path: Path):
+        self._parts = [
+            (
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="file"; filename="{path.name}"'
+                "\r\nContent-Type: text/csv\r\n\r\n"
+            ).encode(),
+            f"\r\n--{self.boundary}--\r\n".encode(),
+        ]
+        self._size = path.stat().st_size
+        self._file = open(path, "rb")
+        # 0 - head, 1 - file, 2 - tail, 3 - done
+        self._phase = 0
+        self._offset = 0
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return sum(map(len, self._parts)) + self._size
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            size = len(self)
+        out = bytearray()
+        while len(out) < size and self._phase < 3:
+            if self._phase == 1:
+                data = self._file.read(size - len(out))
+                if not data:
+                    self._phase = 2
+                out += data
+                continue
+            part = self._parts[self._phase // 2]
+            data = part[self._offset : self._offset + size - len(out)]
+            out += data
+            self._offset += len(data)
+            if self._offset == len(part):
+                self._phase += 1
+                self._offset = 0
+        return bytes(out)
+
+    def close(self):
+        self._file.close()
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def synthetic_records(rows: int) -> Iterator[Record]:
+    return (Record("benchmark", 30, f"cookie-{i}", i % 100) for i in range(rows))
+
+
+def serve_app() -> tuple[str, Callable[[], None]]:
+    """Serve the Flask app on a local port, return its URL and a stop function."""
+    from werkzeug.serving import make_server
+
+    from data_connector import create_app
+
+    server = make_server("127.0.0.1", 0, create_app(), threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+
+    return f"http://127.0.0.1:{server.server_port}", stop
+
+
+def bench_parse_file(path: Path, rows: int, options: dict[str, Any]) -> dict[str, Any]:
+    policy = ValidationPolicy.from_args()
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        accepted = sum(1 for _ in parse_file(f, policy))
+    return {
+        "seconds": time.perf_counter() - start,
+        "accepted": accepted,
+        "rejected": sum(policy.rejections.values()),
+        "latencies": [],
+    }
+
+
+def bench_send_data(path: Path, rows: int, options: dict[str, Any]) -> dict[str, Any]:
+    client = TimedShowAdsClient.from_env()
+    set_client(client)
+    start = time.perf_counter()
+    sent = send_data(synthetic_records(rows), options["concurrency"])
+    return {
+        "seconds": time.perf_counter() - start,
+        "sent": sent,
+        "latencies": client.latencies,
+    }
+
+
+def bench_cli(path: Path, rows: int, options: dict[str, Any]) -> dict[str, Any]:
+    from data_connector import create_app
+    from data_connector.commands import upload_file
+
+    client = TimedShowAdsClient.from_env()
+    set_client(client)
+    runner = create_app().test_cli_runner()
+    start = time.perf_counter()
+    result = runner.invoke(
+        upload_file, [str(path), "-c", str(options["concurrency"])]
+    )
+    elapsed = time.perf_counter() - start
+    if result.exit_code != 0:
+        raise RuntimeError(f"upload-file failed: {result.output}")
+    # "Successfully sent N of records."
+    return {
+        "seconds": elapsed,
+        "sent": int(result.output.split()[2]),
+        "latencies": client.latencies,
+    }
+
+
+def bench_record_endpoint(
+    path: Path, rows: int, options: dict[str, Any]
+) -> dict[str, Any]:
+    set_client(TimedShowAdsClient.from_env())
+    url, stop = serve_app()
+    sessions = threading.local()
+    requests_count = min(rows, options["max_record_requests"])
+
+    def one(i: int) -> tuple[bool, float]:
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        start = time.perf_counter()
+        res = sessions.session.post(
+            f"{url}/send_record",
+            json={"name": "benchmark", "age": 30, "cookie": f"c{i}", "banner_id": 1},
+        )
+        return res.status_code == 202, time.perf_counter() - start
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options["concurrency"]) as pool:
+            results = list(pool.map(one, range(requests_count)))
+        elapsed = time.perf_counter() - start
+    finally:
+        stop()
+    return {
+        "rows": requests_count,
+        "seconds": elapsed,
+        "accepted": sum(ok for ok, _ in results),
+        "latencies": [latency for _, latency in results],
+    }
+
+
+def bench_bulk_endpoint(
+    path: Path, rows: int, options: dict[str, Any]
+) -> dict[str, Any]:
+    client = TimedShowAdsClient.from_env()
+    set_client(client)
+    url, stop = serve_app()
+    body = MultipartBody(path)
+    try:
+        start = time.perf_counter()
+        res = requests.post(
+            f"{url}/send_record/bulk",
+            data=body,
+            headers={"Content-Type": body.content_type},
+        )
+        elapsed = time.perf_counter() - start
+    finally:
+        body.close()
+        stop()
+    if res.status_code != 202:
+        raise RuntimeError(f"/send_record/bulk failed: {res.status_code} {res.text}")
+    return {
+        "seconds": elapsed,
+        "sent": res.json()["sent"],
+        "rejected": res.json()["rejections"]["rejected"],
+        "latencies": client.latencies,
+    }
+
+
+BENCHMARKS: dict[str, Callable[[Path, int, dict[str, Any]], dict[str, Any]]] = {
+    "parse_file": bench_parse_file,
+    "send_data": bench_send_data,
+    "cli": bench_cli,
+    "record_endpoint": bench_record_endpoint,
+    "bulk_endpoint": bench_bulk_endpoint,
+}
+
+
+def run_child(conn, scenario: str, path: Path, rows: int, options: dict[str, Any]):
+    """Run one scenario in a fresh process, send the result to the parent."""
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(
+            {
+                "API_URL": options["api_url"],
+                "PROJECT_KEY": "project-key",
+                "FAILED_RECORDS_DIRPATH": tmp,
+                "SEND_CONCURRENCY": str(options["concurrency"]),
+                "SHOW_ADS_POOL_SIZE": str(max(32, options["concurrency"])),
+                "BULK_STREAM_UPLOADS": "1" if options["stream_uploads"] else "",
+            }
+        )
+        try:
+            result = BENCHMARKS[scenario](path, rows, options)
+        except Exception as e:
+            conn.send({"error": f"{type(e).__name__}: {e}"})
+            return
+    latencies = result.pop("latencies")
+    rows = result.pop("rows", rows)
+    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+    conn.send(
+        {
+            "rows": rows,
+            **result,
+            "rows_per_second": rows / result["seconds"],
+            "p50_ms": None if p50 is None else p50 * 1000,
+            "p99_ms": None if p99 is None else p99 * 1000,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    )
+
+
+def run(
+    scenario: str, path: Path, rows: int, options: dict[str, Any]
+) -> dict[str, Any]:
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(
+        target=run_child, args=(child_conn, scenario, path, rows, options)
+    )
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = {"error": f"process exited with {process.exitcode}"}
+    process.join()
+    return {"scenario": scenario, **result}
+
+
+def metadata(args: argparse.Namespace) -> dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "options": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in {"output", "baseline"}
+        },
+    }
+
+
+def compare(results: list[dict[str, Any]], baseline: Path, tolerance: float) -> bool:
+    """Print the throughput change against a previous run, False on a regression."""
+    with open(baseline) as f:
+        previous = {
+            (r["scenario"], r["rows"]): r
+            for r in json.load(f)["results"]
+            if "error" not in r
+        }
+    ok = True
+    print(
+        f"\n{'scenario':<16} {'rows':>10} {'baseline':>10} {'rows/s':>10} "
+        f"{'change':>8}"
+    )
+    for result in results:
+        old = previous.get((result["scenario"], result["rows"]))
+        if old is None or "error" in result:
+            continue
+        change = result["rows_per_second"] / old["rows_per_second"] - 1
+        regression = change < -tolerance
+        ok = ok and not regression
+        print(
+            f"{result['scenario']:<16} {result['rows']:>10} "
+            f"{old['rows_per_second']:>10.0f} {result['rows_per_second']:>10.0f} "
+            f"{change:>+8.1%}{'  REGRESSION' if regression else ''}"
+        )
+    return ok
+
+
+def _ms(value: float | None) -> str:
+    return "-" if value is None else f"{value:.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-record-requests", type=int, default=2000)
+    parser.add_argument("--stream-uploads", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--unauthorized-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="Store the results as JSON")
+    parser.add_argument("--baseline", type=Path, help="Results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, MockShowAdsServer(
+        latency=args.latency,
+        unauthorized_rate=args.unauthorized_rate,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    ) as server:
+        options = {
+            "api_url": server.url,
+            "concurrency": args.concurrency,
+            "max_record_requests": args.max_record_requests,
+            "stream_uploads": args.stream_uploads,
+        }
+        print(
+            f"{'scenario':<16} {'rows':>10} {'seconds':>8} {'rows/s':>10} "
+            f"{'p50 ms':>8} {'p99 ms':>8} {'RSS MB':>8}"
+        )
+        for rows in args.rows:
+            path = Path(tmp) / f"synthetic_{rows}.csv"
+            generate_csv(path, rows, args.seed)
+            for scenario in args.scenarios:
+                server.reset_counts()
+                result = run(scenario, path, rows, options)
+                result["upstream"] = {
+                    f"{path} {status}": count
+                    for (path, status), count in sorted(server.responses.items())
+                }
+                results.append(result)
+                if "error" in result:
+                    print(f"{scenario:<16} {rows:>10} {result['error']}")
+                    continue
+                print(
+                    f"{scenario:<16} {result['rows']:>10} {result['seconds']:>8.2f} "
+                    f"{result['rows_per_second']:>10.0f} {_ms(result['p50_ms']):>8} "
+                    f"{_ms(result['p99_ms']):>8} {result['peak_rss_mb']:>8.1f}"
+                )
+            path.unlink()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": metadata(args), "results": results}, f, indent=2)
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
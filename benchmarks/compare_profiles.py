@@ -0,0 +1,59 @@
+"""Compare two cProfile profiles, e.g. of the same upload on two releases.
+
+The profiles are written by the app with `PROFILE_DIRPATH` set. The
+functions are matched by their file name (without the directory, so
+profiles of different checkouts match), line and name, and sorted by the
+change of their cumulative time.
+
+Usage::
+
+    python -m benchmarks.compare_profiles old/upload-file_1.prof \\
+        new/upload-file_2.prof --limit 20
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import pstats
+
+# function -> (number of calls, own time, cumulative time)
+Totals = dict[str, tuple[int, float, float]]
+
+
+def load(path: str) -> Totals:
+    totals: Totals = {}
+    stats = pstats.Stats(path).stats  # type: ignore[attr-defined]
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.items():
+        key = f"{os.path.basename(filename)}:{line}({name})"
+        prev = totals.get(key, (0, 0.0, 0.0))
+        totals[key] = (prev[0] + calls, prev[1] + tottime, prev[2] + cumtime)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--limit", type=int, default=30)
+    args = parser.parse_args()
+
+    before, after = load(args.before), load(args.after)
+    empty = (0, 0.0, 0.0)
+    rows = sorted(
+        before.keys() | after.keys(),
+        key=lambda f: abs(after.get(f, empty)[2] - before.get(f, empty)[2]),
+        reverse=True,
+    )
+    print(f"{'cum before':>11} {'cum after':>10} {'delta':>9} {'calls':>15}  function")
+    for func in rows[: args.limit]:
+        calls_b, _, cum_b = before.get(func, empty)
+        calls_a, _, cum_a = after.get(func, empty)
+        print(
+            f"{cum_b:>11.3f} {cum_a:>10.3f} {cum_a - cum_b:>+9.3f} "
+            f"{f'{calls_b}->{calls_a}':>15}  {func}"
+        )
+
+
+if __name__ == "__main__":
+    main()
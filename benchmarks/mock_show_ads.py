@@ -0,0 +1,140 @@
+"""A local stand-in for the ShowAds API used by the benchmarks.
+
+The server implements `/auth`, `/banners/show` and `/banners/show/bulk` and
+answers every request after a fixed delay, which mimics the round-trip to the
+real API. A share of the record and bulk requests can be answered with 401
+(expired token), 429 (throttled) or 500 to exercise the retries of the client.
+"""
+
+from __future__ import annotations
+
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockShowAdsHandler(BaseHTTPRequestHandler):
+    # keep-alive connections, same as the real API
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, avoid the delayed-ACK stall
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        time.sleep(self.server.latency)
+
+        if self.path == "/auth":
+            self._reply(200, {"AccessToken": "access-token"})
+        elif self.path in {"/banners/show", "/banners/show/bulk"}:
+            if not self.headers.get("Authorization"):
+                self._reply(401, {})
+                return
+            status = self.server.injected_status()
+            if status == 429 and self.server.retry_after is not None:
+                self._reply(status, {}, {"Retry-After": str(self.server.retry_after)})
+                return
+            self._reply(status, {})
+        else:
+            self._reply(404, {})
+
+    def _reply(self, status: int, body: dict, headers: dict[str, str] | None = None):
+        self.server.count(self.path, status)
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # silence the default per-request logging
+        pass
+
+
+class MockShowAdsServer(ThreadingHTTPServer):
+    """ShowAds stand-in running in a background thread.
+
+    :param float latency: Delay (in seconds) added to every response.
+    :param float unauthorized_rate: Share of the record and bulk requests
+        answered with 401, the client has to fetch a new token.
+    :param float throttle_rate: Share of the record and bulk requests answered
+        with 429.
+    :param float error_rate: Share of the record and bulk requests answered
+        with 500.
+    :param (float | None) retry_after: `Retry-After` header of the 429 responses.
+    :param int seed: Seed of the injected responses.
+    """
+
+    daemon_threads = True
+    # the async clients open many connections at once
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        unauthorized_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        error_rate: float = 0.0,
+        retry_after: float | None = None,
+        seed: int = 0,
+    ):
+        super().__init__((host, port), MockShowAdsHandler)
+        self.latency = latency
+        self.unauthorized_rate = unauthorized_rate
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        # successful record and bulk requests per path
+        self.requests: dict[str, int] = {}
+        # all the responses per (path, status)
+        self.responses: Counter[tuple[str, int]] = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def injected_status(self) -> int:
+        """Status of the next record or bulk request, 200 unless a fault is drawn."""
+        with self._lock:
+            draw = self._random.random()
+        for status, rate in (
+            (401, self.unauthorized_rate),
+            (429, self.throttle_rate),
+            (500, self.error_rate),
+        ):
+            if draw < rate:
+                return status
+            draw -= rate
+        return 200
+
+    def count(self, path: str, status: int = 200):
+        with self._lock:
+            self.responses[path, status] += 1
+            if status == 200 and path != "/auth":
+                self.requests[path] = self.requests.get(path, 0) + 1
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests.clear()
+            self.responses.clear()
+
+    def __enter__(self) -> MockShowAdsServer:
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
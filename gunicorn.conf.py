@@ -0,0 +1,11 @@
+"""Gunicorn settings, passed with `-c gunicorn.conf.py`."""
+
+from __future__ import annotations
+
+
+def post_worker_init(worker):
+    # continue the bulk jobs interrupted by a crash or a restart; only in the
+    # server workers, the CLI commands create the app too
+    jobs = worker.wsgi.extensions.get("bulk_jobs")
+    if jobs:
+        jobs.resume_interrupted()
@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+import logging
+import os
+
+from data_connector.asgi import create_asgi_app
+from data_connector.tracing import LOG_FORMAT, install_log_filter
+
+# set logging level
+level = os.getenv("LOGLEVEL", "WARNING").upper()
+if level not in {"DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"}:
+    level = "WARNING"
+logging.basicConfig(level=level, format=LOG_FORMAT)
+# the ID of the request being processed, see LOG_FORMAT
+install_log_filter()
+
+# required environment varilables check
+if not os.getenv("API_URL"):
+    logging.error("Environment variable API_URL not found.")
+    exit(1)
+if not os.getenv("PROJECT_KEY"):
+    logging.error("Environment variable PROJECT_KEY not found.")
+    exit(1)
+
+app = create_asgi_app()
@@ -1,13 +1,61 @@
 from __future__ import annotations
 
-from flask import Flask
-from data_connector.api import data_connector_api
-from data_connector.commands import upload_file
+import atexit
+import os
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from flask import Flask
 
 
 def create_app() -> Flask:
-    """Default app factory function."""
+    """Default app factory function.
+
+    Flask and the API modules are imported here, not with the package: the
+    CLI (see `commands.main`) imports only the modules that send the files.
+    """
+    from flask import Flask
+
+    from data_connector.api import data_connector_api
+    from data_connector.coalescer import RecordCoalescer
+    from data_connector.commands import replay_unsent_records, upload_file
+    from data_connector.jobs import JobManager
+    from data_connector.metrics import metrics_dirpath, start_snapshot_thread
+    from data_connector.tracing import WSGIMiddleware
+
     app = Flask(__name__)
     data_connector_api.init_app(app)
     app.cli.add_command(upload_file)
+    app.cli.add_command(replay_unsent_records)
+    # request IDs in the logs, spans of the requests if TRACE_FILEPATH is set
+    app.wsgi_app = WSGIMiddleware(app.wsgi_app)
+
+    # opt-in micro-batching of the single record endpoint
+    if os.getenv("COALESCE_RECORDS", "").lower() in {"1", "true", "yes"}:
+        coalescer = RecordCoalescer(
+            flush_ms=int(os.getenv("COALESCE_FLUSH_MS", 100))
+        ).start()
+        # drain the queue on shutdown so no record is lost
+        atexit.register(coalescer.close)
+        app.extensions["record_coalescer"] = coalescer
+
+    # opt-in parsing of the bulk uploads while they are being received
+    app.config["BULK_STREAM_UPLOADS"] = os.getenv(
+        "BULK_STREAM_UPLOADS", ""
+    ).lower() in {"1", "true", "yes"}
+
+    # metrics shared by the processes of the app through a directory
+    dirpath = metrics_dirpath()
+    if dirpath:
+        start_snapshot_thread(
+            dirpath, float(os.getenv("METRICS_SNAPSHOT_INTERVAL", 5))
+        )
+
+    # opt-in background processing of the bulk uploads; the jobs interrupted
+    # by a crash or a restart are resumed only by the server workers (see
+    # gunicorn.conf.py), not by every process creating the app, e.g. the CLI
+    jobs = JobManager.from_env()
+    if jobs:
+        atexit.register(jobs.shutdown)
+        app.extensions["bulk_jobs"] = jobs
     return app
@@ -1,14 +1,27 @@
 from __future__ import annotations
 
 import logging as log
+import shutil
+import tempfile
 
+from flask import Response, current_app, request
 from flask_restx import Api, Namespace, Resource, fields
 from flask_restx.api import HTTPStatus
 from flask_restx.reqparse import FileStorage
 
-from .record import Record
+from . import metrics, tracing
+from .batch import ndjson_items, send_batch
+from .columnar import parse_file_columnar
+from .multipart import MalformedBody, MultipartUpload
+from .record import Record, ValidationPolicy
 from .show_ads_api_wrapper import send_data, send_record
-from .utils import allowed_file_extension, parse_file
+from .utils import (
+    CSV_READER,
+    NDJSON_READER,
+    Reader,
+    find_reader,
+    supported_formats,
+)
 
 # init API
 data_connector_api = Api(title="DataConnectorAPI", version="1.0.0")
@@ -25,6 +38,18 @@ file_parser.add_argument("file", location="files", type=FileStorage, required=Tr
 file_parser.add_argument("min_age", location="form", type=int)
 file_parser.add_argument("max_age", location="form", type=int)
 
+# rejected rows of an upload, see `ValidationPolicy.report`
+rejection_report = send_record_ns.model(
+    "RejectionReport",
+    {
+        "rejected": fields.Integer,
+        "rules": fields.Raw(description="Number of rejected rows per rule."),
+        "examples": fields.List(
+            fields.Raw, description="The first rejected rows (line, rule, message)."
+        ),
+    },
+)
+
 
 @send_record_ns.route("/send_record")
 @send_record_ns.doc(description="Send a single customer record.")
@@ -75,15 +100,27 @@ class SendRecord(Resource):
             return {"message": "Failed to process data."}, HTTPStatus.BAD_REQUEST
 
         msg = f"Record {rec.cookie} did not pass the validation, ignored."
-        if rec.validate(data.get("min_age"), data.get("max_age")):
-            log.info(f"/send_record: Sending {rec.cookie} to ShowAds API.")
-            send_record(rec)
-            msg = f"Record {rec.cookie} sent to ShowAPI."
+        policy = ValidationPolicy.from_args(data.get("min_age"), data.get("max_age"))
+        if policy.check(rec):
+            coalescer = current_app.extensions.get("record_coalescer")
+            if coalescer:
+                # the record is sent with the next bulk
+                coalescer.submit(rec)
+                msg = f"Record {rec.cookie} queued for sending to ShowAPI."
+            else:
+                log.info(f"/send_record: Sending {rec.cookie} to ShowAds API.")
+                send_record(rec)
+                msg = f"Record {rec.cookie} sent to ShowAPI."
         return {"message": msg}, HTTPStatus.ACCEPTED
 
 
 @send_record_ns.route("/send_record/bulk")
-@send_record_ns.doc(description="Send a bulk of records using a CSV file.")
+@send_record_ns.doc(
+    description=(
+        "Send a bulk of records using a CSV file, gzip or zstd compressed CSV, "
+        "NDJSON or Parquet file."
+    )
+)
 class SendBulk(Resource):
     @send_record_ns.doc(parser=file_parser)
     @send_record_ns.response(
@@ -100,21 +137,240 @@ class SendBulk(Resource):
     )
     @send_record_ns.response(
         code=HTTPStatus.ACCEPTED,
-        description="Number of sent records.",
-        model=fields.Integer,
-        envelope="sent",
+        description=(
+            "Number of sent records and the rejected rows; the ID of the "
+            "background job if the jobs are enabled."
+        ),
+        model=send_record_ns.model(
+            "BulkResult",
+            {
+                "sent": fields.Integer,
+                "rejections": fields.Nested(rejection_report),
+                "job_id": fields.String,
+            },
+        ),
     )
     def post(self):
         """POST endpoint for bulk record forwarding."""
+        with tracing.profiled("bulk"):
+            if not current_app.config.get("BULK_STREAM_UPLOADS"):
+                return self._post()
+            try:
+                return self._post_streamed()
+            # raised by the upload wherever the body turns out to be
+            # malformed or truncated, also while the file is being read
+            except MalformedBody:
+                log.error("/send_record/bulk: Malformed multipart body.")
+                return (
+                    {"message": "Malformed multipart body."},
+                    HTTPStatus.BAD_REQUEST,
+                )
+
+    def _post(self):
+        """Parse and send the file once it is uploaded."""
         args = file_parser.parse_args()
         upload_file: FileStorage = args["file"]
-        buffer: list[Record] = []
         if not upload_file:
             return {"message": "CSV file required."}, HTTPStatus.BAD_REQUEST
-        if not allowed_file_extension(upload_file.filename):
+        reader = find_reader(upload_file.filename or "", upload_file.mimetype)
+        if reader is None:
+            return _unsupported_format()
+        policy = ValidationPolicy.from_args(args.get("min_age"), args.get("max_age"))
+        jobs = current_app.extensions.get("bulk_jobs")
+        if jobs:
+            # the file is processed in the background
+            job = jobs.submit(upload_file.stream, policy, reader)
+            return (
+                {"job_id": job.id},
+                HTTPStatus.ACCEPTED,
+                {"Location": f"/jobs/{job.id}"},
+            )
+        records = reader.parse(upload_file.stream, policy)
+        nof_recs = send_data(records)
+        log.info(f"/send_record/bulk: {nof_recs} sent, {policy.summary()}.")
+        return {"sent": nof_recs, "rejections": policy.report()}, HTTPStatus.ACCEPTED
+
+    def _post_streamed(self):
+        """Parse and send the file while it is being uploaded.
+
+        The filters are taken from the query string and from the form fields
+        sent before the file part; the records are validated as soon as the
+        file data arrive, so fields sent after the file are ignored.
+        """
+        boundary = request.mimetype_params.get("boundary")
+        if request.mimetype != "multipart/form-data" or not boundary:
+            return {"message": "CSV file required."}, HTTPStatus.BAD_REQUEST
+        upload = MultipartUpload(request.stream, boundary.encode())
+        if not upload.open_file():
+            return {"message": "CSV file required."}, HTTPStatus.BAD_REQUEST
+        reader = find_reader(upload.filename or "", upload.content_type)
+        if reader is None:
+            return _unsupported_format()
+        filters = {**request.args, **upload.fields}
+        try:
+            min_age, max_age = (
+                int(filters[key]) if filters.get(key) else None
+                for key in ("min_age", "max_age")
+            )
+        except ValueError:
+            return {"message": "Age filters must be integers."}, HTTPStatus.BAD_REQUEST
+        policy = ValidationPolicy.from_args(min_age, max_age)
+
+        jobs = current_app.extensions.get("bulk_jobs")
+        if jobs:
+            job = jobs.submit(upload, policy, reader)
+            response = (
+                {"job_id": job.id},
+                HTTPStatus.ACCEPTED,
+                {"Location": f"/jobs/{job.id}"},
+            )
+        else:
+            nof_recs = self._send_streamed(upload, reader, policy)
+            log.info(f"/send_record/bulk: {nof_recs} sent, {policy.summary()}.")
+            response = (
+                {"sent": nof_recs, "rejections": policy.report()},
+                HTTPStatus.ACCEPTED,
+            )
+        if upload.close().keys() & {"min_age", "max_age"}:
+            log.warning(
+                "/send_record/bulk: Age filters sent after the file were ignored."
+            )
+        return response
+
+    @staticmethod
+    def _send_streamed(
+        upload: MultipartUpload, reader: Reader, policy: ValidationPolicy
+    ) -> int:
+        if reader.seekable:
+            # e.g. Parquet keeps its metadata at the end, the file is spooled
+            with tempfile.TemporaryFile() as spool:
+                shutil.copyfileobj(upload, spool)
+                spool.seek(0)
+                return send_data(reader.parse(spool, policy))
+        # plain CSV is parsed block by block as the data arrive
+        parse = parse_file_columnar if reader is CSV_READER else reader.parse
+        return send_data(parse(upload, policy))
+
+
+def _unsupported_format():
+    return {
+        "message": f"Unsupported file format. Accepted formats: {supported_formats()}."
+    }, HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+
+
+# filters of a batch, sent in the query string
+batch_parser = send_record_ns.parser()
+batch_parser.add_argument("min_age", location="args", type=int)
+batch_parser.add_argument("max_age", location="args", type=int)
+
+
+@send_record_ns.route("/send_record/batch")
+@send_record_ns.doc(
+    description=(
+        "Send a batch of records, a JSON array (application/json) or NDJSON "
+        "(application/x-ndjson) of the `/send_record` objects."
+    )
+)
+class SendBatch(Resource):
+    @send_record_ns.doc(parser=batch_parser)
+    @send_record_ns.response(
+        code=HTTPStatus.BAD_REQUEST,
+        description="The body is not a JSON array.",
+        model=fields.String,
+        envelope="message",
+    )
+    @send_record_ns.response(
+        code=HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+        description="The body is neither JSON nor NDJSON.",
+        model=fields.String,
+        envelope="message",
+    )
+    @send_record_ns.response(
+        code=HTTPStatus.ACCEPTED,
+        description="Result of every record, in the order of the batch.",
+        model=send_record_ns.model(
+            "BatchResult",
+            {
+                "sent": fields.Integer,
+                "failed": fields.Integer,
+                "rejections": fields.Nested(rejection_report),
+                "results": fields.List(
+                    fields.Raw(
+                        description=(
+                            "Cookie and status (sent, failed or rejected) of "
+                            "a record, the rule a rejected record failed."
+                        )
+                    )
+                ),
+            },
+        ),
+    )
+    def post(self):
+        """POST endpoint for batched record forwarding."""
+        args = batch_parser.parse_args()
+        policy = ValidationPolicy.from_args(args.get("min_age"), args.get("max_age"))
+        if request.mimetype in NDJSON_READER.content_types:
+            # the records are sent while the body is being received
+            items = ndjson_items(request.stream)
+        elif request.mimetype == "application/json":
+            items = request.get_json(silent=True)
+            if not isinstance(items, list):
+                return (
+                    {"message": "A JSON array of records required."},
+                    HTTPStatus.BAD_REQUEST,
+                )
+        else:
             return {
-                "message": "Unsupported file format. Only CSV files are accepted."
+                "message": "Send a JSON array (application/json) "
+                "or NDJSON (application/x-ndjson)."
             }, HTTPStatus.UNSUPPORTED_MEDIA_TYPE
-        buffer = parse_file(upload_file, args.get("min_age"), args.get("max_age"))
-        nof_recs = send_data(buffer)
-        return {"sent": nof_recs}, HTTPStatus.ACCEPTED
+        results = send_batch(items, policy)
+        log.info(f"/send_record/batch: {results.sent} sent, {policy.summary()}.")
+        return results.report(), HTTPStatus.ACCEPTED
+
+
+@send_record_ns.route("/jobs/<string:job_id>")
+@send_record_ns.doc(description="Status of a background bulk upload.")
+class JobStatus(Resource):
+    @send_record_ns.response(
+        code=HTTPStatus.OK,
+        description="Progress of the job.",
+        model=send_record_ns.model(
+            "JobStatus",
+            {
+                "job_id": fields.String,
+                "status": fields.String(enum=["queued", "running", "done", "failed"]),
+                "parsed": fields.Integer,
+                "rejected": fields.Integer,
+                "rejections": fields.Nested(rejection_report),
+                "sent": fields.Integer,
+                "spilled": fields.Integer,
+                "elapsed": fields.Float,
+                "rows_per_second": fields.Float,
+                "sent_per_second": fields.Float,
+                "error": fields.String,
+            },
+        ),
+    )
+    @send_record_ns.response(
+        code=HTTPStatus.NOT_FOUND,
+        description="Unknown job.",
+        model=fields.String,
+        envelope="message",
+    )
+    def get(self, job_id: str):
+        """GET endpoint for the status of a bulk upload job."""
+        jobs = current_app.extensions.get("bulk_jobs")
+        status = jobs.get(job_id) if jobs else None
+        if status is None:
+            return {"message": f"Job {job_id} not found."}, HTTPStatus.NOT_FOUND
+        return status, HTTPStatus.OK
+
+
+@send_record_ns.route("/metrics")
+@send_record_ns.doc(description="Metrics in the Prometheus text format.")
+class Metrics(Resource):
+    @send_record_ns.response(code=HTTPStatus.OK, description="The metrics.")
+    def get(self):
+        """GET endpoint for the metrics of all the app processes."""
+        return Response(metrics.export(), mimetype=metrics.CONTENT_TYPE)
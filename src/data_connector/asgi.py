@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import logging as log
+import os
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable
+
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from . import metrics, tracing
+from .async_show_ads_api_wrapper import AsyncShowAdsClient, send_batch, send_data
+from .batch import ndjson_items
+from .record import Record, ValidationPolicy
+from .utils import NDJSON_READER, find_reader, supported_formats
+
+
+async def send_record_endpoint(request: Request) -> JSONResponse:
+    """POST endpoint for single record forwarding."""
+    try:
+        data = await request.json()
+        rec = Record(
+            # select attributes relevant to the Record constructor
+            **{
+                k: v
+                for k, v in data.items()
+                if k in {"name", "age", "cookie", "banner_id"}
+            }
+        )
+    # invalid JSON, or the Record cannot be constructed
+    except (AttributeError, TypeError, ValueError):
+        log.error("/send_record: Failed to transform received data to Record object.")
+        return JSONResponse({"message": "Failed to process data."}, 400)
+
+    msg = f"Record {rec.cookie} did not pass the validation, ignored."
+    policy = ValidationPolicy.from_args(data.get("min_age"), data.get("max_age"))
+    if policy.check(rec):
+        log.info(f"/send_record: Sending {rec.cookie} to ShowAds API.")
+        await request.app.state.show_ads.send_record(rec)
+        msg = f"Record {rec.cookie} sent to ShowAPI."
+    return JSONResponse({"message": msg}, 202)
+
+
+async def send_bulk_endpoint(request: Request) -> JSONResponse:
+    """POST endpoint for bulk record forwarding."""
+    # the other requests served by the loop meanwhile are profiled as well
+    with tracing.profiled("bulk"):
+        return await _send_bulk(request)
+
+
+async def _send_bulk(request: Request) -> JSONResponse:
+    async with request.form() as form:
+        upload_file = form.get("file")
+        if not isinstance(upload_file, UploadFile):
+            return JSONResponse({"message": "CSV file required."}, 400)
+        reader = find_reader(upload_file.filename or "", upload_file.content_type)
+        if reader is None:
+            return JSONResponse(
+                {
+                    "message": "Unsupported file format. Accepted formats: "
+                    f"{supported_formats()}."
+                },
+                415,
+            )
+        try:
+            min_age, max_age = (
+                int(form[key]) if form.get(key) else None
+                for key in ("min_age", "max_age")
+            )
+        except ValueError:
+            return JSONResponse({"message": "Age filters must be integers."}, 400)
+        policy = ValidationPolicy.from_args(min_age, max_age)
+        # the bulks are parsed on the loop, one at a time between the sends
+        records = reader.parse(upload_file.file, policy)
+        nof_recs = await send_data(request.app.state.show_ads, records)
+    log.info(f"/send_record/bulk: {nof_recs} sent, {policy.summary()}.")
+    return JSONResponse({"sent": nof_recs, "rejections": policy.report()}, 202)
+
+
+async def send_batch_endpoint(request: Request) -> JSONResponse:
+    """POST endpoint for batched record forwarding."""
+    try:
+        min_age, max_age = (
+            int(request.query_params[key]) if request.query_params.get(key) else None
+            for key in ("min_age", "max_age")
+        )
+    except ValueError:
+        return JSONResponse({"message": "Age filters must be integers."}, 400)
+    policy = ValidationPolicy.from_args(min_age, max_age)
+
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type in NDJSON_READER.content_types:
+        # the records are sent while the body is being received
+        items = _ndjson_items(request)
+    elif content_type == "application/json":
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not isinstance(data, list):
+            return JSONResponse({"message": "A JSON array of records required."}, 400)
+        items = _items(data)
+    else:
+        return JSONResponse(
+            {
+                "message": "Send a JSON array (application/json) "
+                "or NDJSON (application/x-ndjson)."
+            },
+            415,
+        )
+    results = await send_batch(request.app.state.show_ads, items, policy)
+    log.info(f"/send_record/batch: {results.sent} sent, {policy.summary()}.")
+    return JSONResponse(results.report(), 202)
+
+
+async def _ndjson_items(request: Request) -> AsyncIterator[Any]:
+    """Decode the NDJSON body as it arrives, see `batch.ndjson_items`."""
+    rest = b""
+    async for chunk in request.stream():
+        *lines, rest = (rest + chunk).split(b"\n")
+        for item in ndjson_items(lines):
+            yield item
+    for item in ndjson_items([rest]):
+        yield item
+
+
+async def _items(data: list[Any]) -> AsyncIterator[Any]:
+    for item in data:
+        yield item
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    """GET endpoint for the metrics of all the app processes."""
+    return Response(metrics.export(), media_type=metrics.CONTENT_TYPE)
+
+
+def create_asgi_app(
+    client_factory: Callable[[], AsyncShowAdsClient] = AsyncShowAdsClient.from_env,
+) -> Starlette:
+    """ASGI app factory function.
+
+    The app serves `/send_record`, `/send_record/bulk` and `/send_record/batch`
+    like the Flask app, the upstream calls do not block the event loop.
+
+    :param Callable client_factory: Creates the client of the ShowAds API on
+        startup (default: configured by the environment variables).
+    :return: The app.
+    :rtype: Starlette
+    """
+
+    @asynccontextmanager
+    async def lifespan(app: Starlette) -> AsyncIterator[None]:
+        dirpath = metrics.metrics_dirpath()
+        if dirpath:
+            metrics.start_snapshot_thread(
+                dirpath, float(os.getenv("METRICS_SNAPSHOT_INTERVAL", 5))
+            )
+        # the client is bound to the loop the app runs in
+        app.state.show_ads = client_factory()
+        try:
+            yield
+        finally:
+            await app.state.show_ads.close()
+
+    return Starlette(
+        routes=[
+            Route("/send_record", send_record_endpoint, methods=["POST"]),
+            Route("/send_record/bulk", send_bulk_endpoint, methods=["POST"]),
+            Route("/send_record/batch", send_batch_endpoint, methods=["POST"]),
+            Route("/metrics", metrics_endpoint, methods=["GET"]),
+        ],
+        # request IDs in the logs, spans of the requests if TRACE_FILEPATH is set
+        middleware=[Middleware(tracing.ASGIMiddleware)],
+        lifespan=lifespan,
+    )
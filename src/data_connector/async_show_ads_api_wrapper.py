@@ -0,0 +1,465 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, AsyncIterable, Callable, Iterable, TypeVar
+
+import aiohttp
+
+from data_connector import tracing
+from data_connector.batch import BatchResults, Bulk
+from data_connector.dedup import DedupCache, dedup_key
+from data_connector.delivery import (
+    DELIVERED,
+    REFRESH_TOKEN,
+    REFUSED,
+    BulkDelivery,
+    BulkResult,
+    next_step,
+    retry_delay,
+    status_label,
+    store_failed_record,
+    store_failed_records,
+    update_limiter,
+)
+from data_connector.encoder import EncodedPayload, encode_record
+from data_connector.metrics import TOKEN_REFRESHES, UPSTREAM_LATENCY, UPSTREAM_RETRIES
+from data_connector.record import Record, RecordBatch, ValidationPolicy
+from data_connector.show_ads_api_wrapper import (
+    ACCESS_TOKEN_TTL,
+    BULK_SIZE,
+    bulk_sizer_from_env,
+)
+from data_connector.throttle import (
+    CONNECTION_FAILED,
+    TIMED_OUT,
+    AdaptiveBulkSize,
+    AsyncAdaptiveConcurrency,
+    RetryPolicy,
+    TokenBucket,
+)
+from data_connector.utils import adaptive_batches
+
+T = TypeVar("T")
+
+
+class AsyncShowAdsClient:
+    """Asynchronous client of the ShowAds API.
+
+    Counterpart of `ShowAdsClient` for an event loop: the requests are sent
+    with a pooled `aiohttp.ClientSession`, so a waiting request holds neither
+    a thread nor a worker. The access token is refreshed by one coroutine at
+    a time. The client must be created and used within a single running
+    event loop.
+
+    :param str base_url: URL of the ShowAds API.
+    :param str project_key: The project key value.
+    :param int pool_size: Maximum number of connections to the API.
+    :param float token_ttl: Lifetime of the access token (in seconds), used if
+        the API does not return `ExpiresIn`.
+    :param float refresh_margin: The token is refreshed this many seconds
+        before it expires.
+    :param bool compress: Send the request bodies compressed with gzip.
+    :param (RetryPolicy | None) retry_policy: Backoff between the attempts.
+    :param (TokenBucket | None) rate_limiter: Limits the request rate.
+    :param (AsyncAdaptiveConcurrency | None) concurrency_limiter: Limits the
+        number of in-flight requests, backs off when the upstream replies 429.
+    :param (DedupCache | None) dedup: Records with a (cookie, banner ID) pair
+        delivered within the cache window are skipped.
+    :param (AdaptiveBulkSize | None) bulk_sizer: Limits the number of records
+        and bytes of a bulk, shrinks it when the upstream rejects a bulk.
+    :param (float | None) timeout: Time (in seconds) to wait for a response;
+        a timed out attempt is retried (default: no timeout).
+    """
+
+    def __init__(
+        self,
+        base_url: str | None,
+        project_key: str | None,
+        pool_size: int = 32,
+        token_ttl: float = ACCESS_TOKEN_TTL,
+        refresh_margin: float = 300,
+        compress: bool = False,
+        retry_policy: RetryPolicy | None = None,
+        rate_limiter: TokenBucket | None = None,
+        concurrency_limiter: AsyncAdaptiveConcurrency | None = None,
+        dedup: DedupCache | None = None,
+        bulk_sizer: AdaptiveBulkSize | None = None,
+        timeout: float | None = None,
+    ):
+        self.base_url = base_url
+        self.project_key = project_key
+        self.token_ttl = token_ttl
+        self.refresh_margin = refresh_margin
+        self.compress = compress
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter = rate_limiter or TokenBucket(0)
+        self.concurrency_limiter = concurrency_limiter or AsyncAdaptiveConcurrency(0)
+        self.dedup = dedup
+        self.bulk_sizer = bulk_sizer or AdaptiveBulkSize(BULK_SIZE)
+        self.timeout = timeout
+
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size),
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        )
+
+        self._access_token = ""
+        self._expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+
+    @classmethod
+    def from_env(cls) -> AsyncShowAdsClient:
+        """Create a client configured by the environment variables."""
+        pool_size = int(os.getenv("SHOW_ADS_POOL_SIZE", 32))
+        return cls(
+            os.getenv("API_URL"),
+            os.getenv("PROJECT_KEY"),
+            pool_size=pool_size,
+            token_ttl=float(os.getenv("ACCESS_TOKEN_TTL", ACCESS_TOKEN_TTL)),
+            refresh_margin=float(os.getenv("ACCESS_TOKEN_REFRESH_MARGIN", 300)),
+            compress=os.getenv("SHOW_ADS_GZIP", "").lower() in {"1", "true", "yes"},
+            retry_policy=RetryPolicy.from_env(),
+            rate_limiter=TokenBucket(
+                float(os.getenv("SHOW_ADS_RATE_LIMIT", 0)),
+                float(os.getenv("SHOW_ADS_RATE_BURST", 0)) or None,
+            ),
+            concurrency_limiter=AsyncAdaptiveConcurrency(
+                int(os.getenv("SHOW_ADS_MAX_IN_FLIGHT", pool_size))
+            ),
+            dedup=DedupCache.from_env(),
+            bulk_sizer=bulk_sizer_from_env(),
+            timeout=float(os.getenv("SHOW_ADS_TIMEOUT", 0)) or None,
+        )
+
+    @property
+    def access_token(self) -> str:
+        return self._access_token
+
+    async def close(self):
+        """Close the pooled connections."""
+        await self.session.close()
+
+    async def get_access_token(self) -> str:
+        """Return a valid access token, refresh it if it is about to expire."""
+        token = self._access_token
+        if not token or time.monotonic() >= self._expires_at - self.refresh_margin:
+            token = await self.update_access_token(stale_token=token)
+        return token
+
+    async def update_access_token(
+        self, nof_tries: int = 3, stale_token: str | None = None
+    ) -> str:
+        """Updates an access token, see `ShowAdsClient.update_access_token`.
+
+        :param int nof_tries: Number of tries.
+        :param (str | None) stale_token: The token the caller found invalid.
+        :return: The current access token (empty if it was never fetched).
+        :rtype: str
+        """
+        async with self._token_lock:
+            if stale_token is not None and stale_token != self._access_token:
+                return self._access_token
+
+            logging.info(
+                f"Sending a AccessToken request for project {self.project_key}."
+            )
+            status, retry_after, body = await self._post_auth()
+            tries = 0
+            while status != 200 and (nof_tries == -1 or tries < nof_tries):
+                logging.warning(
+                    f"Access Token request fail: Request return code {status}."
+                )
+                await asyncio.sleep(self.retry_policy.delay(tries, retry_after))
+                tries += 1
+                status, retry_after, body = await self._post_auth()
+
+            if status != 200:
+                logging.error("Access Token request fail: Unable to fetch auth token.")
+                TOKEN_REFRESHES.inc(result="failure")
+                return self._access_token
+            logging.info("Access Token loaded")
+            TOKEN_REFRESHES.inc(result="success")
+            data = json.loads(body)
+            self._access_token = data["AccessToken"]
+            self._expires_at = time.monotonic() + float(
+                data.get("ExpiresIn", self.token_ttl)
+            )
+            return self._access_token
+
+    async def send_bulk(
+        self,
+        bulk_id: int,
+        lof_records: RecordBatch | list[Record],
+        spill: bool = True,
+    ) -> int:
+        """Send a bulk of customer records, see `ShowAdsClient.send_bulk`.
+
+        :param int bulk_id: ID of the bulk used in the logs.
+        :param (RecordBatch | list[Record]) lof_records: The records to send.
+        :param bool spill: Store the records for a later resend if they
+            cannot be sent.
+        :return: Number of records successfully sent, including the duplicates
+            skipped by the dedup cache.
+        :rtype: int
+        """
+        return (await self.deliver_bulk(bulk_id, lof_records, spill)).sent
+
+    async def deliver_bulk(
+        self,
+        bulk_id: int,
+        lof_records: RecordBatch | list[Record],
+        spill: bool = True,
+    ) -> BulkResult:
+        """Send a bulk of customer records, see `ShowAdsClient.deliver_bulk`.
+
+        :param int bulk_id: ID of the bulk used in the logs.
+        :param (RecordBatch | list[Record]) lof_records: The records to send.
+        :param bool spill: Store the records that cannot be sent for a later
+            resend, and the refused ones with the reason.
+        :return: The delivered records, the duplicates skipped by the dedup
+            cache included, and the refused ones.
+        :rtype: BulkResult
+        """
+        with tracing.span(
+            "send_bulk", **{"bulk.id": bulk_id, "records": len(lof_records)}
+        ) as span:
+            result = await self._deliver_bulk(bulk_id, lof_records, spill)
+            span.set(sent=result.sent, rejected=len(result.rejected))
+        return result
+
+    async def _deliver_bulk(
+        self, bulk_id: int, lof_records: RecordBatch | list[Record], spill: bool
+    ) -> BulkResult:
+        if not isinstance(lof_records, RecordBatch):
+            lof_records = RecordBatch.from_records(lof_records)
+        delivery = BulkDelivery(
+            bulk_id,
+            lof_records,
+            self.bulk_sizer,
+            self.compress,
+            dedup=self.dedup is not None,
+        )
+        if self.dedup is not None:
+            delivery.skip_duplicates(
+                await self._call_dedup(self.dedup.new_keys, delivery.keys)
+            )
+
+        while (payload := delivery.next_payload()) is not None:
+            started = time.perf_counter()
+            status, detail = await self._deliver(
+                "/banners/show/bulk", payload, f"bulk {bulk_id}"
+            )
+            delivery.finish_part(status, detail, time.perf_counter() - started)
+        if self.dedup is not None:
+            await self._call_dedup(self.dedup.add, delivery.delivered_keys())
+
+        result = delivery.result
+        if spill and result.sent < len(delivery.records):
+            # the spill file is synced to disk, keep it off the loop
+            await asyncio.to_thread(store_failed_records, delivery.records, result)
+        return delivery.bulk_result()
+
+    async def send_record(self, rec: Record) -> int:
+        """Send a single customer record, see `ShowAdsClient.send_record`.
+
+        :param Record rec: The given record to be sent to the external API.
+        :return: Number of records successfully sent, including a duplicate
+            skipped by the dedup cache.
+        :rtype: int
+        """
+        key = dedup_key(rec.cookie, rec.banner_id)
+        if self.dedup is not None:
+            (new,) = await self._call_dedup(self.dedup.new_keys, [key])
+            if not new:
+                logging.info(f"Record {rec.cookie} is a duplicate, skipped.")
+                return 1
+
+        payload = encode_record(rec, self.compress)
+        status, detail = await self._deliver(
+            "/banners/show", payload, f"record {rec.cookie}"
+        )
+        if status == 200:
+            if self.dedup is not None:
+                await self._call_dedup(self.dedup.add, [key])
+            return 1
+        await asyncio.to_thread(store_failed_record, rec, status, detail)
+        return 0
+
+    async def _call_dedup(
+        self, method: Callable[[list[str]], T], keys: list[str]
+    ) -> T:
+        """Call the dedup cache, in a thread if it blocks, see `DedupCache`."""
+        if self.dedup is not None and self.dedup.blocking:
+            return await asyncio.to_thread(method, keys)
+        return method(keys)
+
+    async def _deliver(
+        self, path: str, payload: EncodedPayload, what: str
+    ) -> tuple[int, str]:
+        """Send a payload, see `ShowAdsClient._deliver`."""
+        token = await self.get_access_token()
+        policy = self.retry_policy
+        status = TIMED_OUT
+        for attempt in range(policy.attempts):
+            if attempt:
+                UPSTREAM_RETRIES.inc(endpoint=path)
+            while (wait := self.rate_limiter.try_acquire()) > 0:
+                await asyncio.sleep(wait)
+            retry_after = None
+            content = b""
+            async with self.concurrency_limiter.slot() as limiter:
+                status, retry_after, content = await self._post(
+                    path,
+                    payload.body,
+                    {**payload.headers, "Authorization": f"Bearer {token}"},
+                )
+                update_limiter(limiter, status)
+
+            step = next_step(status, what, self.timeout)
+            if step == DELIVERED:
+                return status, ""
+            if step == REFRESH_TOKEN:
+                token = await self.update_access_token(stale_token=token)
+                continue
+            if step == REFUSED:
+                detail = content[:200].decode(errors="replace").strip()
+                return status, detail if status == 400 else ""
+            delay = retry_delay(policy, status, attempt, retry_after)
+            if delay:
+                await asyncio.sleep(delay)
+        return status, ""
+
+    async def _post_auth(self) -> tuple[int, str | None, bytes]:
+        while (wait := self.rate_limiter.try_acquire()) > 0:
+            await asyncio.sleep(wait)
+        return await self._post(
+            "/auth",
+            json.dumps({"ProjectKey": self.project_key}).encode(),
+            {"Content-Type": "application/json"},
+        )
+
+    async def _post(
+        self, path: str, body: bytes, headers: dict[str, str]
+    ) -> tuple[int, str | None, bytes]:
+        """Send a request, return its status, `Retry-After` header and body.
+
+        The status is `TIMED_OUT` or `CONNECTION_FAILED` if there was no
+        response.
+        """
+        started = time.perf_counter()
+        status, retry_after, content = TIMED_OUT, None, b""
+        with tracing.span(
+            "upstream", tracing.SPAN_KIND_CLIENT, **{"http.route": path}
+        ) as span:
+            try:
+                async with self.session.post(
+                    f"{self.base_url}{path}", data=body, headers=headers
+                ) as res:
+                    # read to the end, the connection is reused
+                    content = await res.read()
+                status, retry_after = res.status, res.headers.get("Retry-After")
+                span.set(**{"http.status_code": status})
+                if status != 200:
+                    span.fail(f"Return code {status}.")
+            except asyncio.TimeoutError:
+                span.fail(f"No response in {self.timeout}s.")
+            except aiohttp.ClientError as e:
+                # e.g. refused or reset connection, retried like a timeout
+                status = CONNECTION_FAILED
+                span.fail(f"Connection failed: {e}")
+        UPSTREAM_LATENCY.observe(
+            time.perf_counter() - started, endpoint=path, status=status_label(status)
+        )
+        return status, retry_after, content
+
+
+async def send_data(
+    client: AsyncShowAdsClient,
+    records: Iterable[Record],
+    concurrency: int | None = None,
+) -> int:
+    """Send records to the ShowAds API, see `show_ads_api_wrapper.send_data`.
+
+    At most `concurrency` bulks are in flight at once; the records are not
+    consumed any further until one of them finishes.
+
+    :param AsyncShowAdsClient client: The client.
+    :param Iterable[Record] records: Valid records to send.
+    :param (int | None) concurrency: Number of bulks sent in parallel. If not
+        set, the value is taken from `SEND_CONCURRENCY` environment variable.
+    :return: Number of records sent.
+    :rtype: int
+    """
+    if not concurrency:
+        concurrency = int(os.getenv("SEND_CONCURRENCY", 1))
+
+    total_sent = 0
+    in_flight: set[asyncio.Task[int]] = set()
+    bulks = tracing.traced(adaptive_batches(records, client.bulk_sizer), "read_bulk")
+    for bulk_id, bulk in enumerate(bulks):
+        if len(in_flight) >= concurrency:
+            done, in_flight = await asyncio.wait(
+                in_flight, return_when=asyncio.FIRST_COMPLETED
+            )
+            total_sent += sum(task.result() for task in done)
+        in_flight.add(asyncio.ensure_future(client.send_bulk(bulk_id, bulk)))
+    if in_flight:
+        done, _ = await asyncio.wait(in_flight)
+        total_sent += sum(task.result() for task in done)
+    return total_sent
+
+
+async def send_batch(
+    client: AsyncShowAdsClient,
+    items: AsyncIterable[Any],
+    policy: ValidationPolicy,
+    concurrency: int | None = None,
+) -> BatchResults:
+    """Validate a batch of JSON records and send the valid ones in bulks.
+
+    Counterpart of `batch.send_batch`; at most `concurrency` bulks are in
+    flight at once.
+
+    :param AsyncShowAdsClient client: The client.
+    :param AsyncIterable[Any] items: Decoded JSON values of the records, see
+        `BatchResults.add`.
+    :param ValidationPolicy policy: Validation rules of the records.
+    :param (int | None) concurrency: Number of bulks sent in parallel. If not
+        set, the value is taken from `SEND_CONCURRENCY` environment variable.
+    :return: Result of every record.
+    :rtype: BatchResults
+    """
+    if not concurrency:
+        concurrency = int(os.getenv("SEND_CONCURRENCY", 1))
+
+    results = BatchResults(policy, client.bulk_sizer)
+    in_flight: dict[asyncio.Task[BulkResult], Bulk] = {}
+
+    async def submit(bulk_id: int, bulk: Bulk):
+        if len(in_flight) >= concurrency:
+            done, _ = await asyncio.wait(
+                in_flight, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                results.finish(in_flight.pop(task), task.result())
+        task = asyncio.ensure_future(client.deliver_bulk(bulk_id, bulk[1]))
+        in_flight[task] = bulk
+
+    bulk_id = 0
+    async for item in items:
+        bulk = results.add(item)
+        if bulk is not None:
+            await submit(bulk_id, bulk)
+            bulk_id += 1
+    bulk = results.flush()
+    if bulk is not None:
+        await submit(bulk_id, bulk)
+    if in_flight:
+        done, _ = await asyncio.wait(in_flight)
+        for task in done:
+            results.finish(in_flight[task], task.result())
+    return results
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import json
+import os
+from typing import Any, Iterable, Iterator
+
+from data_connector.record import (
+    REJECT_MESSAGES,
+    Record,
+    RecordBatch,
+    ValidationPolicy,
+)
+from data_connector.delivery import BulkResult
+from data_connector.encoder import BULK_ENVELOPE_BYTES, record_bytes
+from data_connector.show_ads_api_wrapper import BULK_SIZE, dispatch, get_client
+from data_connector.throttle import AdaptiveBulkSize
+from data_connector.utils import record_from_json
+
+# accepted records of a bulk: their positions in the batch and the records
+Bulk = tuple[list[int], RecordBatch]
+
+
+class BatchResults:
+    """Per-record results of a batch of JSON records, see `send_batch`.
+
+    Every record gets a result at its position in the batch: `rejected` with
+    the failed rule (`upstream` if the ShowAds API refused it, with its
+    reason), `sent`, or `failed` if it could not be delivered (the record is
+    then stored for a later resend like any other unsent record). The
+    rejections are also counted by the policy, the `line` of the examples is
+    the position of the record in the batch, counted from 1.
+
+    :param ValidationPolicy policy: Validation rules of the records.
+    :param (AdaptiveBulkSize | None) sizer: Size of the bulks (default: at
+        most `BULK_SIZE` records).
+    """
+
+    def __init__(
+        self, policy: ValidationPolicy, sizer: AdaptiveBulkSize | None = None
+    ):
+        self.policy = policy
+        self.sizer = sizer or AdaptiveBulkSize(BULK_SIZE)
+        self.results: list[dict[str, Any]] = []
+        self.sent = 0
+        self.failed = 0
+        # accepted records not yielded in a bulk yet
+        self._indices: list[int] = []
+        self._batch = RecordBatch()
+        self._nbytes = BULK_ENVELOPE_BYTES
+        self._limit = self.sizer.size
+
+    def bulks(self, items: Iterable[Any]) -> Iterator[Bulk]:
+        """Validate the items, yield the accepted records in bulks.
+
+        The items are consumed lazily, a bulk is yielded once it is full, see
+        `add`; an empty bulk is never yielded.
+
+        :param Iterable[Any] items: Decoded JSON values, see `add`.
+        :return: Iterator of the bulks.
+        :rtype: Iterator[Bulk]
+        """
+        for item in items:
+            bulk = self.add(item)
+            if bulk is not None:
+                yield bulk
+        bulk = self.flush()
+        if bulk is not None:
+            yield bulk
+
+    def add(self, item: Any) -> Bulk | None:
+        """Validate a single item and store its result.
+
+        :param Any item: Decoded JSON value of the record; raw bytes stand for
+            an NDJSON line that is not valid JSON.
+        :return: The pending bulk if the record does not fit in it (it holds
+            `sizer.size` records or the record would take it over
+            `sizer.max_bytes`), None otherwise. The record starts a new bulk.
+        :rtype: Bulk | None
+        """
+        rec = self._validate(item)
+        if rec is None:
+            return None
+        rec_bytes = 0
+        if self.sizer.max_bytes:
+            rec_bytes = record_bytes(rec.cookie, rec.banner_id)
+        bulk = None
+        if self._indices and (
+            len(self._indices) >= self._limit
+            or (
+                self.sizer.max_bytes
+                and self._nbytes + rec_bytes > self.sizer.max_bytes
+            )
+        ):
+            bulk = self.flush()
+        self._indices.append(len(self.results) - 1)
+        self._batch.append(rec)
+        self._nbytes += rec_bytes
+        return bulk
+
+    def flush(self) -> Bulk | None:
+        """Take the accepted records that are not in a bulk yet.
+
+        :return: The bulk; None if there are no such records.
+        :rtype: Bulk | None
+        """
+        if not self._indices:
+            return None
+        bulk = self._indices, self._batch
+        self._indices, self._batch = [], RecordBatch()
+        # the size of the next bulk follows the upstream responses
+        self._nbytes, self._limit = BULK_ENVELOPE_BYTES, self.sizer.size
+        return bulk
+
+    def finish(self, bulk: Bulk, result: BulkResult):
+        """Store the result of a finished bulk.
+
+        :param Bulk bulk: The bulk.
+        :param BulkResult result: Result of its records, see `deliver_bulk`.
+        """
+        indices, _ = bulk
+        for i, (index, delivered) in enumerate(zip(indices, result.delivered)):
+            entry = self.results[index]
+            if delivered:
+                entry["status"] = "sent"
+                self.sent += 1
+            elif i in result.rejected:
+                self.policy.reject("upstream", index + 1, entry["cookie"])
+                entry.update(self._rejected("upstream"))
+                entry["message"] = result.rejected[i]
+            else:
+                entry["status"] = "failed"
+                self.failed += 1
+
+    def report(self) -> dict[str, Any]:
+        """Response body: the counts, the rejection report and the results."""
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "rejections": self.policy.report(),
+            "results": self.results,
+        }
+
+    def _validate(self, item: Any) -> Record | None:
+        """Store the result of an item, return the record if it is accepted."""
+        position = len(self.results) + 1
+        rec = None if isinstance(item, bytes) else record_from_json(item)
+        if rec is None:
+            row = (
+                item.decode(errors="replace").strip()
+                if isinstance(item, bytes)
+                else json.dumps(item)
+            )
+            self.policy.reject("format", position, row=row)
+            self.results.append(self._rejected("format"))
+            return None
+
+        rule = self.policy.reject_reason(rec.name, rec.age, rec.banner_id)
+        if rule is not None:
+            self.policy.reject(rule, position, rec.cookie)
+            self.results.append({"cookie": rec.cookie, **self._rejected(rule)})
+            return None
+        self.results.append({"cookie": rec.cookie, "status": "accepted"})
+        return rec
+
+    @staticmethod
+    def _rejected(rule: str) -> dict[str, Any]:
+        return {"status": "rejected", "rule": rule, "message": REJECT_MESSAGES[rule]}
+
+
+def ndjson_items(lines: Iterable[bytes]) -> Iterator[Any]:
+    """Decode the lines of an NDJSON body, skip the empty ones.
+
+    A line that is not valid JSON is yielded as is, see `BatchResults.add`.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield line
+
+
+def send_batch(
+    items: Iterable[Any],
+    policy: ValidationPolicy,
+    concurrency: int | None = None,
+) -> BatchResults:
+    """Validate a batch of JSON records and send the valid ones in bulks.
+
+    The records are validated in one pass with the rules of `Record.validate`
+    and the accepted ones are sent in bulks sized by the `AdaptiveBulkSize` of
+    the client, so a batch costs one upstream request per bulk instead of one
+    per record. The items are consumed lazily, a streamed body is sent while
+    it is being received.
+
+    :param Iterable[Any] items: Decoded JSON values of the records, see
+        `BatchResults.add`.
+    :param ValidationPolicy policy: Validation rules of the records.
+    :param (int | None) concurrency: Number of bulks sent in parallel. If not
+        set, the value is taken from `SEND_CONCURRENCY` environment variable.
+    :return: Result of every record.
+    :rtype: BatchResults
+    """
+    if not concurrency:
+        concurrency = int(os.getenv("SEND_CONCURRENCY", 1))
+    client = get_client()
+    results = BatchResults(policy, client.bulk_sizer)
+    dispatch(
+        results.bulks(items),
+        lambda bulk_id, bulk: client.deliver_bulk(bulk_id, bulk[1]),
+        concurrency,
+        results.finish,
+    )
+    return results
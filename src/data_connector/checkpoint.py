@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, field, replace
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Iterator
+
+from data_connector.record import RecordBatch, ValidationPolicy
+from data_connector.show_ads_api_wrapper import BULK_SIZE, dispatch, send_bulk
+from data_connector.utils import batched_records, parse_file
+
+# validation rules that decide which records end up in which bulk
+POLICY_SETTINGS = (
+    "min_age",
+    "max_age",
+    "min_banner_id",
+    "max_banner_id",
+    "max_name_length",
+)
+
+
+@dataclass
+class CheckpointBulk:
+    """Bulk of records and the position in the file right after its last record."""
+
+    id: int
+    batch: RecordBatch
+    end: int
+    line: int
+
+
+@dataclass
+class Checkpoint:
+    """Progress of a file upload, see `send_file_checkpointed`.
+
+    Everything before `offset` is sent (or spilled for a later resend). Bulks
+    that finished out of order, while an earlier one was still in flight, are
+    kept in `confirmed` until the offset reaches them.
+    """
+
+    # identity of the file and the rules, the bulks depend on both
+    size: int
+    mtime_ns: int
+    policy: dict[str, Any]
+    offset: int = 0
+    # number of lines before the offset
+    line: int = 0
+    # ID of the first bulk after the offset
+    next_bulk: int = 0
+    # bulks after the offset that are already finished: ID -> [end, line]
+    confirmed: dict[int, list[int]] = field(default_factory=dict)
+    # valid records in the finished bulks, and those of them that were sent
+    accepted: int = 0
+    sent: int = 0
+
+    @classmethod
+    def start(cls, path: Path, policy: ValidationPolicy) -> Checkpoint:
+        """Checkpoint of an upload that has not sent anything yet."""
+        stat = os.stat(path)
+        return cls(
+            stat.st_size,
+            stat.st_mtime_ns,
+            {name: getattr(policy, name) for name in POLICY_SETTINGS},
+        )
+
+    @classmethod
+    def load(cls, state_path: Path) -> Checkpoint | None:
+        """Read a checkpoint; None if there is none."""
+        try:
+            with open(state_path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        data["confirmed"] = {int(k): v for k, v in data["confirmed"].items()}
+        return cls(**data)
+
+    def save(self, state_path: Path):
+        # atomic replace, an interrupted write leaves the previous checkpoint
+        tmp = state_path.with_name(f".{state_path.name}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(asdict(self), f)
+        os.replace(tmp, state_path)
+
+    def matches(self, other: Checkpoint) -> bool:
+        """Check if both checkpoints are of the same file and rules."""
+        return (self.size, self.mtime_ns, self.policy) == (
+            other.size,
+            other.mtime_ns,
+            other.policy,
+        )
+
+    def validation_policy(self) -> ValidationPolicy:
+        """Validation rules the upload was started with."""
+        return replace(ValidationPolicy.from_args(), **self.policy)
+
+    def confirm(self, bulk: CheckpointBulk, sent: int):
+        """Record a finished bulk, move the offset past the finished ones."""
+        self.accepted += len(bulk.batch)
+        self.sent += sent
+        self.confirmed[bulk.id] = [bulk.end, bulk.line]
+        while self.next_bulk in self.confirmed:
+            self.offset, self.line = self.confirmed.pop(self.next_bulk)
+            self.next_bulk += 1
+
+
+class _CountedLines:
+    """Lines of a binary file, tracks the offset and the number of the lines read."""
+
+    def __init__(self, file: BinaryIO, offset: int, line: int):
+        self._file = file
+        self.offset = offset
+        self.line = line
+
+    def __iter__(self) -> Iterator[bytes]:
+        for line in self._file:
+            self.offset += len(line)
+            self.line += 1
+            yield line
+
+
+def checkpoint_path(path: Path) -> Path:
+    """State file of an upload of `path`.
+
+    The file is stored next to the uploaded one, or in `CHECKPOINT_DIRPATH`
+    directory if the environment variable is set.
+    """
+    dirpath = os.getenv("CHECKPOINT_DIRPATH")
+    return Path(dirpath or path.parent) / f"{path.name}.checkpoint.json"
+
+
+def send_file_checkpointed(
+    path: Path,
+    policy: ValidationPolicy,
+    state_path: Path | None = None,
+    concurrency: int | None = None,
+    resume: bool = False,
+    on_bulk: Callable[[int, int], None] | None = None,
+) -> int:
+    """Send a CSV file, store the progress after every finished bulk.
+
+    The checkpoint (the byte offset up to which every bulk is finished and
+    the IDs of the bulks finished after it) is written to the state file
+    whenever a bulk is sent or spilled. An interrupted upload resumed from
+    the checkpoint reads the file from the offset and skips the finished
+    bulks, so at most the bulks that were in flight are sent again. The state
+    file is removed once the whole file is sent.
+
+    The rejection report of the policy covers only the rows read after the
+    checkpoint.
+
+    :param Path path: The CSV file.
+    :param ValidationPolicy policy: Validation rules of the records.
+    :param (Path | None) state_path: The state file (default: see
+        `checkpoint_path`).
+    :param (int | None) concurrency: Number of bulks sent in parallel. If not
+        set, the value is taken from `SEND_CONCURRENCY` environment variable.
+    :param bool resume: Continue from the checkpoint in the state file, if
+        there is one.
+    :param Callable on_bulk: Called with the bulk size and the number of sent
+        records once a bulk is finished, see `send_data`.
+    :return: Number of records sent, including those sent before the resume.
+    :rtype: int
+    :raises ValueError: The checkpoint is of another version of the file or
+        of other validation rules.
+    """
+    state_path = state_path or checkpoint_path(path)
+    if not concurrency:
+        concurrency = int(os.getenv("SEND_CONCURRENCY", 1))
+
+    checkpoint = Checkpoint.start(path, policy)
+    saved = Checkpoint.load(state_path) if resume else None
+    if saved is not None:
+        if not saved.matches(checkpoint):
+            raise ValueError(
+                f"Checkpoint {state_path} does not match the file or the filters."
+            )
+        checkpoint = saved
+        logging.info(
+            f"Resuming {path} from line {checkpoint.line + 1}, "
+            f"{checkpoint.sent} records sent before."
+        )
+    checkpoint.save(state_path)
+
+    with open(path, "rb") as f:
+        f.seek(checkpoint.offset)
+        lines = _CountedLines(f, checkpoint.offset, checkpoint.line)
+        records = parse_file(lines, policy, first_line=checkpoint.line + 1)
+
+        def bulks() -> Iterator[CheckpointBulk]:
+            for bulk_id, batch in enumerate(
+                batched_records(records, BULK_SIZE), checkpoint.next_bulk
+            ):
+                # the bulks are cut the same way as before the interruption;
+                # a confirmed bulk may already be behind the offset here
+                finished = bulk_id < checkpoint.next_bulk
+                if not finished and bulk_id not in checkpoint.confirmed:
+                    yield CheckpointBulk(bulk_id, batch, lines.offset, lines.line)
+
+        def on_done(bulk: CheckpointBulk, sent: int):
+            checkpoint.confirm(bulk, sent)
+            checkpoint.save(state_path)
+            if on_bulk:
+                on_bulk(len(bulk.batch), sent)
+
+        dispatch(
+            bulks(),
+            lambda _, bulk: send_bulk(bulk.id, bulk.batch),
+            concurrency,
+            on_done,
+        )
+    state_path.unlink(missing_ok=True)
+    return checkpoint.sent
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+import time
+from typing import Callable
+
+from data_connector.metrics import QUEUE_DEPTH
+from data_connector.record import Record
+from data_connector.show_ads_api_wrapper import BULK_SIZE, send_bulk
+from data_connector.utils import store_unsent_records
+
+# marks the end of the queue
+_CLOSE = None
+
+
+class RecordCoalescer:
+    """Collects single records and sends them to the ShowAds API in bulks.
+
+    The records are queued in-process and a background thread flushes them as
+    a bulk once `max_size` records are collected, or `flush_ms` milliseconds
+    after the first record of the bulk arrived, whichever comes first.
+
+    :param int flush_ms: Maximum time (in milliseconds) a record waits in
+        the queue.
+    :param int max_size: Maximum number of records in a bulk.
+    :param Callable sender: Function sending a bulk, see `send_bulk`.
+    """
+
+    def __init__(
+        self,
+        flush_ms: int = 100,
+        max_size: int = BULK_SIZE,
+        sender: Callable[[int, list[Record]], int] = send_bulk,
+    ):
+        self.flush_ms = flush_ms
+        self.max_size = max_size
+        self.sender = sender
+        self.sent = 0
+        self._bulk_id = 0
+        self._queue: queue.Queue[Record | None] = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="record_coalescer", daemon=True
+        )
+
+    def start(self) -> RecordCoalescer:
+        """Start the background flushing thread."""
+        QUEUE_DEPTH.set_function(self._queue.qsize, queue="coalescer")
+        self._thread.start()
+        return self
+
+    def submit(self, rec: Record):
+        """Queue a validated record for sending.
+
+        :param Record rec: The record to be sent.
+        :raises RuntimeError: The coalescer was already closed.
+        """
+        if self._closed:
+            raise RuntimeError("Record coalescer is closed.")
+        self._queue.put(rec)
+
+    def close(self, timeout: float | None = None):
+        """Stop accepting records and wait until the queue is drained.
+
+        :param (float | None) timeout: Maximum time (in seconds) to wait.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_CLOSE)
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self):
+        running = True
+        while running:
+            rec = self._queue.get()
+            if rec is _CLOSE:
+                break
+            bulk = [rec]
+            deadline = time.monotonic() + self.flush_ms / 1000
+            while len(bulk) < self.max_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    rec = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if rec is _CLOSE:
+                    running = False
+                    break
+                bulk.append(rec)
+            self._flush(bulk)
+        # records submitted right before the close
+        leftover = []
+        while not self._queue.empty():
+            rec = self._queue.get_nowait()
+            if rec is not _CLOSE:
+                leftover.append(rec)
+        for i in range(0, len(leftover), self.max_size):
+            self._flush(leftover[i : i + self.max_size])
+
+    def _flush(self, bulk: list[Record]):
+        try:
+            self.sent += self.sender(self._bulk_id, bulk)
+        except Exception:
+            # e.g. the connection failed; keep the records for a later resend
+            logging.exception(f"Coalesced bulk {self._bulk_id} fail.")
+            store_unsent_records(bulk)
+        self._bulk_id += 1
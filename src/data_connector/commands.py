@@ -1,29 +1,158 @@
 from __future__ import annotations
+
+import logging
+import os
 from pathlib import Path
 
 import click
-from flask.cli import with_appcontext
 
+from data_connector import tracing
+from data_connector.checkpoint import checkpoint_path, send_file_checkpointed
+from data_connector.record import ValidationPolicy
 from data_connector.show_ads_api_wrapper import send_data
-from data_connector.utils import allowed_file_extension, parse_file
+from data_connector.utils import CSV_READER, find_reader, supported_formats
+
+# the commands run in the `flask` CLI of the app and in the standalone
+# `data-connector` CLI, which neither creates the app nor imports Flask; the
+# modules used by a single option are imported when it is used
 
 
 @click.command(name="upload-file")
 @click.option("-mi", "--minimum", help="Minimum age filter", type=int)
 @click.option("-ma", "--maximum", help="Maximum age filter", type=int)
+@click.option(
+    "-c", "--concurrency", help="Number of bulks sent in parallel", type=int
+)
+@click.option(
+    "-w", "--workers", help="Number of processes parsing the file", type=int
+)
+@click.option(
+    "--checkpoint",
+    help="Store the progress of the upload after every bulk",
+    is_flag=True,
+)
+@click.option(
+    "--resume",
+    help="Continue an interrupted upload from its checkpoint",
+    is_flag=True,
+)
 @click.argument("filename")
-@with_appcontext
-def upload_file(minimum: int | None, maximum: int | None, filename: str):
+@tracing.traced_command("upload-file")
+def upload_file(
+    minimum: int | None,
+    maximum: int | None,
+    concurrency: int | None,
+    workers: int | None,
+    checkpoint: bool,
+    resume: bool,
+    filename: str,
+):
     """CLI command to process CSV file.
 
+    The file can also be a gzip or zstd compressed CSV, NDJSON or Parquet
+    file, the format is given by its extension. With `--checkpoint` the
+    progress of a CSV upload is stored after every bulk, see `--resume`.
+
     :param str filename: File path to the CSV file.
     """
-    if not allowed_file_extension(filename):
-        click.echo("Only CSV file format is supported.")
+    reader = find_reader(filename)
+    if reader is None:
+        click.echo(f"Unsupported file format. Accepted formats: {supported_formats()}.")
         exit(1)
 
-    buffer = []
-    with open(Path(filename), "rb") as f:
-        buffer = parse_file(f, minimum, maximum)
-    nof_recs = send_data(buffer)
+    path = Path(filename)
+    policy = ValidationPolicy.from_args(minimum, maximum)
+    # resuming an upload keeps checkpointing it
+    checkpoint = checkpoint or resume
+    if reader is CSV_READER and workers and workers > 1:
+        if checkpoint:
+            click.echo("--checkpoint and --resume cannot be combined with --workers.")
+            exit(1)
+        from data_connector.sharding import send_file_sharded
+
+        nof_recs = send_file_sharded(path, policy, workers, concurrency)
+    elif reader is CSV_READER and checkpoint:
+        state_path = checkpoint_path(path)
+        if not resume and state_path.exists():
+            click.echo(
+                f"Found the checkpoint of an interrupted upload ({state_path}). "
+                "Use --resume to continue it, or remove the file to start over."
+            )
+            exit(1)
+        try:
+            nof_recs = send_file_checkpointed(
+                path, policy, state_path, concurrency, resume
+            )
+        except ValueError as e:
+            click.echo(str(e))
+            exit(1)
+    else:
+        if workers and workers > 1:
+            click.echo(
+                f"--workers is ignored, {reader.name} files are read by one process."
+            )
+        if checkpoint:
+            click.echo(
+                "--checkpoint and --resume are ignored, only plain CSV uploads "
+                "are checkpointed."
+            )
+        with open(path, "rb") as f:
+            # records are sent while the rest of the file is still being read
+            nof_recs = send_data(reader.parse(f, policy), concurrency)
     click.echo(f"Successfully sent {nof_recs} of records.")
+    click.echo(f"Rows {policy.summary()}.")
+    for example in policy.examples:
+        line = f"line {example['line']}: " if "line" in example else ""
+        click.echo(f"  {line}{example['message']} {example.get('row', '')}".rstrip())
+
+
+@click.command(name="replay-unsent")
+@click.option(
+    "-c", "--concurrency", help="Number of bulks sent in parallel", type=int
+)
+@click.argument("filenames", nargs=-1)
+@tracing.traced_command("replay-unsent")
+def replay_unsent_records(concurrency: int | None, filenames: tuple[str, ...]):
+    """CLI command to resend the records that could not be sent.
+
+    The delivered records are removed from the spill files.
+
+    :param tuple[str] filenames: Spill files to replay (default: all the files
+        in `FAILED_RECORDS_DIRPATH`).
+    """
+    from data_connector.replay import replay_unsent
+
+    paths = [Path(filename) for filename in filenames] or None
+    result = replay_unsent(paths, concurrency)
+    click.echo(
+        f"Successfully resent {result.delivered} of records, "
+        f"{result.left} of records left."
+    )
+    if result.rejected:
+        click.echo(
+            f"{result.rejected} of records refused by the ShowAds API, "
+            "moved to the rejected files."
+        )
+
+
+@click.group(name="data-connector")
+def main():
+    """Send customer records to the ShowAds API.
+
+    Standalone counterpart of the `flask` CLI of the app for the scheduled
+    uploads: it starts without building the app. Takes the same environment
+    variables as the app.
+    """
+    level = os.getenv("LOGLEVEL", "WARNING").upper()
+    if level not in {"DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"}:
+        level = "WARNING"
+    logging.basicConfig(level=level, format=tracing.LOG_FORMAT)
+    tracing.install_log_filter()
+    for name in ("API_URL", "PROJECT_KEY"):
+        if not os.getenv(name):
+            click.echo(f"Environment variable {name} not found.", err=True)
+            exit(1)
+
+
+main.add_command(upload_file)
+main.add_command(replay_unsent_records)
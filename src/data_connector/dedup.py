@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import os
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable
+
+from data_connector.metrics import DEDUP_LOOKUPS
+
+# separates the cookie from the banner ID in the cache keys
+_SEP = "\x1f"
+
+
+def dedup_key(cookie: str, banner_id: int) -> str:
+    """Cache key of a (VisitorCookie, BannerId) pair."""
+    return f"{cookie}{_SEP}{banner_id}"
+
+
+class DedupCache(ABC):
+    """Remembers the pairs delivered to the ShowAds API within a time window.
+
+    :param float ttl: Length of the window (in seconds).
+    :param int max_entries: Maximum number of remembered pairs.
+    """
+
+    # the calls wait for I/O, an event loop makes them in a thread
+    blocking = False
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> DedupCache | None:
+        """Create a cache if `DEDUP_WINDOW_SECONDS` is set to a positive number.
+
+        The cache is kept in memory unless `DEDUP_SQLITE_PATH` is set, in which
+        case it is shared by all the processes using the same database file.
+        """
+        ttl = float(os.getenv("DEDUP_WINDOW_SECONDS", 0))
+        if ttl <= 0:
+            return None
+        max_entries = int(os.getenv("DEDUP_MAX_ENTRIES", 1_000_000))
+        sqlite_path = os.getenv("DEDUP_SQLITE_PATH")
+        if sqlite_path:
+            return SQLiteDedupCache(sqlite_path, ttl, max_entries)
+        return MemoryDedupCache(ttl, max_entries)
+
+    def new_keys(self, keys: list[str]) -> list[bool]:
+        """Check which keys were not delivered within the window.
+
+        A key repeated within `keys` is new only at its first position.
+
+        :param list[str] keys: The keys to check.
+        :return: True for the keys that should be sent.
+        :rtype: list[bool]
+        """
+        seen = self._lookup(keys)
+        mask = []
+        for key in keys:
+            if key in seen:
+                mask.append(False)
+            else:
+                mask.append(True)
+                seen.add(key)
+        new = sum(mask)
+        with self._lock:
+            self.misses += new
+            self.hits += len(keys) - new
+        DEDUP_LOOKUPS.inc(new, result="miss")
+        DEDUP_LOOKUPS.inc(len(keys) - new, result="hit")
+        return mask
+
+    @abstractmethod
+    def add(self, keys: Iterable[str]):
+        """Remember delivered keys."""
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    @abstractmethod
+    def _lookup(self, keys: list[str]) -> set[str]:
+        """Return the keys delivered within the window."""
+
+
+class MemoryDedupCache(DedupCache):
+    """In-process LRU cache with a TTL."""
+
+    def __init__(self, ttl: float, max_entries: int):
+        super().__init__(ttl, max_entries)
+        # key -> expiration time, oldest first
+        self._entries: OrderedDict[str, float] = OrderedDict()
+
+    def add(self, keys: Iterable[str]):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key in keys:
+                self._entries[key] = expires
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _lookup(self, keys: list[str]) -> set[str]:
+        now = time.monotonic()
+        with self._lock:
+            # the entries are ordered by their expiration
+            while self._entries:
+                key, expires = next(iter(self._entries.items()))
+                if expires > now:
+                    break
+                del self._entries[key]
+            return {key for key in keys if key in self._entries}
+
+
+class SQLiteDedupCache(DedupCache):
+    """Cache stored in a SQLite database shared by several processes."""
+
+    # expired entries are purged once per this many added keys
+    PURGE_EVERY = 10_000
+    blocking = True
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        super().__init__(ttl, max_entries)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS delivered "
+                "(key TEXT PRIMARY KEY, expires REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS delivered_expires ON delivered (expires)"
+            )
+        self._added = 0
+
+    def add(self, keys: Iterable[str]):
+        # wall clock, the entries are shared between processes
+        expires = time.time() + self.ttl
+        rows = [(key, expires) for key in keys]
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO delivered (key, expires) VALUES (?, ?)", rows
+            )
+            self._added += len(rows)
+            if self._added >= self.PURGE_EVERY:
+                self._added = 0
+                self._purge()
+
+    def close(self):
+        self._db.close()
+
+    def _lookup(self, keys: list[str]) -> set[str]:
+        now = time.time()
+        seen: set[str] = set()
+        with self._lock:
+            # stay below the SQLite limit of the query parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                seen.update(
+                    row[0]
+                    for row in self._db.execute(
+                        f"SELECT key FROM delivered "
+                        f"WHERE expires > ? AND key IN ({placeholders})",
+                        (now, *chunk),
+                    )
+                )
+        return seen
+
+    def _purge(self):
+        self._db.execute("DELETE FROM delivered WHERE expires <= ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM delivered WHERE key IN (SELECT key FROM delivered "
+            "ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
@@ -0,0 +1,368 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass, field
+from itertools import compress
+from typing import Iterator
+
+from data_connector import tracing
+from data_connector.dedup import dedup_key
+from data_connector.encoder import EncodedPayload, encode_bulk
+from data_connector.metrics import BULK_RECORDS
+from data_connector.record import Record, RecordBatch
+from data_connector.throttle import (
+    BULK_SHRINK_STATUS_CODES,
+    CONNECTION_FAILED,
+    RETRYABLE_STATUS_CODES,
+    TIMED_OUT,
+    AdaptiveBulkSize,
+    AdaptiveConcurrency,
+    RetryPolicy,
+)
+from data_connector.utils import (
+    split_batch,
+    store_rejected_records,
+    store_unsent_records,
+)
+
+# the decisions shared by `ShowAdsClient` and `AsyncShowAdsClient`; the
+# clients only send the requests, sleep and call the dedup cache
+
+# requests a bulk may take to find the records the upstream refuses, see
+# `BulkDelivery`; enough to single out about three of them in 1000 records
+MAX_SPLIT_REQUESTS = 64
+
+# what a client does after an attempt, see `next_step`
+DELIVERED = "delivered"
+REFRESH_TOKEN = "refresh_token"
+# the same payload would be refused again
+REFUSED = "refused"
+FAILED = "failed"
+
+
+def next_step(status: int, what: str, timeout: float | None) -> str:
+    """Log the response to an attempt, return what the client does next.
+
+    :param int status: Status code of the response, `TIMED_OUT` or
+        `CONNECTION_FAILED` if there was none.
+    :param str what: Description of the payload used in the logs.
+    :param (float | None) timeout: Timeout of the attempt, used in the logs.
+    :return: `DELIVERED`, `REFRESH_TOKEN` (retried right away with a new
+        token), `REFUSED` or `FAILED` (see `retry_delay`).
+    :rtype: str
+    """
+    if status == 200:
+        logging.info(f"Successfully sent {what}.")
+        return DELIVERED
+    if status == 401:
+        return REFRESH_TOKEN
+    if status == 400:
+        logging.error(f"Send {what} fail: Bad request.")
+        return REFUSED
+    if status == 413:
+        logging.error(f"Send {what} fail: Payload too large.")
+        return REFUSED
+
+    if status == TIMED_OUT:
+        logging.error(f"Send {what} fail: No response in {timeout}s.")
+    elif status == CONNECTION_FAILED:
+        logging.error(
+            f"Send {what} fail: Connection to the destination server failed."
+        )
+    elif status == 500:
+        logging.error(f"Send {what} fail: Destination server error.")
+    elif status == 429:
+        logging.error(f"Send {what} fail: Destination server is under heavy load.")
+    else:
+        logging.error(f"Send {what} fail: Return code {status}.")
+    return FAILED
+
+
+def retry_delay(
+    policy: RetryPolicy, status: int, attempt: int, retry_after: str | None
+) -> float:
+    """Delay (in seconds) before the attempt following a failed one.
+
+    :param RetryPolicy policy: The backoff.
+    :param int status: Status code of the failed attempt.
+    :param int attempt: Number of the failed attempt, starting from 0.
+    :param (str | None) retry_after: Value of the `Retry-After` header.
+    :return: The delay; 0 if the status is not worth waiting for or if it was
+        the last attempt.
+    :rtype: float
+    """
+    if status in RETRYABLE_STATUS_CODES and attempt + 1 < policy.attempts:
+        return policy.delay(attempt, retry_after)
+    return 0.0
+
+
+def update_limiter(limiter: AdaptiveConcurrency, status: int):
+    """Report the response to the limiter of the in-flight requests.
+
+    :param AdaptiveConcurrency limiter: The limiter, also an
+        `AsyncAdaptiveConcurrency`.
+    :param int status: Status code of the response, `TIMED_OUT` or
+        `CONNECTION_FAILED` if there was none.
+    """
+    if status == 429:
+        limiter.throttled()
+    elif 0 < status < 500:
+        limiter.succeeded()
+
+
+def status_label(status: int) -> str:
+    """Value of the `status` label of the latency metric."""
+    if status == TIMED_OUT:
+        return "timeout"
+    if status == CONNECTION_FAILED:
+        return "connection_error"
+    return str(status)
+
+
+def refusal_reason(detail: str) -> str:
+    """Reason stored with a record the upstream refused with 400."""
+    return f"Bad request: {detail}" if detail else "Bad request."
+
+
+def store_failed_record(rec: Record, status: int, detail: str):
+    """Store a single record that was not delivered, see `store_failed_records`.
+
+    :param Record rec: The record.
+    :param int status: Status code of the last attempt.
+    :param str detail: Body of a 400 response.
+    """
+    if status == 400:
+        # it would be refused again
+        store_rejected_records([rec], [refusal_reason(detail)])
+    else:
+        # app was unable to forward data to ShowAds API
+        # thus we store it in CSV file (for convenience)
+        # and try it later
+        store_unsent_records([rec])
+
+
+@dataclass
+class BulkResult:
+    """Result of every record of a bulk, see `ShowAdsClient.deliver_bulk`.
+
+    Records neither delivered nor rejected could not be sent, e.g. because
+    the upstream was down, and can be sent again later.
+    """
+
+    delivered: list[bool]
+    # records the upstream refused on their own: position -> reason
+    rejected: dict[int, str] = field(default_factory=dict)
+
+    @property
+    def sent(self) -> int:
+        return sum(self.delivered)
+
+    def unsent(self) -> list[bool]:
+        """Mask of the records that can be sent again."""
+        return [
+            not ok and i not in self.rejected for i, ok in enumerate(self.delivered)
+        ]
+
+    def extend(self, other: BulkResult):
+        """Append the result of the following records."""
+        offset = len(self.delivered)
+        self.delivered += other.delivered
+        self.rejected.update({offset + i: r for i, r in other.rejected.items()})
+
+    def expand(self, mask: list[bool]) -> BulkResult:
+        """Result of the whole bulk if this one is of the records in `mask`.
+
+        The records outside the mask count as delivered.
+        """
+        positions = [i for i, selected in enumerate(mask) if selected]
+        delivered = [True] * len(mask)
+        for i, ok in zip(positions, self.delivered):
+            delivered[i] = ok
+        return BulkResult(
+            delivered, {positions[i]: r for i, r in self.rejected.items()}
+        )
+
+
+def store_failed_records(records: RecordBatch, result: BulkResult):
+    """Store the records of a bulk that were not delivered.
+
+    :param RecordBatch records: The records of the bulk.
+    :param BulkResult result: Their result; the records that can be sent
+        again are stored for a later resend, the refused ones with the reason.
+    """
+    # app was unable to forward data to ShowAds API
+    # thus we store it in CSV file (for convenience)
+    # and try it later
+    unsent = result.unsent()
+    if any(unsent):
+        store_unsent_records(records.select(unsent))
+    if result.rejected:
+        store_rejected_records(
+            records.select(i in result.rejected for i in range(len(records))),
+            [result.rejected[i] for i in sorted(result.rejected)],
+        )
+
+
+class BulkDelivery:
+    """Splits a bulk into parts and decides what to do with their responses.
+
+    The client sends the payload of every part returned by `next_payload`
+    and reports the response to `finish_part`, until there is no part left.
+    A part the upstream refuses is split in halves which are sent again: on
+    413 because it is too large, on 400 to find the records the upstream
+    refuses, in O(log n) requests per such record.
+
+    The halves of a bulk take at most `max_requests` requests; the records
+    not sent by then count as unsent. If no record of a part is delivered,
+    the refused ones count as unsent too: an upstream refusing everything is
+    broken, the records are stored to be sent again.
+
+    :param int bulk_id: ID of the bulk used in the logs.
+    :param RecordBatch records: The records of the bulk.
+    :param AdaptiveBulkSize sizer: Size of the parts, adapted to the responses.
+    :param bool compress: Compress the payloads with gzip.
+    :param bool dedup: Compute the dedup keys of the records, see
+        `skip_duplicates`.
+    :param int max_requests: Number of requests for the halves of the refused
+        parts.
+    """
+
+    def __init__(
+        self,
+        bulk_id: int,
+        records: RecordBatch,
+        sizer: AdaptiveBulkSize,
+        compress: bool = False,
+        dedup: bool = False,
+        max_requests: int = MAX_SPLIT_REQUESTS,
+    ):
+        BULK_RECORDS.observe(len(records))
+        self.bulk_id = bulk_id
+        self.records = records
+        self.sizer = sizer
+        self.compress = compress
+        self.max_requests = max_requests
+        self.keys = (
+            list(map(dedup_key, records.cookies, records.banner_ids)) if dedup else []
+        )
+        self.result = BulkResult([])
+        self._mask: list[bool] = []
+        self._parts: Iterator[RecordBatch] | None = None
+        # parts of the refused ones waiting to be sent, the next one last
+        self._halves: list[tuple[RecordBatch, bool]] = []
+        self._current: tuple[RecordBatch, bool] | None = None
+        self._split_requests = 0
+        self._gave_up = False
+        # position of the first record of the part being sent in the result
+        self._part_start = 0
+
+    def skip_duplicates(self, mask: list[bool]):
+        """Leave out the records delivered before, see `DedupCache.new_keys`.
+
+        :param list[bool] mask: False for the records not to send.
+        """
+        skipped = len(mask) - sum(mask)
+        if not skipped:
+            return
+        logging.info(f"Send bulk {self.bulk_id}: {skipped} duplicates skipped.")
+        self._mask = mask
+        self.records = self.records.select(mask)
+        self.keys = list(compress(self.keys, mask))
+
+    def next_payload(self) -> EncodedPayload | None:
+        """Encode the next part to send; None once every record is finished."""
+        if self._parts is None:
+            self._parts = split_batch(
+                self.records, self.sizer.size, self.sizer.max_bytes
+            )
+        while self._halves:
+            part, adapt = self._halves.pop()
+            if self._split_requests < self.max_requests:
+                self._split_requests += 1
+                self._current = (part, adapt)
+                break
+            self._finish_unsent(part)
+        else:
+            part = next(self._parts, None)
+            if part is None:
+                return None
+            # the parts of the bulk adapt the bulk size
+            self._current = (part, True)
+            self._part_start = len(self.result.delivered)
+        # serialized once, the same bytes are sent by every retry
+        with tracing.span("encode", records=len(part)) as span:
+            payload = encode_bulk(part, self.compress)
+            span.set(bytes=len(payload.body))
+        return payload
+
+    def finish_part(self, status: int, detail: str, seconds: float):
+        """Record the response to the payload of the last part.
+
+        :param int status: Status code of the last attempt, see `next_step`.
+        :param str detail: Body of a 400 response.
+        :param float seconds: Time it took to send the part.
+        """
+        assert self._current is not None
+        part, adapt = self._current
+        self._current = None
+        if status == 200:
+            if adapt:
+                self.sizer.succeeded(seconds)
+            self._extend(BulkResult([True] * len(part)))
+            return
+        if adapt and status in BULK_SHRINK_STATUS_CODES:
+            self.sizer.shrink(len(part))
+        if status in (400, 413) and len(part) > 1:
+            if self._split_requests >= self.max_requests:
+                self._finish_unsent(part)
+                return
+            half = len(part) // 2
+            # the halves of a part refused with 400 do not adapt the size,
+            # one refused record cuts it once
+            adapt = adapt and status == 413
+            self._halves.append((part.slice(half, len(part)), adapt))
+            self._halves.append((part.slice(0, half), adapt))
+            return
+        if status == 400:
+            reason = refusal_reason(detail)
+            logging.error(
+                f"Send bulk {self.bulk_id}: record {part.cookies[0]} refused. "
+                f"{reason}"
+            )
+            self._extend(BulkResult([False], {0: reason}))
+            return
+        self._extend(BulkResult([False] * len(part)))
+
+    def _finish_unsent(self, part: RecordBatch):
+        """Give up a half of a refused part, store it to be sent again."""
+        if not self._gave_up:
+            self._gave_up = True
+            logging.warning(
+                f"Send bulk {self.bulk_id}: refused records not singled out "
+                f"in {self.max_requests} requests, the rest is stored for a resend."
+            )
+        self._extend(BulkResult([False] * len(part)))
+
+    def _extend(self, result: BulkResult):
+        self.result.extend(result)
+        if self._halves:
+            return
+        # every record of the part is finished
+        start = self._part_start
+        rejected = [i for i in self.result.rejected if i >= start]
+        if len(rejected) > 1 and not any(self.result.delivered[start:]):
+            logging.error(
+                f"Send bulk {self.bulk_id}: no record of a part delivered, "
+                f"the {len(rejected)} refused ones are stored for a resend."
+            )
+            for i in rejected:
+                del self.result.rejected[i]
+
+    def delivered_keys(self) -> list[str]:
+        """Dedup keys of the delivered records."""
+        return list(compress(self.keys, self.result.delivered))
+
+    def bulk_result(self) -> BulkResult:
+        """Result of every record of the bulk, the skipped duplicates included."""
+        # the positions of the records skipped by the dedup cache are restored
+        return self.result.expand(self._mask) if self._mask else self.result
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import gzip
+import json
+from dataclasses import dataclass, field
+from json.encoder import encode_basestring_ascii
+
+from data_connector.record import Record, RecordBatch
+
+try:
+    import orjson
+except ImportError:  # optional dependency, the stdlib encoder is used instead
+    orjson = None
+
+# name of the JSON library used to encode the payloads
+JSON_BACKEND = "orjson" if orjson else "json"
+
+# bytes of `{"Data":[]}` around the records of a bulk body
+BULK_ENVELOPE_BYTES = 11
+# bytes of a bulk item without its values, the separator included
+_ITEM_BYTES = len('{"VisitorCookie":,"BannerId":},')
+
+
+@dataclass
+class EncodedPayload:
+    """Request body serialized once and reused by every retry."""
+
+    body: bytes
+    headers: dict[str, str] = field(
+        default_factory=lambda: {"Content-Type": "application/json"}
+    )
+
+
+def _finish(body: bytes, compress: bool) -> EncodedPayload:
+    payload = EncodedPayload(body)
+    if compress:
+        # level 1 compresses the repetitive JSON well at a fraction of the cost
+        payload.body = gzip.compress(body, compresslevel=1)
+        payload.headers["Content-Encoding"] = "gzip"
+    return payload
+
+
+def encode_bulk(batch: RecordBatch, compress: bool = False) -> EncodedPayload:
+    """Serialize a bulk of records to the ShowAds API's bulk format.
+
+    `orjson` is used when it is installed, otherwise the body is written by
+    `RecordBatch.to_json`.
+
+    :param RecordBatch batch: The records to serialize.
+    :param bool compress: Compress the body with gzip.
+    :return: The encoded request body and its headers.
+    :rtype: EncodedPayload
+    """
+    if orjson is not None:
+        body = orjson.dumps(
+            {
+                "Data": [
+                    {"VisitorCookie": cookie, "BannerId": banner_id}
+                    for cookie, banner_id in zip(batch.cookies, batch.banner_ids)
+                ]
+            }
+        )
+    else:
+        body = batch.to_json()
+    return _finish(body, compress)
+
+
+def record_bytes(cookie: str, banner_id: int) -> int:
+    """Upper bound of the bytes a record takes in an uncompressed bulk body.
+
+    The cookie is measured ASCII-escaped, which is never shorter than the
+    UTF-8 output of `orjson`.
+
+    :param str cookie: Cookie of the record.
+    :param int banner_id: Banner ID of the record.
+    :return: The number of bytes.
+    :rtype: int
+    """
+    return len(encode_basestring_ascii(cookie)) + len(str(banner_id)) + _ITEM_BYTES
+
+
+def encode_record(rec: Record, compress: bool = False) -> EncodedPayload:
+    """Serialize a single record to the ShowAds API's format.
+
+    :param Record rec: The record to serialize.
+    :param bool compress: Compress the body with gzip.
+    :return: The encoded request body and its headers.
+    :rtype: EncodedPayload
+    """
+    if orjson is not None:
+        body = orjson.dumps(rec.transform_data())
+    else:
+        body = json.dumps(rec.transform_data(), separators=(",", ":")).encode()
+    return _finish(body, compress)
@@ -0,0 +1,329 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Any, Iterable, Iterator
+
+from data_connector import tracing
+from data_connector.checkpoint import Checkpoint, send_file_checkpointed
+from data_connector.metrics import QUEUE_DEPTH
+from data_connector.record import Record, ValidationPolicy
+from data_connector.show_ads_api_wrapper import send_data
+from data_connector.utils import CSV_READER, Reader
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, the jobs are not resumed
+    fcntl = None
+
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+@dataclass
+class Job:
+    """Bulk upload processed in the background."""
+
+    id: str
+    policy: ValidationPolicy
+    reader: Reader = CSV_READER
+    status: str = "queued"
+    accepted: int = 0
+    sent: int = 0
+    spilled: int = 0
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    error: str | None = None
+    # locked while the job is processed by this process, see `JobManager`
+    claim: IO[str] | None = field(default=None, repr=False)
+
+    @property
+    def rejected(self) -> int:
+        return sum(self.policy.rejections.values())
+
+    @property
+    def parsed(self) -> int:
+        return self.accepted + self.rejected
+
+    def count_accepted(self, records: Iterable[Record]) -> Iterator[Record]:
+        """Pass the records through, counting them."""
+        for rec in records:
+            self.accepted += 1
+            yield rec
+
+    def on_bulk(self, size: int, sent: int):
+        """Update the counters once a bulk is finished, see `send_data`."""
+        self.sent += sent
+        # records that were not sent are stored by the sender
+        self.spilled += size - sent
+
+    def to_dict(self) -> dict[str, Any]:
+        """Status of the job in a JSON serializable form."""
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "parsed": self.parsed,
+            "rejected": self.rejected,
+            "sent": self.sent,
+            "spilled": self.spilled,
+            "rejections": self.policy.report(),
+            "elapsed": round(elapsed, 3),
+            "rows_per_second": round(self.parsed / elapsed, 1) if elapsed else 0.0,
+            "sent_per_second": round(self.sent / elapsed, 1) if elapsed else 0.0,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """Spools uploaded files to disk and processes them with a worker pool.
+
+    The status of every job is also written next to the spooled files after
+    each bulk, so it can be read by any process sharing the spool directory
+    (e.g. the other gunicorn workers). CSV jobs also keep a checkpoint of
+    their progress, a job interrupted by a crash or a restart is resumed by
+    `resume_interrupted`. A process holds a lock on each of its unfinished
+    jobs, so no job is resumed while it is still processed.
+
+    :param int workers: Number of jobs processed at once.
+    :param (Path | None) spool_dir: Directory of the spooled files.
+    :param int history: Number of finished jobs kept in memory.
+    """
+
+    def __init__(
+        self, workers: int, spool_dir: Path | None = None, history: int = 1000
+    ):
+        self.spool_dir = Path(spool_dir or tempfile.gettempdir())
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.history = history
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="bulk_job"
+        )
+        QUEUE_DEPTH.set_function(self.queued, queue="bulk_jobs")
+
+    @classmethod
+    def from_env(cls) -> JobManager | None:
+        """Create a manager if `BULK_JOB_WORKERS` is set to a positive number."""
+        workers = int(os.getenv("BULK_JOB_WORKERS", 0))
+        if workers <= 0:
+            return None
+        return cls(
+            workers,
+            os.getenv("BULK_JOB_SPOOL_DIRPATH"),
+            int(os.getenv("BULK_JOB_HISTORY", 1000)),
+        )
+
+    def submit(
+        self, stream: IO[bytes], policy: ValidationPolicy, reader: Reader = CSV_READER
+    ) -> Job:
+        """Spool the uploaded file and queue it for processing.
+
+        :param IO[bytes] stream: The uploaded file.
+        :param ValidationPolicy policy: Validation rules of the records.
+        :param Reader reader: Parser of the file format (default: CSV).
+        :return: The queued job.
+        :rtype: Job
+        """
+        job = Job(uuid.uuid4().hex, policy, reader)
+        job.claim = self._claim(job.id)
+        with open(self._spool_path(job.id), "wb") as f:
+            shutil.copyfileobj(stream, f)
+        if reader is CSV_READER:
+            Checkpoint.start(self._spool_path(job.id), policy).save(
+                self._checkpoint_path(job.id)
+            )
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict()
+        self._save_status(job)
+        self._executor.submit(self._run, job)
+        return job
+
+    def resume_interrupted(self) -> list[Job]:
+        """Queue the unfinished jobs no running process holds, e.g. after a crash.
+
+        CSV jobs continue from their checkpoint; the jobs of other formats
+        cannot be resumed and are marked as failed. Without file locks (on
+        Windows) no job is resumed, a job still processed by another process
+        would be sent twice.
+
+        :return: The queued jobs.
+        :rtype: list[Job]
+        """
+        if fcntl is None:
+            logging.warning(
+                "Interrupted bulk jobs are not resumed, file locks are not available."
+            )
+            return []
+        resumed = []
+        for status_path in sorted(self.spool_dir.glob("job_*.json")):
+            job_id = status_path.stem[len("job_") :]
+            if not JOB_ID_PATTERN.fullmatch(job_id) or job_id in self._jobs:
+                continue
+            claim = self._claim(job_id)
+            if claim is None:
+                # processed by another process
+                continue
+            try:
+                # read after the lock is taken, the job may have just finished
+                with open(status_path) as f:
+                    status = json.load(f)
+            except (OSError, ValueError):
+                status = {}
+            if status.get("status") not in {"queued", "running"}:
+                self._release(job_id, claim)
+                continue
+
+            try:
+                checkpoint = Checkpoint.load(self._checkpoint_path(job_id))
+                policy = checkpoint.validation_policy() if checkpoint else None
+            except Exception:
+                # a corrupt checkpoint fails its job, not the worker resuming them
+                logging.exception(f"Bulk job {job_id}: checkpoint not readable.")
+                checkpoint = policy = None
+            if policy is None or not self._spool_path(job_id).exists():
+                job = Job(job_id, ValidationPolicy(), status="failed")
+                job.error = "Interrupted, the file has to be uploaded again."
+                job.finished_at = time.time()
+                self._save_status(job)
+                self._release(job_id, claim)
+                continue
+            job = Job(
+                job_id,
+                policy,
+                CSV_READER,
+                accepted=checkpoint.accepted,
+                sent=checkpoint.sent,
+                spilled=checkpoint.accepted - checkpoint.sent,
+                claim=claim,
+            )
+            logging.info(f"Bulk job {job_id}: resumed after an interruption.")
+            with self._lock:
+                self._jobs[job.id] = job
+            self._save_status(job)
+            self._executor.submit(self._run, job)
+            resumed.append(job)
+        return resumed
+
+    def queued(self) -> int:
+        """Number of jobs waiting for a worker."""
+        return sum(job.status == "queued" for job in list(self._jobs.values()))
+
+    def get(self, job_id: str) -> dict[str, Any] | None:
+        """Return the status of a job; None if the job is not known."""
+        if not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        # the job may be processed by another process
+        try:
+            with open(self._status_path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting jobs; wait for the queued ones to finish."""
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, job: Job):
+        # the job ID is the request ID of the logs, the spans and the profile
+        with tracing.request("bulk job", job.id), tracing.profiled("job"):
+            self._process(job)
+
+    def _process(self, job: Job):
+        job.status = "running"
+        job.started_at = time.time()
+        self._save_status(job)
+
+        def on_bulk(size: int, sent: int):
+            job.on_bulk(size, sent)
+            self._save_status(job)
+
+        def on_checkpointed_bulk(size: int, sent: int):
+            # the records are counted per bulk, the checkpoint holds the counts
+            job.accepted += size
+            on_bulk(size, sent)
+
+        path = self._spool_path(job.id)
+        try:
+            if job.reader is CSV_READER:
+                send_file_checkpointed(
+                    path,
+                    job.policy,
+                    self._checkpoint_path(job.id),
+                    resume=True,
+                    on_bulk=on_checkpointed_bulk,
+                )
+            else:
+                with open(path, "rb") as f:
+                    records = job.reader.parse(f, job.policy)
+                    send_data(job.count_accepted(records), on_bulk=on_bulk)
+            job.status = "done"
+            logging.info(f"Bulk job {job.id}: {job.policy.summary()}.")
+        except Exception as e:
+            logging.exception(f"Bulk job {job.id} fail.")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            self._save_status(job)
+            path.unlink(missing_ok=True)
+            self._checkpoint_path(job.id).unlink(missing_ok=True)
+            self._release(job.id, job.claim)
+            job.claim = None
+
+    def _evict(self):
+        finished = [j for j in self._jobs.values() if j.finished_at is not None]
+        for job in finished[: max(len(finished) - self.history, 0)]:
+            del self._jobs[job.id]
+            self._status_path(job.id).unlink(missing_ok=True)
+
+    def _spool_path(self, job_id: str) -> Path:
+        return self.spool_dir / f"job_{job_id}.csv"
+
+    def _checkpoint_path(self, job_id: str) -> Path:
+        return self.spool_dir / f"job_{job_id}.checkpoint.json"
+
+    def _claim(self, job_id: str) -> IO[str] | None:
+        """Lock the job for this process; None if another process holds it.
+
+        The lock is released by the system if the process dies.
+        """
+        claim = open(self.spool_dir / f"job_{job_id}.lock", "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(claim, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                claim.close()
+                return None
+        return claim
+
+    def _release(self, job_id: str, claim: IO[str] | None):
+        if claim is not None:
+            (self.spool_dir / f"job_{job_id}.lock").unlink(missing_ok=True)
+            claim.close()
+
+    def _status_path(self, job_id: str) -> Path:
+        return self.spool_dir / f"job_{job_id}.json"
+
+    def _save_status(self, job: Job):
+        # atomic replace, readers never see a half-written file
+        tmp = self.spool_dir / f".job_{job.id}.json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp, self._status_path(job.id))
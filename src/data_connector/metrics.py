@@ -0,0 +1,391 @@
+from __future__ import annotations
+
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter as TallyCounter
+from pathlib import Path
+from typing import Any, Callable
+
+# upper bounds of the latency histogram buckets (in seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# upper bounds of the bulk size histogram buckets (in records)
+BULK_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 750, 1000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric:
+    """Base of the metrics, a value per combination of the label values.
+
+    The metrics are meant to be updated once per batch or request, never
+    once per row; every update takes the lock of the metric.
+
+    :param str name: Name of the metric.
+    :param str documentation: Help text of the metric.
+    :param tuple[str, ...] labels: Names of the labels.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: dict[tuple[str, ...], Any] = {}
+        self._functions: dict[tuple[str, ...], Callable[[], float]] = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def set_function(self, function: Callable[[], float], **labels: str):
+        """Read the value from `function` whenever the metric is exported."""
+        with self._lock:
+            self._functions[self._key(labels)] = function
+
+    def values(self) -> list[tuple[tuple[str, ...], Any]]:
+        """Current values of the metric, with their label values."""
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            values[key] = function()
+        return sorted(values.items())
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labels)
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        if not amount:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down, e.g. the depth of a queue."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets.
+
+    :param tuple[float, ...] buckets: Upper bounds of the buckets, ascending.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # counts of the buckets and of the +Inf bucket, sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][i] += 1
+            state[1] += value
+
+
+class Registry:
+    """All the metrics of the process."""
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        self.metrics[metric.name] = metric
+
+    def snapshot(self) -> dict[str, Any]:
+        """Values of all the metrics in a JSON serializable form."""
+        pid, token, started = _identity()
+        return {
+            "pid": pid,
+            "token": token,
+            "started": started,
+            "metrics": {
+                name: [[list(key), value] for key, value in metric.values()]
+                for name, metric in self.metrics.items()
+            },
+        }
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def render(self, snapshots: list[dict[str, Any]]) -> str:
+        """Merge the snapshots of the processes into the Prometheus text format.
+
+        Counters and histograms are summed over all the snapshots, also of the
+        processes that are gone; gauges only over the snapshots of the
+        processes that are still running. A PID can be reused, of the
+        snapshots with the same PID only the last started one can be running.
+        """
+        started: dict[int, float] = {}
+        for snapshot in snapshots:
+            pid = snapshot["pid"]
+            started[pid] = max(started.get(pid, 0.0), snapshot.get("started", 0.0))
+        running = [
+            snapshot
+            for snapshot in snapshots
+            if snapshot.get("started", 0.0) == started[snapshot["pid"]]
+            and _is_running(snapshot["pid"])
+        ]
+
+        lines = []
+        for name, metric in self.metrics.items():
+            merged: dict[tuple[str, ...], Any] = {}
+            for snapshot in running if metric.kind == "gauge" else snapshots:
+                for key, value in snapshot["metrics"].get(name, []):
+                    key = tuple(key)
+                    if metric.kind == "histogram":
+                        state = merged.setdefault(
+                            key, [[0] * (len(metric.buckets) + 1), 0.0]
+                        )
+                        state[0] = [a + b for a, b in zip(state[0], value[0])]
+                        state[1] += value[1]
+                    else:
+                        merged[key] = merged.get(key, 0.0) + value
+
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(merged.items()):
+                labels = dict(zip(metric.labels, key))
+                if metric.kind != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip((*metric.buckets, "+Inf"), counts):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else _number(bound)
+                    lines.append(
+                        f"{name}_bucket{_labels({**labels, 'le': le})} {cumulative}"
+                    )
+                lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _number(value: float) -> str:
+    return repr(float(value))
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_process: tuple[int, str, float] | None = None
+
+
+def _identity() -> tuple[int, str, float]:
+    """PID, random token and start time of this process.
+
+    Set again in a forked process, which gets a PID of its own.
+    """
+    global _process
+    if _process is None or _process[0] != os.getpid():
+        _process = (os.getpid(), uuid.uuid4().hex, time.time())
+    return _process
+
+
+REGISTRY = Registry()
+
+ROWS_PARSED = Counter(
+    "data_connector_rows_parsed_total", "Rows read from the uploaded files."
+)
+ROWS_REJECTED = Counter(
+    "data_connector_rows_rejected_total",
+    "Rows rejected by the validation, by the failed rule.",
+    ("rule",),
+)
+BULK_RECORDS = Histogram(
+    "data_connector_bulk_size",
+    "Number of records in the bulks sent to the ShowAds API.",
+    buckets=BULK_SIZE_BUCKETS,
+)
+UPSTREAM_LATENCY = Histogram(
+    "data_connector_upstream_request_duration_seconds",
+    "Duration of the requests to the ShowAds API.",
+    ("endpoint", "status"),
+)
+UPSTREAM_RETRIES = Counter(
+    "data_connector_upstream_retries_total",
+    "Requests to the ShowAds API sent again after a failed attempt.",
+    ("endpoint",),
+)
+TOKEN_REFRESHES = Counter(
+    "data_connector_token_refreshes_total",
+    "Access token refreshes, by their result.",
+    ("result",),
+)
+SPILLED_RECORDS = Counter(
+    "data_connector_spilled_records_total",
+    "Records stored for a later resend.",
+)
+REJECTED_RECORDS = Counter(
+    "data_connector_rejected_records_total",
+    "Records the ShowAds API refused, stored with the reason.",
+)
+DEDUP_LOOKUPS = Counter(
+    "data_connector_dedup_lookups_total",
+    "Records looked up in the dedup cache, by the result.",
+    ("result",),
+)
+QUEUE_DEPTH = Gauge(
+    "data_connector_queue_depth",
+    "Number of items waiting in the in-process queues.",
+    ("queue",),
+)
+
+
+class ParseTally:
+    """Counts the parsed and rejected rows of a file, flushes them in batches.
+
+    The parsers count the rejections in the `rejections` counter of their
+    policy; the tally adds the new ones to the metrics once per `every` rows,
+    so the metric locks are not taken for every row.
+
+    :param TallyCounter rejections: The rejection counter of the policy.
+    :param int every: Number of rows between two flushes.
+    """
+
+    def __init__(self, rejections: TallyCounter, every: int = 1000):
+        self.rejections = rejections
+        self.every = every
+        self.pending = 0
+        self._reported: TallyCounter = TallyCounter(rejections)
+
+    def add(self, rows: int = 1):
+        self.pending += rows
+        if self.pending >= self.every:
+            self.flush()
+
+    def flush(self):
+        ROWS_PARSED.inc(self.pending)
+        self.pending = 0
+        for rule, count in (self.rejections - self._reported).items():
+            ROWS_REJECTED.inc(count, rule=rule)
+        self._reported = TallyCounter(self.rejections)
+
+
+def metrics_dirpath() -> Path | None:
+    """Directory shared by the processes, `METRICS_DIRPATH` environment variable."""
+    dirpath = os.getenv("METRICS_DIRPATH")
+    return Path(dirpath) if dirpath else None
+
+
+def write_snapshot(dirpath: Path):
+    """Store the snapshot of this process as `metrics_{pid}_{token}.json`.
+
+    The token is random, a process that gets the PID of a process that is
+    gone writes a file of its own, and the counters of the old one are kept.
+    """
+    dirpath.mkdir(parents=True, exist_ok=True)
+    snapshot = REGISTRY.snapshot()
+    name = f"metrics_{snapshot['pid']}_{snapshot['token']}.json"
+    tmp = dirpath / f".{name}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot, f)
+    # atomic replace, readers never see a half-written file
+    os.replace(tmp, dirpath / name)
+
+
+def export() -> str:
+    """Metrics in the Prometheus text format.
+
+    If `METRICS_DIRPATH` is set, the metrics of all the processes sharing the
+    directory are merged, otherwise only the metrics of this process are
+    exported.
+    """
+    dirpath = metrics_dirpath()
+    if dirpath is None:
+        return REGISTRY.render([REGISTRY.snapshot()])
+    write_snapshot(dirpath)
+    snapshots = []
+    for path in sorted(dirpath.glob("metrics_*.json")):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            # removed in the meantime
+            continue
+    return REGISTRY.render(snapshots)
+
+
+_snapshot_thread: threading.Thread | None = None
+
+
+def start_snapshot_thread(dirpath: Path, interval: float):
+    """Write the snapshot of this process every `interval` seconds and at exit.
+
+    A process forked from this one starts with empty metrics and its own
+    thread, so the values of the parent are not counted twice.
+    """
+    if _snapshot_thread is not None:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            write_snapshot(dirpath)
+
+    def start():
+        global _snapshot_thread
+        _snapshot_thread = threading.Thread(
+            target=run, name="metrics_snapshot", daemon=True
+        )
+        _snapshot_thread.start()
+
+    def after_fork():
+        REGISTRY.reset()
+        start()
+
+    start()
+    atexit.register(lambda: write_snapshot(dirpath))
+    os.register_at_fork(after_in_child=after_fork)
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+from typing import BinaryIO, Iterator
+
+from werkzeug.sansio.multipart import (
+    Data,
+    Epilogue,
+    Event,
+    Field,
+    File,
+    MultipartDecoder,
+    NeedData,
+)
+
+# number of bytes read from the request body at once
+CHUNK_SIZE = 64 * 1024
+
+
+class MalformedBody(ValueError):
+    """The request body is not valid `multipart/form-data`, e.g. it is truncated."""
+
+
+class MultipartUpload:
+    """Streaming reader of a `multipart/form-data` request body.
+
+    The body is read from the stream only as fast as the file part is
+    consumed, neither the body nor the file is ever held in memory as a
+    whole. Once `open_file` returns, the form fields sent before the file
+    part are in `fields`, the name and the content type of the file in
+    `filename` and `content_type`, and the file data are read with `read`
+    or by lines, the same way as from a file opened in binary mode.
+
+    :param BinaryIO stream: The request body.
+    :param bytes boundary: Boundary of the parts.
+    :param int chunk_size: Number of bytes read from the body at once.
+    """
+
+    def __init__(self, stream: BinaryIO, boundary: bytes, chunk_size: int = CHUNK_SIZE):
+        self.fields: dict[str, str] = {}
+        self.filename: str | None = None
+        # content type of the file part, if it was sent
+        self.content_type: str | None = None
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._decoder = MultipartDecoder(boundary)
+        self._events = self._read_events()
+        self._in_file = False
+        self._pending = b""
+
+    def open_file(self) -> bool:
+        """Read the body up to the data of the first file part.
+
+        :return: False if the body has no file part.
+        :rtype: bool
+        :raises MalformedBody: The body is malformed.
+        """
+        self.fields.update(self._read_fields(stop_at_file=True))
+        return self._in_file
+
+    def read(self, size: int = -1) -> bytes:
+        """Read at most `size` bytes of the file data.
+
+        :param int size: Maximum number of bytes; a negative value reads the
+            rest of the file.
+        :return: The data; empty at the end of the file part.
+        :rtype: bytes
+        :raises MalformedBody: The body is malformed.
+        """
+        if size < 0:
+            chunks = [self._pending]
+            while data := self._next_file_data():
+                chunks.append(data)
+            self._pending = b""
+            return b"".join(chunks)
+        if not self._pending:
+            self._pending = self._next_file_data()
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Iterate over the lines of the file data, like a binary file.
+
+        :raises MalformedBody: The body is malformed.
+        """
+        buffer = b""
+        while chunk := self.read(self._chunk_size):
+            buffer += chunk
+            start = 0
+            while (end := buffer.find(b"\n", start)) >= 0:
+                yield buffer[start : end + 1]
+                start = end + 1
+            buffer = buffer[start:]
+        if buffer:
+            yield buffer
+
+    def close(self) -> dict[str, str]:
+        """Read the rest of the body, skipping the unread file data.
+
+        :return: The form fields sent after the file part.
+        :rtype: dict[str, str]
+        :raises MalformedBody: The body is malformed.
+        """
+        while self._next_file_data():
+            pass
+        self._pending = b""
+        return self._read_fields(stop_at_file=False)
+
+    def _read_events(self) -> Iterator[Event]:
+        while True:
+            try:
+                event = self._decoder.next_event()
+                if isinstance(event, NeedData):
+                    data = self._stream.read(self._chunk_size)
+                    self._decoder.receive_data(data or None)
+                    continue
+            except ValueError as e:
+                # e.g. the body ends before the closing boundary
+                raise MalformedBody(str(e)) from e
+            if isinstance(event, Epilogue):
+                return
+            yield event
+
+    def _read_fields(self, stop_at_file: bool) -> dict[str, str]:
+        fields: dict[str, str] = {}
+        name: str | None = None
+        value = bytearray()
+        for event in self._events:
+            if isinstance(event, File):
+                if stop_at_file:
+                    self.filename = event.filename
+                    self.content_type = event.headers.get("Content-Type")
+                    self._in_file = True
+                    return fields
+                # data of the further files are skipped
+                name = None
+            elif isinstance(event, Field):
+                name = event.name
+                value = bytearray()
+            elif isinstance(event, Data) and name is not None:
+                value += event.data
+                if not event.more_data:
+                    try:
+                        fields[name] = value.decode()
+                    except UnicodeDecodeError as e:
+                        raise MalformedBody(f"Field {name} is not UTF-8.") from e
+                    name = None
+        return fields
+
+    def _next_file_data(self) -> bytes:
+        while self._in_file:
+            event = next(self._events, None)
+            if not isinstance(event, Data) or not event.more_data:
+                self._in_file = False
+            if isinstance(event, Data) and event.data:
+                return event.data
+        return b""
@@ -1,15 +1,181 @@
 from __future__ import annotations
-import logging
 import os
 import re
-from dataclasses import dataclass
-from typing import Any
+from collections import Counter
+from json.encoder import encode_basestring_ascii
+from dataclasses import dataclass, field
+from itertools import compress
+from typing import Any, Iterable, Iterator
+
+NAME_PATTERN = re.compile(r"[a-zA-Z ]*")
+
+# rejection messages of the validation rules
+REJECT_MESSAGES = {
+    "format": "Malformed row.",
+    "name": "An invalid name.",
+    "name_length": "Name too long.",
+    "age": "Ignored due to age.",
+    "banner_id": "Banner ID out of range.",
+    # the record passed the validation, the ShowAds API refused it
+    "upstream": "Refused by the ShowAds API.",
+}
+
+
+@dataclass
+class ValidationPolicy:
+    """Validation rules of the customer records.
+
+    The policy is resolved once per request (or CLI run) and then applied to
+    every record, so no configuration is read on the per-row path. Each
+    rejected record is counted under the rule it failed and the first
+    `max_examples` of them are kept for the rejection report; nothing is
+    logged per row.
+    """
+
+    min_age: int = 18
+    # no upper limit if not set
+    max_age: int | None = None
+    min_banner_id: int = 0
+    max_banner_id: int = 99
+    # no length limit if not set
+    max_name_length: int | None = None
+    name_pattern: re.Pattern = NAME_PATTERN
+    # number of rejected records per rule
+    rejections: Counter = field(default_factory=Counter)
+    max_examples: int = 10
+    # the first rejected records, see `reject`
+    examples: list[dict[str, Any]] = field(default_factory=list)
+
+    @classmethod
+    def from_args(
+        cls, min_age: int | None = None, max_age: int | None = None
+    ) -> ValidationPolicy:
+        """Build the policy from the request arguments and the environment.
+
+        The age filters are used in this order: function parameter, environment variable.
+        default values (for minimum it's 18, and for maximum is not limited).
+
+        :param (int | None) min_age: Minimal age filter. If not set, the default
+            value is taken from `MIN_AGE_FILTER` environment variable.
+        :param (int | None) max_age: Maximal age filter. If not set, the default
+            value is taken form `MAX_AGE_FILTER` environment variable.
+        :return: The resolved policy. The banner ID range, the name length
+            limit and the number of examples in the rejection report are taken
+            from `MIN_BANNER_ID`, `MAX_BANNER_ID`, `MAX_NAME_LENGTH` and
+            `REJECTION_EXAMPLES` environment variables.
+        :rtype: ValidationPolicy
+        """
+        if not min_age:
+            min_age = int(os.getenv("MIN_AGE_FILTER", 18))
+        if not max_age and os.getenv("MAX_AGE_FILTER"):
+            max_age = int(os.getenv("MAX_AGE_FILTER"))
+        max_name_length = os.getenv("MAX_NAME_LENGTH")
+        return cls(
+            min_age=min_age,
+            max_age=max_age or None,
+            min_banner_id=int(os.getenv("MIN_BANNER_ID", 0)),
+            max_banner_id=int(os.getenv("MAX_BANNER_ID", 99)),
+            max_name_length=int(max_name_length) if max_name_length else None,
+            max_examples=int(os.getenv("REJECTION_EXAMPLES", 10)),
+        )
+
+    def reject_reason(self, name: str, age: int, banner_id: int) -> str | None:
+        """Find the first rule the values fail.
+
+        :return: Name of the failed rule (see `REJECT_MESSAGES`); None if the
+            values pass the validation.
+        :rtype: str | None
+        """
+        if self.name_pattern.fullmatch(name) is None:
+            return "name"
+        if self.max_name_length is not None and len(name) > self.max_name_length:
+            return "name_length"
+        if age < self.min_age or (self.max_age is not None and age > self.max_age):
+            return "age"
+        if not (self.min_banner_id <= banner_id <= self.max_banner_id):
+            return "banner_id"
+        return None
+
+    def reject(
+        self,
+        rule: str,
+        line: int | None = None,
+        cookie: str | None = None,
+        row: str | None = None,
+    ):
+        """Count a rejected record, keep it as an example if there is room.
+
+        :param str rule: The failed rule, see `REJECT_MESSAGES`.
+        :param (int | None) line: Line number of the record in the file.
+        :param (str | None) cookie: Cookie of the record.
+        :param (str | None) row: The raw row, for the rows that cannot be parsed.
+        """
+        self.rejections[rule] += 1
+        if len(self.examples) < self.max_examples:
+            example: dict[str, Any] = {"rule": rule, "message": REJECT_MESSAGES[rule]}
+            if line is not None:
+                example["line"] = line
+            if cookie is not None:
+                example["cookie"] = cookie
+            if row is not None:
+                example["row"] = row[:200]
+            self.examples.append(example)
+
+    def merge(
+        self,
+        rejections: dict[str, int],
+        examples: list[dict[str, Any]],
+        line_offset: int = 0,
+    ):
+        """Add the rejections counted by another policy, e.g. of a shard.
+
+        :param dict[str, int] rejections: Number of rejected records per rule.
+        :param list[dict[str, Any]] examples: Examples of the other policy.
+        :param int line_offset: Added to the line numbers of the examples.
+        """
+        self.rejections.update(rejections)
+        for example in examples[: max(self.max_examples - len(self.examples), 0)]:
+            if "line" in example:
+                example = {**example, "line": example["line"] + line_offset}
+            self.examples.append(example)
+
+    def report(self) -> dict[str, Any]:
+        """Rejection report: counts per rule and the first rejected records."""
+        return {
+            "rejected": sum(self.rejections.values()),
+            "rules": dict(self.rejections),
+            "examples": list(self.examples),
+        }
+
+    def summary(self) -> str:
+        """One line summary of the rejections."""
+        counts = ", ".join(
+            f"{rule}: {n}" for rule, n in sorted(self.rejections.items())
+        )
+        return f"{sum(self.rejections.values())} rejected ({counts or 'none'})"
+
+    def check(self, rec: Record, line: int | None = None) -> bool:
+        """Validate a record, count it if it is rejected.
+
+        :param Record rec: The record to validate.
+        :param (int | None) line: Line number of the record in the file.
+        :return: True if the record passes the validation test.
+        :rtype: bool
+        """
+        rule = self.reject_reason(rec.name, rec.age, rec.banner_id)
+        if rule is None:
+            return True
+        self.reject(rule, line, rec.cookie)
+        return False
 
 
 @dataclass
 class Record:
     """Customer record entity."""
 
+    # millions of records can be created during a bulk upload
+    __slots__ = ("name", "age", "cookie", "banner_id")
+
     name: str
     age: int
     # UUID of the customer's cookie
@@ -22,7 +188,12 @@ class Record:
         self.cookie = cookie
         self.banner_id = banner_id
 
-    def validate(self, min_age: int | None = None, max_age: int | None = None) -> bool:
+    def validate(
+        self,
+        min_age: int | None = None,
+        max_age: int | None = None,
+        policy: ValidationPolicy | None = None,
+    ) -> bool:
         """Validates the format of the received data.
 
         These are the following rules:
@@ -32,38 +203,21 @@ class Record:
 
         The age filters are used in this order: function parameter, environment variable.
         default values (for minimum it's 18, and for maximum is not limited).
+        Callers validating many records should build a `ValidationPolicy` once
+        and pass it instead of the filters.
 
         :param (int | None) min_age: Minimal age filter. If not set, the default
             value is taken from `MIN_AGE_FILTER` environment variable.
         :param (int | None) max_age: Maximal age filter. If not set, the default
             value is taken form `MAX_AGE_FILTER` environment variable.
+        :param (ValidationPolicy | None) policy: Resolved validation rules; the
+            age filters are ignored if set.
         :return: True if the record passes the validation test.
         :rtype: bool
         """
-
-        # setup minimum and maximum age
-        if not min_age:
-            min_age = int(os.getenv("MIN_AGE_FILTER", 18))
-        if not max_age:
-            if os.getenv('MAX_AGE_FILTER'):
-                max_age = int(os.getenv('MAX_AGE_FILTER'))
-
-        def skip_warn(cookie_uuid: str, reason: str):
-            logging.warning(f"Skipping record {cookie_uuid}: {reason}")
-
-        if re.search(r"^[a-zA-Z ]*$", self.name) is None:
-            skip_warn(self.cookie, "An invalid name.")
-            return False
-        if self.age < min_age:
-            skip_warn(self.cookie, "Ignored due to age.")
-            return False
-        if max_age and self.age > int(max_age):
-            skip_warn(self.cookie, "Ignored due to age.")
-            return False
-        if not (0 <= self.banner_id and self.banner_id <= 99):
-            skip_warn(self.cookie, "Banner ID out of range.")
-            return False
-        return True
+        if policy is None:
+            policy = ValidationPolicy.from_args(min_age, max_age)
+        return policy.check(self)
 
     def transform_data(self) -> dict[str, Any]:
         """Transform the data to the ShowAds API's format.
@@ -75,3 +229,92 @@ class Record:
 
     def to_csv_string(self) -> str:
         return f"{self.name},{self.age},{self.cookie},{self.banner_id}"
+
+
+class RecordBatch:
+    """A bulk of customer records stored column by column.
+
+    The four attributes are kept in parallel lists instead of a list of
+    `Record` objects, and the ShowAds payload is built straight from the
+    columns.
+    """
+
+    __slots__ = ("names", "ages", "cookies", "banner_ids")
+
+    def __init__(self):
+        self.names: list[str] = []
+        self.ages: list[int] = []
+        self.cookies: list[str] = []
+        self.banner_ids: list[int] = []
+
+    @classmethod
+    def from_records(cls, records: Iterable[Record]) -> RecordBatch:
+        """Create a batch from the given records."""
+        batch = cls()
+        for rec in records:
+            batch.append(rec)
+        return batch
+
+    def append(self, rec: Record):
+        """Add a record at the end of the batch."""
+        self.names.append(rec.name)
+        self.ages.append(rec.age)
+        self.cookies.append(rec.cookie)
+        self.banner_ids.append(rec.banner_id)
+
+    def __len__(self) -> int:
+        return len(self.cookies)
+
+    def select(self, mask: Iterable[bool]) -> RecordBatch:
+        """Create a batch of the records with a true value in `mask`."""
+        mask = list(mask)
+        batch = RecordBatch()
+        batch.names = list(compress(self.names, mask))
+        batch.ages = list(compress(self.ages, mask))
+        batch.cookies = list(compress(self.cookies, mask))
+        batch.banner_ids = list(compress(self.banner_ids, mask))
+        return batch
+
+    def slice(self, start: int, stop: int) -> RecordBatch:
+        """Create a batch of the records from `start` up to `stop`."""
+        batch = RecordBatch()
+        batch.names = self.names[start:stop]
+        batch.ages = self.ages[start:stop]
+        batch.cookies = self.cookies[start:stop]
+        batch.banner_ids = self.banner_ids[start:stop]
+        return batch
+
+    def __iter__(self) -> Iterator[Record]:
+        for name, age, cookie, banner_id in zip(
+            self.names, self.ages, self.cookies, self.banner_ids
+        ):
+            yield Record(name, age, cookie, banner_id)
+
+    def to_json(self) -> bytes:
+        """Serialize the batch to the ShowAds API's bulk format.
+
+        The JSON document is written straight from the columns, without an
+        intermediate object per record.
+
+        :return: UTF-8 encoded JSON body of the bulk request.
+        :rtype: bytes
+        """
+        encode = encode_basestring_ascii
+        items = ",".join(
+            f'{{"VisitorCookie":{encode(cookie)},"BannerId":{banner_id:d}}}'
+            for cookie, banner_id in zip(self.cookies, self.banner_ids)
+        )
+        return f'{{"Data":[{items}]}}'.encode()
+
+    def transform_data(self) -> dict[str, Any]:
+        """Transform the batch to the ShowAds API's bulk format.
+
+        :return: An object in ShowAds API bulk format.
+        :rtype: dict[str, Any]
+        """
+        return {
+            "Data": [
+                {"VisitorCookie": cookie, "BannerId": banner_id}
+                for cookie, banner_id in zip(self.cookies, self.banner_ids)
+            ]
+        }
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from data_connector.delivery import BulkResult
+from data_connector.record import RecordBatch
+from data_connector.show_ads_api_wrapper import BULK_SIZE, dispatch, get_client
+from data_connector.spill import SpillStore, get_spill_store
+from data_connector.utils import parse_line
+
+
+@dataclass
+class SpilledBulk:
+    """Bulk of spilled records and their byte offsets in the spill file."""
+
+    batch: RecordBatch = field(default_factory=RecordBatch)
+    offsets: list[int] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+
+@dataclass
+class ReplayResult:
+    """Outcome of a replay."""
+
+    delivered: int = 0
+    failed: int = 0
+    # records refused by the upstream, moved to the rejected file
+    rejected: int = 0
+    # lines that cannot be parsed, they are kept in the spill file
+    invalid: int = 0
+    # records left in the spill files after the compaction
+    left: int = 0
+
+
+def _spilled_bulks(
+    store: SpillStore, path: Path, end: int, result: ReplayResult
+) -> Iterator[SpilledBulk]:
+    bulk = SpilledBulk()
+    for offset, line in store.entries(path, end):
+        rec = parse_line(line.decode().strip())
+        if rec is None:
+            result.invalid += 1
+            continue
+        bulk.batch.append(rec)
+        bulk.offsets.append(offset)
+        if len(bulk.offsets) >= BULK_SIZE:
+            yield bulk
+            bulk = SpilledBulk()
+    if bulk.offsets:
+        yield bulk
+
+
+def replay_unsent(
+    paths: Iterable[Path] | None = None,
+    concurrency: int | None = None,
+    store: SpillStore | None = None,
+) -> ReplayResult:
+    """Send the spilled records again and compact the spill files.
+
+    The records are streamed from the files in bulks and sent concurrently.
+    The delivered records are written to the index of the spill file after
+    each bulk, so an interrupted replay does not send them again. Records
+    that still cannot be sent stay in the file; records the upstream refuses
+    are moved to the rejected file with the reason, see `SpillStore`.
+
+    :param (Iterable[Path] | None) paths: The spill files (default: all the
+        spill files of the store).
+    :param (int | None) concurrency: Number of bulks sent in parallel. If not
+        set, the value is taken from `SEND_CONCURRENCY` environment variable.
+    :param (SpillStore | None) store: The spill store (default: the store of
+        `FAILED_RECORDS_DIRPATH`).
+    :return: Number of delivered, failed, rejected, invalid and remaining
+        records.
+    :rtype: ReplayResult
+    """
+    store = store or get_spill_store()
+    if not concurrency:
+        concurrency = int(os.getenv("SEND_CONCURRENCY", 1))
+    client = get_client()
+    result = ReplayResult()
+
+    for path in list(paths) if paths is not None else store.spill_files():
+        path = Path(path)
+        # records appended during the replay are left for the next one
+        with store.locked():
+            end = path.stat().st_size
+        logging.info(f"Replaying {path}.")
+
+        def on_done(bulk: SpilledBulk, outcome: BulkResult):
+            if outcome.rejected:
+                positions = sorted(outcome.rejected)
+                store.append_rejected(
+                    bulk.batch.select(i in outcome.rejected for i in range(len(bulk))),
+                    [outcome.rejected[i] for i in positions],
+                )
+            # the refused records are removed from the spill file as well
+            done = [
+                offset
+                for i, (offset, ok) in enumerate(zip(bulk.offsets, outcome.delivered))
+                if ok or i in outcome.rejected
+            ]
+            if done:
+                store.mark_delivered(path, done)
+            result.delivered += outcome.sent
+            result.rejected += len(outcome.rejected)
+            result.failed += len(bulk.offsets) - len(done)
+
+        dispatch(
+            _spilled_bulks(store, path, end, result),
+            lambda bulk_id, bulk: client.deliver_bulk(
+                bulk_id, bulk.batch, spill=False
+            ),
+            concurrency,
+            on_done,
+        )
+        result.left += store.compact(path)
+    return result
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import mmap
+import multiprocessing
+import os
+import queue as queue_module
+from collections import Counter
+from dataclasses import replace
+from pathlib import Path
+from typing import Iterator
+
+from data_connector.columnar import read_columns, validate_columns
+from data_connector.metrics import ROWS_PARSED, ROWS_REJECTED
+from data_connector.record import RecordBatch, ValidationPolicy
+from data_connector.show_ads_api_wrapper import BULK_SIZE, dispatch, send_bulk
+
+# how often (in seconds) the workers are checked while the queue is empty
+WORKER_POLL_INTERVAL = 1.0
+
+
+def shard_ranges(path: Path, shards: int) -> list[tuple[int, int]]:
+    """Split a file into byte ranges aligned to the line boundaries.
+
+    The boundaries are looked up in a memory map of the file, the file is not
+    read as a whole.
+
+    :param Path path: The file.
+    :param int shards: Requested number of ranges.
+    :return: List of `(start, end)` byte offsets; fewer than `shards` if the
+        file has not enough lines.
+    :rtype: list[tuple[int, int]]
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    with open(path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mm:
+        bounds = [0]
+        for i in range(1, shards):
+            newline = mm.find(b"\n", max(size * i // shards, bounds[-1]))
+            if newline == -1 or newline + 1 >= size:
+                break
+            if newline + 1 > bounds[-1]:
+                bounds.append(newline + 1)
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+class _RangeReader:
+    """File-like view of a byte range of a memory map."""
+
+    def __init__(self, mm: mmap.mmap, start: int, end: int):
+        self._mm = mm
+        self._pos = start
+        self._end = end
+
+    def read(self, size: int) -> bytes:
+        size = min(size, self._end - self._pos)
+        data = self._mm[self._pos : self._pos + size]
+        self._pos += size
+        return data
+
+
+def _parse_shard(
+    path: Path,
+    shard: int,
+    start: int,
+    end: int,
+    policy: ValidationPolicy,
+    queue: multiprocessing.Queue,
+):
+    """Worker process: parse and validate a range of the file.
+
+    The line numbers in the rejection examples are relative to the range.
+    """
+    try:
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            batch = RecordBatch()
+            parsed = 0
+            for cols in read_columns(_RangeReader(mm, start, end)):
+                result = validate_columns(cols, policy)
+                parsed += len(cols)
+                for row in result.accepted:
+                    i = row - cols.start
+                    batch.names.append(cols.names[i])
+                    batch.ages.append(cols.ages[i])
+                    batch.cookies.append(cols.cookies[i])
+                    batch.banner_ids.append(cols.banner_ids[i])
+                    if len(batch) >= BULK_SIZE:
+                        queue.put(("batch", shard, batch))
+                        batch = RecordBatch()
+            if len(batch):
+                queue.put(("batch", shard, batch))
+        queue.put(
+            ("done", shard, (parsed, dict(policy.rejections), policy.examples))
+        )
+    except Exception as e:
+        queue.put(("error", shard, repr(e)))
+
+
+def send_file_sharded(
+    path: Path,
+    policy: ValidationPolicy,
+    workers: int,
+    concurrency: int | None = None,
+) -> int:
+    """Parse a CSV file with several processes and send the valid records.
+
+    The file is split into `workers` byte ranges, each of them is parsed and
+    validated in its own process. The valid records of all the shards are
+    sent by the sender of this process. The rejections of the shards are
+    added to `policy` once all the shards are done, in the order of the file.
+    A worker that dies without finishing its shard (e.g. killed for running
+    out of memory) fails the upload instead of leaving it waiting.
+
+    :param Path path: The CSV file.
+    :param ValidationPolicy policy: Validation rules of the records.
+    :param int workers: Number of parsing processes.
+    :param (int | None) concurrency: Number of bulks sent in parallel. If not
+        set, the value is taken from `SEND_CONCURRENCY` environment variable.
+    :return: Number of records sent.
+    :rtype: int
+    :raises RuntimeError: A shard could not be parsed.
+    """
+    if not concurrency:
+        concurrency = int(os.getenv("SEND_CONCURRENCY", 1))
+    ranges = shard_ranges(path, workers)
+    ctx = multiprocessing.get_context()
+    # bounded, the workers wait while the sender is behind
+    queue = ctx.Queue(maxsize=4 * max(len(ranges), 1))
+    total_sent = 0
+    # number of rows, rejections and rejection examples of each shard
+    results: dict[int, tuple[int, dict[str, int], list]] = {}
+
+    # every worker counts its own rejections
+    procs = [
+        ctx.Process(
+            target=_parse_shard,
+            args=(
+                path,
+                i,
+                start,
+                end,
+                replace(policy, rejections=Counter(), examples=[]),
+                queue,
+            ),
+            daemon=True,
+        )
+        for i, (start, end) in enumerate(ranges)
+    ]
+    for proc in procs:
+        proc.start()
+
+    def batches() -> Iterator[RecordBatch]:
+        running = set(range(len(procs)))
+        # workers found exited before their shard was done
+        exited: set[int] = set()
+        while running:
+            try:
+                kind, shard, payload = queue.get(timeout=WORKER_POLL_INTERVAL)
+            except queue_module.Empty:
+                # the last messages of a worker that has just exited may still
+                # be on their way, it is given one more interval
+                lost = exited & running
+                if lost:
+                    shard = min(lost)
+                    raise RuntimeError(
+                        f"Parsing of shard {shard} failed: the worker exited "
+                        f"with code {procs[shard].exitcode}."
+                    )
+                exited = {i for i in running if procs[i].exitcode is not None}
+                continue
+            if kind == "batch":
+                yield payload
+            elif kind == "done":
+                parsed, rejections, _ = results[shard] = payload
+                # the metrics of the worker processes are not exported
+                ROWS_PARSED.inc(parsed)
+                for rule, count in rejections.items():
+                    ROWS_REJECTED.inc(count, rule=rule)
+                running.discard(shard)
+            else:
+                raise RuntimeError(f"Parsing of shard {shard} failed: {payload}")
+
+    def on_done(bulk: RecordBatch, sent: int):
+        nonlocal total_sent
+        total_sent += sent
+
+    try:
+        dispatch(batches(), send_bulk, concurrency, on_done)
+    except BaseException:
+        for proc in procs:
+            proc.terminate()
+        raise
+    finally:
+        for proc in procs:
+            proc.join()
+
+    line_offset = 0
+    for shard in range(len(procs)):
+        parsed, rejections, examples = results[shard]
+        policy.merge(rejections, examples, line_offset)
+        line_offset += parsed
+    return total_sent
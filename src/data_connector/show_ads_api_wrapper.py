@@ -1,164 +1,560 @@
 from __future__ import annotations
 
+import contextvars
 import logging
+import json
 import os
-from typing import Any
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, TypeVar
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from data_connector.record import Record
-from data_connector.utils import store_unsent_records
+from data_connector import tracing
+from data_connector.dedup import DedupCache, dedup_key
+from data_connector.delivery import (
+    DELIVERED,
+    REFRESH_TOKEN,
+    REFUSED,
+    BulkDelivery,
+    BulkResult,
+    next_step,
+    retry_delay,
+    status_label,
+    store_failed_record,
+    store_failed_records,
+    update_limiter,
+)
+from data_connector.encoder import EncodedPayload, encode_record
+from data_connector.metrics import TOKEN_REFRESHES, UPSTREAM_LATENCY, UPSTREAM_RETRIES
+from data_connector.record import Record, RecordBatch
+from data_connector.throttle import (
+    CONNECTION_FAILED,
+    TIMED_OUT,
+    AdaptiveBulkSize,
+    AdaptiveConcurrency,
+    RetryPolicy,
+    TokenBucket,
+)
+from data_connector.utils import adaptive_batches
 
-OPT_DICT: dict[str, Any] = {
-    "base_url": os.getenv("API_URL"),
-    "project_key": os.getenv("PROJECT_KEY"),
-    "access_token": "",
-}
+# maximum number of records the ShowAds API accepts in a single bulk
+BULK_SIZE = 1000
 
+B = TypeVar("B")
+R = TypeVar("R")
 
-def send_data(buffer: list[Record]) -> int:
-    """Send a list of records to the ShowAds API.
+# default lifetime of an access token (in seconds) if the API does not say
+ACCESS_TOKEN_TTL = 24 * 60 * 60
 
-    :param list[Record] buffer: A list containing all the valid records.
+
+def send_data(
+    records: Iterable[Record],
+    concurrency: int | None = None,
+    on_bulk: Callable[[int, int], None] | None = None,
+) -> int:
+    """Send records to the ShowAds API.
+
+    The records are consumed lazily and a bulk is sent as soon as it fills up,
+    so the records can be streamed straight from the parser. The bulks are
+    sized by the `AdaptiveBulkSize` of the client.
+
+    With `concurrency` greater than 1 the bulks are dispatched by a pool of
+    worker threads. At most `concurrency` bulks are in flight at once; the
+    records are not consumed any further until one of them finishes.
+
+    :param Iterable[Record] records: Valid records to send.
+    :param (int | None) concurrency: Number of bulks sent in parallel. If not
+        set, the value is taken from `SEND_CONCURRENCY` environment variable
+        (default 1, sequential dispatch).
+    :param Callable on_bulk: Called with the bulk size and the number of sent
+        records once a bulk is finished. It is always called from the calling
+        thread.
     :return: Number of records sent.
     :rtype: int
     """
+    if not concurrency:
+        concurrency = int(os.getenv("SEND_CONCURRENCY", 1))
+
     total_sent = 0
-    i = 0
-    while i <= len(buffer) // 1000:
-        # send a bulk of max 1000 records
-        total_sent += send_bulk(i, buffer[i * 1000 : min((i + 1) * 1000, len(buffer))])
-        i += 1
+
+    def finished(bulk: RecordBatch, sent: int):
+        nonlocal total_sent
+        total_sent += sent
+        if on_bulk:
+            on_bulk(len(bulk), sent)
+
+    bulks = adaptive_batches(records, get_client().bulk_sizer)
+    dispatch(bulks, send_bulk, concurrency, finished)
     return total_sent
 
 
-def update_access_token(nof_tries: int = 3):
-    """Updates an access token.
+def dispatch(
+    bulks: Iterable[B],
+    sender: Callable[[int, B], R],
+    concurrency: int,
+    on_done: Callable[[B, R], None],
+):
+    """Send bulks with at most `concurrency` of them in flight.
 
-    Requires the project key to be set.
+    The bulks are consumed lazily; with `concurrency` greater than 1 they are
+    sent by a pool of worker threads and the iterable is not advanced until
+    one of the in-flight bulks finishes. Reading a bulk is timed in a
+    `read_bulk` span of the request, the worker threads send the bulks in
+    the context of the request.
 
-    :param int nof_tries: Number of tries.
+    :param Iterable bulks: The bulks to send.
+    :param Callable sender: Sends a bulk, called with its ID and the bulk;
+        returns the number of sent records or a `BulkResult`.
+    :param int concurrency: Number of bulks sent in parallel.
+    :param Callable on_done: Called with the bulk and the result of the
+        sender once a bulk is finished, always from the calling thread.
     """
+    bulks = tracing.traced(bulks, "read_bulk")
+    if concurrency <= 1:
+        for bulk_id, bulk in enumerate(bulks):
+            on_done(bulk, sender(bulk_id, bulk))
+        return
 
-    def warning_msg(reason: str):
-        logging.warning(f"Access Token request fail: {reason}")
+    in_flight: dict[Future[R], B] = {}
+    with ThreadPoolExecutor(
+        max_workers=concurrency, thread_name_prefix="send_bulk"
+    ) as executor:
+        for bulk_id, bulk in enumerate(bulks):
+            if len(in_flight) >= concurrency:
+                # backpressure: wait for a free slot before reading further
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    on_done(in_flight.pop(future), future.result())
+            context = contextvars.copy_context()
+            in_flight[executor.submit(context.run, sender, bulk_id, bulk)] = bulk
+        for future in wait(in_flight).done:
+            on_done(in_flight[future], future.result())
 
-    logging.info(
-        f"Sending a AccessToken request for project {OPT_DICT['project_key']}."
-    )
-    res = requests.post(
-        f"{OPT_DICT['base_url']}/auth", json={"ProjectKey": OPT_DICT["project_key"]}
-    )
 
-    # trying `nof_tries` times
-    tries = 0
-    while res.status_code != 200 and (nof_tries == -1 or tries < nof_tries):
-        if res.status_code == 400:
-            warning_msg("Project Key missing.")
-        elif res.status_code == 500:
-            warning_msg("Internal server error.")
-        elif res.status_code == 429:
-            warning_msg("Too many requests.")
-        else:
-            warning_msg(f"Request return code {res.status_code}.")
-        tries += 1
-        res = requests.post(
-            f"{OPT_DICT['base_url']}/auth", json={"ProjectKey": OPT_DICT["project_key"]}
+class ShowAdsClient:
+    """Client of the ShowAds API.
+
+    The client owns a single keep-alive session shared by all the threads and
+    the access token. The token is refreshed by one thread at a time; the other
+    threads wait for the result instead of sending their own `/auth` request.
+    The token is refreshed ahead of its expiry so the requests do not fail on
+    it.
+
+    :param str base_url: URL of the ShowAds API.
+    :param str project_key: The project key value.
+    :param int pool_size: Maximum number of kept-alive connections.
+    :param float token_ttl: Lifetime of the access token (in seconds), used if
+        the API does not return `ExpiresIn`.
+    :param float refresh_margin: The token is refreshed this many seconds
+        before it expires.
+    :param bool compress: Send the request bodies compressed with gzip; the
+        upstream must accept `Content-Encoding: gzip`.
+    :param (RetryPolicy | None) retry_policy: Backoff between the attempts.
+    :param (TokenBucket | None) rate_limiter: Limits the request rate.
+    :param (AdaptiveConcurrency | None) concurrency_limiter: Limits the number
+        of in-flight requests, backs off when the upstream replies 429.
+    :param (DedupCache | None) dedup: Records with a (cookie, banner ID) pair
+        delivered within the cache window are skipped.
+    :param (AdaptiveBulkSize | None) bulk_sizer: Limits the number of records
+        and bytes of a bulk, shrinks it when the upstream rejects a bulk.
+    :param (float | None) timeout: Time (in seconds) to wait for a response;
+        a timed out attempt is retried (default: no timeout).
+    """
+
+    def __init__(
+        self,
+        base_url: str | None,
+        project_key: str | None,
+        pool_size: int = 32,
+        token_ttl: float = ACCESS_TOKEN_TTL,
+        refresh_margin: float = 300,
+        compress: bool = False,
+        retry_policy: RetryPolicy | None = None,
+        rate_limiter: TokenBucket | None = None,
+        concurrency_limiter: AdaptiveConcurrency | None = None,
+        dedup: DedupCache | None = None,
+        bulk_sizer: AdaptiveBulkSize | None = None,
+        timeout: float | None = None,
+    ):
+        self.base_url = base_url
+        self.project_key = project_key
+        self.token_ttl = token_ttl
+        self.refresh_margin = refresh_margin
+        self.compress = compress
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter = rate_limiter or TokenBucket(0)
+        self.concurrency_limiter = concurrency_limiter or AdaptiveConcurrency(0)
+        self.dedup = dedup
+        self.bulk_sizer = bulk_sizer or AdaptiveBulkSize(BULK_SIZE)
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._access_token = ""
+        self._expires_at = 0.0
+        self._token_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> ShowAdsClient:
+        """Create a client configured by the environment variables."""
+        pool_size = int(os.getenv("SHOW_ADS_POOL_SIZE", 32))
+        return cls(
+            os.getenv("API_URL"),
+            os.getenv("PROJECT_KEY"),
+            pool_size=pool_size,
+            token_ttl=float(os.getenv("ACCESS_TOKEN_TTL", ACCESS_TOKEN_TTL)),
+            refresh_margin=float(os.getenv("ACCESS_TOKEN_REFRESH_MARGIN", 300)),
+            compress=os.getenv("SHOW_ADS_GZIP", "").lower() in {"1", "true", "yes"},
+            retry_policy=RetryPolicy.from_env(),
+            rate_limiter=TokenBucket(
+                float(os.getenv("SHOW_ADS_RATE_LIMIT", 0)),
+                float(os.getenv("SHOW_ADS_RATE_BURST", 0)) or None,
+            ),
+            concurrency_limiter=AdaptiveConcurrency(
+                int(os.getenv("SHOW_ADS_MAX_IN_FLIGHT", pool_size))
+            ),
+            dedup=DedupCache.from_env(),
+            bulk_sizer=bulk_sizer_from_env(),
+            timeout=float(os.getenv("SHOW_ADS_TIMEOUT", 0)) or None,
         )
 
-    if res.status_code != 200:
-        logging.error("Access Token request fail: Unable to fetch auth token.")
-        return
-    logging.info("Access Token loaded")
-    OPT_DICT["access_token"] = res.json()["AccessToken"]
+    @property
+    def access_token(self) -> str:
+        return self._access_token
 
+    def close(self):
+        """Close the pooled connections."""
+        self.session.close()
 
-def send_bulk(bulk_id: int, lof_records: list[Record]) -> int:
-    """Wrapper function that sends a bulk of customer records to ShowAds API endpoint.
+    def get_access_token(self) -> str:
+        """Return a valid access token, refresh it if it is about to expire."""
+        token = self._access_token
+        if not token or time.monotonic() >= self._expires_at - self.refresh_margin:
+            token = self.update_access_token(stale_token=token)
+        return token
 
-    The sender must ensure to send the maximum number of records allowed by the API.
-    """
-    rec_sent = 0
-    session = requests.session()
-    if not OPT_DICT["access_token"]:
-        update_access_token()
-
-    headers = {"Authorization": f"Bearer {OPT_DICT['access_token']}"}
-    session.headers.update(headers)
-
-    retries = 3
-    while retries > 0:
-        res = session.post(
-            f"{OPT_DICT['base_url']}/banners/show/bulk",
-            json={"Data": [r.transform_data() for r in lof_records]},
+    def update_access_token(
+        self, nof_tries: int = 3, stale_token: str | None = None
+    ) -> str:
+        """Updates an access token.
+
+        Requires the project key to be set. If `stale_token` is given and
+        the current token is a different one, another thread has already
+        refreshed it and no request is sent.
+
+        :param int nof_tries: Number of tries.
+        :param (str | None) stale_token: The token the caller found invalid.
+        :return: The current access token (empty if it was never fetched).
+        :rtype: str
+        """
+
+        def warning_msg(reason: str):
+            logging.warning(f"Access Token request fail: {reason}")
+
+        with self._token_lock:
+            if stale_token is not None and stale_token != self._access_token:
+                return self._access_token
+
+            logging.info(
+                f"Sending a AccessToken request for project {self.project_key}."
+            )
+            status, retry_after, body = self._post_auth()
+
+            # trying `nof_tries` times
+            tries = 0
+            while status != 200 and (nof_tries == -1 or tries < nof_tries):
+                if status == TIMED_OUT:
+                    warning_msg(f"No response in {self.timeout}s.")
+                elif status == CONNECTION_FAILED:
+                    warning_msg("Connection to the destination server failed.")
+                elif status == 400:
+                    warning_msg("Project Key missing.")
+                elif status == 500:
+                    warning_msg("Internal server error.")
+                elif status == 429:
+                    warning_msg("Too many requests.")
+                else:
+                    warning_msg(f"Request return code {status}.")
+                time.sleep(self.retry_policy.delay(tries, retry_after))
+                tries += 1
+                status, retry_after, body = self._post_auth()
+
+            if status != 200:
+                logging.error("Access Token request fail: Unable to fetch auth token.")
+                TOKEN_REFRESHES.inc(result="failure")
+                return self._access_token
+            logging.info("Access Token loaded")
+            TOKEN_REFRESHES.inc(result="success")
+            data = json.loads(body)
+            self._access_token = data["AccessToken"]
+            self._expires_at = time.monotonic() + float(
+                data.get("ExpiresIn", self.token_ttl)
+            )
+            return self._access_token
+
+    def send_bulk(
+        self,
+        bulk_id: int,
+        lof_records: RecordBatch | list[Record],
+        spill: bool = True,
+    ) -> int:
+        """Send a bulk of customer records to ShowAds API endpoint.
+
+        See `deliver_bulk` for the result of every record.
+
+        :param int bulk_id: ID of the bulk used in the logs.
+        :param (RecordBatch | list[Record]) lof_records: The records to send.
+        :param bool spill: Store the records for a later resend if they
+            cannot be sent.
+        :return: Number of records successfully sent, including the duplicates
+            skipped by the dedup cache.
+        :rtype: int
+        """
+        return self.deliver_bulk(bulk_id, lof_records, spill).sent
+
+    def deliver_bulk(
+        self,
+        bulk_id: int,
+        lof_records: RecordBatch | list[Record],
+        spill: bool = True,
+    ) -> BulkResult:
+        """Send a bulk of customer records, report the result of every record.
+
+        The bulk is sent in parts that fit the bulk size, see
+        `AdaptiveBulkSize`. A part the upstream refuses is split in halves and
+        the halves are sent again: on 413 because it is too large, on 400 to
+        find the records the upstream refuses, in O(log n) requests per such
+        record. The other records of the bulk are still delivered.
+
+        :param int bulk_id: ID of the bulk used in the logs.
+        :param (RecordBatch | list[Record]) lof_records: The records to send.
+        :param bool spill: Store the records that cannot be sent for a later
+            resend, and the refused ones with the reason, see `SpillStore`.
+        :return: The delivered records, the duplicates skipped by the dedup
+            cache included, and the refused ones.
+        :rtype: BulkResult
+        """
+        with tracing.span(
+            "send_bulk", **{"bulk.id": bulk_id, "records": len(lof_records)}
+        ) as span:
+            result = self._deliver_bulk(bulk_id, lof_records, spill)
+            span.set(sent=result.sent, rejected=len(result.rejected))
+        return result
+
+    def _deliver_bulk(
+        self, bulk_id: int, lof_records: RecordBatch | list[Record], spill: bool
+    ) -> BulkResult:
+        if not isinstance(lof_records, RecordBatch):
+            lof_records = RecordBatch.from_records(lof_records)
+        delivery = BulkDelivery(
+            bulk_id,
+            lof_records,
+            self.bulk_sizer,
+            self.compress,
+            dedup=self.dedup is not None,
         )
-        if res.status_code == 200:
-            logging.info(f"Send bulk {bulk_id}: A bulk successfully sent.")
-            rec_sent = len(lof_records)
-            retries = 0
-        elif res.status_code == 401:
-            update_access_token()
-        elif res.status_code == 400:
-            logging.error(f"Send bulk {bulk_id} fail: Bad request.")
-        elif res.status_code == 500:
-            logging.error(f"Send bulk {bulk_id} fail: Destination server error.")
-        else:
-            logging.error(f"Send bulk {bulk_id} fail: Return code {res.status_code}.")
-        retries -= 1
-
-    # app was unable to forward data to ShowAds API
-    # thus we store it in CSV file (for convenience)
-    # and try it later
-    if rec_sent == 0:
-        store_unsent_records(lof_records)
-    return rec_sent
+        if self.dedup is not None:
+            delivery.skip_duplicates(self.dedup.new_keys(delivery.keys))
 
+        while (payload := delivery.next_payload()) is not None:
+            started = time.perf_counter()
+            status, detail = self._deliver(
+                "/banners/show/bulk", payload, f"bulk {bulk_id}"
+            )
+            delivery.finish_part(status, detail, time.perf_counter() - started)
+        if self.dedup is not None:
+            self.dedup.add(delivery.delivered_keys())
 
-def send_record(rec: Record) -> int:
-    """Wrapper function that sends a single customer record to ShowAds API endpoint.
+        if spill:
+            store_failed_records(delivery.records, delivery.result)
+        return delivery.bulk_result()
+
+    def send_record(self, rec: Record) -> int:
+        """Send a single customer record to ShowAds API endpoint.
+
+        If all the attempts fail the record is stored for a later resend.
+
+        :param Record rec: The given record to be sent to the external API.
+        :return: Number of records successfully sent, including a duplicate
+            skipped by the dedup cache.
+        :rtype: int
+        """
+        key = dedup_key(rec.cookie, rec.banner_id)
+        if self.dedup is not None and not self.dedup.new_keys([key])[0]:
+            logging.info(f"Record {rec.cookie} is a duplicate, skipped.")
+            return 1
+
+        payload = encode_record(rec, self.compress)
+        status, detail = self._deliver(
+            "/banners/show", payload, f"record {rec.cookie}"
+        )
+        if status == 200:
+            if self.dedup is not None:
+                self.dedup.add([key])
+            return 1
+        store_failed_record(rec, status, detail)
+        return 0
+
+    def _deliver(
+        self, path: str, payload: EncodedPayload, what: str
+    ) -> tuple[int, str]:
+        """Send a payload, retry with backoff if the upstream asks for it.
+
+        :param str path: Endpoint of the ShowAds API.
+        :param EncodedPayload payload: The request body.
+        :param str what: Description of the payload used in the logs.
+        :return: Status code of the last response, 200 if the payload was
+            delivered, `TIMED_OUT` if the last attempt got no response in
+            time, `CONNECTION_FAILED` if it could not connect; and the body
+            of a 400 response.
+        :rtype: tuple[int, str]
+        """
+        token = self.get_access_token()
+        policy = self.retry_policy
+        status = TIMED_OUT
+        for attempt in range(policy.attempts):
+            if attempt:
+                UPSTREAM_RETRIES.inc(endpoint=path)
+            self.rate_limiter.acquire()
+            retry_after = None
+            with self.concurrency_limiter.slot() as limiter, tracing.span(
+                "upstream",
+                tracing.SPAN_KIND_CLIENT,
+                **{"http.route": path, "attempt": attempt},
+            ) as span:
+                started = time.perf_counter()
+                try:
+                    res = self.session.post(
+                        f"{self.base_url}{path}",
+                        data=payload.body,
+                        headers={**payload.headers, "Authorization": f"Bearer {token}"},
+                        timeout=self.timeout,
+                    )
+                    status = res.status_code
+                    retry_after = res.headers.get("Retry-After")
+                except requests.Timeout:
+                    status = TIMED_OUT
+                    span.fail(f"No response in {self.timeout}s.")
+                except requests.RequestException as e:
+                    # e.g. refused or reset connection, retried like a timeout
+                    status = CONNECTION_FAILED
+                    span.fail(f"Connection failed: {e}")
+                if status > 0:
+                    span.set(**{"http.status_code": status})
+                    if status != 200:
+                        span.fail(f"Return code {status}.")
+                UPSTREAM_LATENCY.observe(
+                    time.perf_counter() - started,
+                    endpoint=path,
+                    status=status_label(status),
+                )
+                update_limiter(limiter, status)
+
+            step = next_step(status, what, self.timeout)
+            if step == DELIVERED:
+                return status, ""
+            if step == REFRESH_TOKEN:
+                token = self.update_access_token(stale_token=token)
+                continue
+            if step == REFUSED:
+                return status, res.text[:200].strip() if status == 400 else ""
+            delay = retry_delay(policy, status, attempt, retry_after)
+            if delay:
+                time.sleep(delay)
+        return status, ""
+
+    def _post_auth(self) -> tuple[int, str | None, bytes]:
+        """Request an access token, return the status, `Retry-After` and body.
+
+        The status is `TIMED_OUT` or `CONNECTION_FAILED` if there was no
+        response.
+        """
+        self.rate_limiter.acquire()
+        started = time.perf_counter()
+        status, retry_after, content = TIMED_OUT, None, b""
+        with tracing.span(
+            "upstream", tracing.SPAN_KIND_CLIENT, **{"http.route": "/auth"}
+        ) as span:
+            try:
+                res = self.session.post(
+                    f"{self.base_url}/auth",
+                    json={"ProjectKey": self.project_key},
+                    timeout=self.timeout,
+                )
+                status, retry_after = res.status_code, res.headers.get("Retry-After")
+                content = res.content
+                span.set(**{"http.status_code": status})
+            except requests.Timeout:
+                span.fail(f"No response in {self.timeout}s.")
+            except requests.RequestException as e:
+                status = CONNECTION_FAILED
+                span.fail(f"Connection failed: {e}")
+        UPSTREAM_LATENCY.observe(
+            time.perf_counter() - started, endpoint="/auth", status=status_label(status)
+        )
+        return status, retry_after, content
+
+
+def bulk_sizer_from_env() -> AdaptiveBulkSize:
+    """Create the bulk size configured by the environment variables."""
+    return AdaptiveBulkSize(
+        int(os.getenv("SHOW_ADS_BULK_MAX_RECORDS", BULK_SIZE)),
+        int(os.getenv("SHOW_ADS_BULK_MAX_BYTES", 0)),
+        float(os.getenv("SHOW_ADS_BULK_TARGET_LATENCY", 1.0)),
+    )
+
+
+_client: ShowAdsClient | None = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> ShowAdsClient:
+    """Return the process-wide ShowAds client, create it on the first call."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ShowAdsClient.from_env()
+    return _client
 
-    The function has 3 retries. If all three attempts fail
+
+def set_client(client: ShowAdsClient | None):
+    """Replace the process-wide ShowAds client.
+
+    :param (ShowAdsClient | None) client: The new client. If None, a new client
+        is created from the environment variables on the next use.
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = client
+
+
+def update_access_token(nof_tries: int = 3):
+    """Updates an access token of the process-wide client.
+
+    :param int nof_tries: Number of tries.
+    """
+    get_client().update_access_token(nof_tries)
+
+
+def send_bulk(bulk_id: int, lof_records: RecordBatch | list[Record]) -> int:
+    """Send a bulk of customer records using the process-wide client."""
+    return get_client().send_bulk(bulk_id, lof_records)
+
+
+def send_record(rec: Record) -> int:
+    """Send a single customer record using the process-wide client.
 
     :param Record rec: The given record to be sent to the external API.
     :return: Number of records successfully sent.
     :rtype: int
     """
-    rec_sent = 0
-    session = requests.session()
-    if not OPT_DICT["access_token"]:
-        update_access_token()
-
-    headers = {"Authorization": f"Bearer {OPT_DICT['access_token']}"}
-    session.headers.update(headers)
-
-    retries = 3
-    while retries > 0:
-        res = session.post(
-            f"{OPT_DICT['base_url']}/banners/show", json=rec.transform_data()
-        )
-        if res.status_code == 200:
-            logging.info(f"Successfully sent record {rec.cookie}.")
-            rec_sent = 1
-            retries = 0
-        elif res.status_code == 401:
-            update_access_token()
-        elif res.status_code == 400:
-            logging.error(f"Send record {rec.cookie} fail: Bad request.")
-        elif res.status_code == 500:
-            logging.error(f"Send record {rec.cookie} fail: Destination server error.")
-        elif res.status_code == 429:
-            logging.error(
-                f"Send record {rec.cookie} fail: Destination server is under heavy load."
-            )
-        else:
-            logging.error(
-                f"Send record {rec.cookie} fail: Return code {res.status_code}."
-            )
-
-        retries -= 1
-    # app was unable to forward data to ShowAds API
-    # thus we store it in CSV file (for convenience)
-    # and try it later
-    if rec_sent == 0:
-        store_unsent_records([rec])
-    return rec_sent
+    return get_client().send_record(rec)
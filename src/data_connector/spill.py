@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import atexit
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from data_connector.metrics import REJECTED_RECORDS, SPILLED_RECORDS
+from data_connector.record import Record
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, only threads are synchronized
+    fcntl = None
+
+
+class SpillStore:
+    """Append-only store of the records that could not be sent.
+
+    The records are appended as CSV lines to `unsent_{date}.csv` files. A
+    lock file in the directory serializes the writers across processes, so
+    the lines of concurrent gunicorn workers never interleave. The data are
+    synced to disk after `fsync_records` records or `fsync_interval` seconds,
+    whichever comes first. Both are checked when records are appended, there
+    is no timer: the last records before a quiet period stay unsynced until
+    the next append, `flush` or `close` (at the latest at the exit).
+
+    Each record is identified by its byte offset in the file. Delivered
+    records are listed in an index file next to the spill file
+    (`unsent_{date}.csv.idx`) until the spill file is compacted.
+
+    Records the upstream refused on their own would be refused again; they
+    are appended to `rejected_{date}.csv` with the reason instead and are
+    not replayed.
+
+    :param Path dirpath: Directory of the spill files.
+    :param int fsync_records: Number of records written between two syncs.
+    :param float fsync_interval: Time (in seconds) after which an append
+        syncs the file.
+    """
+
+    def __init__(
+        self, dirpath: Path, fsync_records: int = 1000, fsync_interval: float = 1.0
+    ):
+        self.dirpath = Path(dirpath)
+        self.fsync_records = fsync_records
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._fd: int | None = None
+        self._fd_path: Path | None = None
+        self._pending = 0
+        self._synced_at = time.monotonic()
+
+    def path_for(self, day: date) -> Path:
+        """Path of the spill file of the given day."""
+        return self.dirpath / f"unsent_{day}.csv"
+
+    def rejected_path_for(self, day: date) -> Path:
+        """Path of the file of the records rejected on the given day."""
+        return self.dirpath / f"rejected_{day}.csv"
+
+    def spill_files(self) -> list[Path]:
+        """All the spill files in the directory, oldest first."""
+        return sorted(self.dirpath.glob("unsent_*.csv"))
+
+    @staticmethod
+    def index_path(path: Path) -> Path:
+        return path.with_name(f"{path.name}.idx")
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """Hold the store lock, shared by the threads and the processes."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            self.dirpath.mkdir(parents=True, exist_ok=True)
+            with open(self.dirpath / ".unsent.lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def append(self, records: Iterable[Record]):
+        """Append records to today's spill file.
+
+        :param Iterable[Record] records: The records to store.
+        """
+        lines = [f"{record.to_csv_string()}\n" for record in records]
+        if lines:
+            self._write(self.path_for(date.today()), lines)
+            SPILLED_RECORDS.inc(len(lines))
+
+    def append_rejected(self, records: Iterable[Record], reasons: Iterable[str]):
+        """Append records the upstream refused to today's rejected file.
+
+        Every line holds the record and the reason as the last column.
+
+        :param Iterable[Record] records: The refused records.
+        :param Iterable[str] reasons: Reason of every record.
+        """
+        lines = [
+            f"{record.to_csv_string()},{' '.join(reason.split())}\n"
+            for record, reason in zip(records, reasons)
+        ]
+        if lines:
+            self._write(self.rejected_path_for(date.today()), lines)
+            REJECTED_RECORDS.inc(len(lines))
+
+    def flush(self):
+        """Sync the pending records to disk."""
+        with self._lock:
+            if self._fd is not None and self._pending:
+                self._sync()
+
+    def close(self):
+        """Sync the pending records and close the spill file."""
+        with self._lock:
+            self._close()
+
+    def entries(self, path: Path, end: int | None = None) -> Iterator[tuple[int, bytes]]:
+        """Iterate over the records of a spill file that were not delivered.
+
+        :param Path path: The spill file.
+        :param (int | None) end: Stop at this byte offset (default: end of the
+            file).
+        :return: Iterator of the byte offsets and the lines of the records.
+        :rtype: Iterator[tuple[int, bytes]]
+        """
+        delivered = self.delivered(path)
+        offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if end is not None and offset >= end:
+                    break
+                if offset not in delivered and line.strip():
+                    yield offset, line
+                offset += len(line)
+
+    def delivered(self, path: Path) -> set[int]:
+        """Byte offsets of the delivered records of a spill file."""
+        index = self.index_path(path)
+        if not index.exists():
+            return set()
+        with open(index) as f:
+            return {int(line) for line in f if line.strip()}
+
+    def mark_delivered(self, path: Path, offsets: Iterable[int]):
+        """Record the delivered records of a spill file in its index.
+
+        :param Path path: The spill file.
+        :param Iterable[int] offsets: Byte offsets of the delivered records.
+        """
+        data = "".join(f"{offset}\n" for offset in offsets).encode()
+        with self.locked():
+            fd = os.open(self.index_path(path), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def compact(self, path: Path) -> int:
+        """Rewrite a spill file without its delivered records.
+
+        The file is removed if no record is left.
+
+        :param Path path: The spill file.
+        :return: Number of records left in the file.
+        :rtype: int
+        """
+        with self.locked():
+            if self._fd_path == path:
+                # the writers reopen the file on their next append
+                self._close()
+            index = self.index_path(path)
+            if not path.exists():
+                index.unlink(missing_ok=True)
+                return 0
+            tmp = path.with_name(f".{path.name}.tmp")
+            left = 0
+            with open(tmp, "wb") as out:
+                for _, line in self.entries(path):
+                    out.write(line)
+                    left += 1
+                out.flush()
+                os.fsync(out.fileno())
+            if left:
+                os.replace(tmp, path)
+            else:
+                tmp.unlink()
+                path.unlink()
+            index.unlink(missing_ok=True)
+            return left
+
+    def _write(self, path: Path, lines: list[str]):
+        data = "".join(lines).encode()
+        with self.locked():
+            fd = self._open(path)
+            # a single write, the whole bulk lands in one piece
+            os.write(fd, data)
+            self._pending += len(lines)
+            if (
+                self._pending >= self.fsync_records
+                or time.monotonic() - self._synced_at >= self.fsync_interval
+            ):
+                self._sync()
+
+    def _open(self, path: Path) -> int:
+        # the file may have been rotated or compacted by another process
+        if self._fd is not None:
+            try:
+                current = os.stat(path).st_ino == os.fstat(self._fd).st_ino
+            except FileNotFoundError:
+                current = False
+            if self._fd_path != path or not current:
+                self._close()
+        if self._fd is None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self._fd_path = path
+        return self._fd
+
+    def _sync(self):
+        os.fsync(self._fd)
+        self._pending = 0
+        self._synced_at = time.monotonic()
+
+    def _close(self):
+        if self._fd is not None:
+            if self._pending:
+                self._sync()
+            os.close(self._fd)
+            self._fd = None
+            self._fd_path = None
+
+
+_stores: dict[Path, SpillStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_spill_store(dirpath: Path | str | None = None) -> SpillStore:
+    """Return the process-wide spill store of a directory.
+
+    :param (Path | str | None) dirpath: Directory of the spill files (default:
+        `FAILED_RECORDS_DIRPATH` environment variable, or `/tmp`).
+    :return: The spill store.
+    :rtype: SpillStore
+    """
+    path = Path(dirpath or os.getenv("FAILED_RECORDS_DIRPATH", "/tmp"))
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = SpillStore(
+                path,
+                int(os.getenv("SPILL_FSYNC_RECORDS", 1000)),
+                float(os.getenv("SPILL_FSYNC_INTERVAL", 1.0)),
+            )
+        return _stores[path]
+
+
+@atexit.register
+def _close_stores():
+    for store in _stores.values():
+        store.close()
@@ -0,0 +1,264 @@
+from __future__ import annotations
+
+import os
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, AsyncIterator, Iterator
+
+if TYPE_CHECKING:
+    import asyncio
+
+# status of an attempt that got no response in time
+TIMED_OUT = 0
+# status of an attempt that could not connect or lost the connection
+CONNECTION_FAILED = -1
+# status codes worth retrying after a delay
+RETRYABLE_STATUS_CODES = {CONNECTION_FAILED, TIMED_OUT, 429, 500, 502, 503, 504}
+# responses after which the bulks are made smaller, see `AdaptiveBulkSize`
+BULK_SHRINK_STATUS_CODES = {TIMED_OUT, 400, 413}
+
+
+class TokenBucket:
+    """Limits the rate of the requests sent to the upstream.
+
+    :param float rate: Number of requests per second; 0 disables the limit.
+    :param (float | None) capacity: Maximum burst size (default: one second
+        worth of requests).
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0):
+        """Block until `tokens` tokens are available and take them."""
+        while (wait := self.try_acquire(tokens)) > 0:
+            time.sleep(wait)
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """Take `tokens` tokens if they are available, without blocking.
+
+        :param float tokens: Number of tokens to take.
+        :return: 0 if the tokens were taken, otherwise the time (in seconds)
+            until they are available.
+        :rtype: float
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+
+class AdaptiveConcurrency:
+    """Limits the number of in-flight requests with AIMD.
+
+    The limit grows by one request per "round" of successful responses
+    (additive increase) and is cut by `decrease` whenever the upstream
+    replies 429 (multiplicative decrease).
+
+    :param int max_limit: Upper bound of the limit; 0 disables the limiter.
+    :param int min_limit: Lower bound of the limit.
+    :param float decrease: Factor the limit is multiplied by on a 429.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, decrease: float = 0.5):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease = decrease
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self) -> Iterator[AdaptiveConcurrency]:
+        """Hold an in-flight slot; call `throttled` within it on a 429."""
+        if self.max_limit <= 0:
+            yield self
+            return
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._cond.notify()
+
+    def throttled(self):
+        """The upstream is overloaded, back off."""
+        with self._cond:
+            self.limit = max(self.min_limit, self.limit * self.decrease)
+
+    def succeeded(self):
+        """The upstream keeps up, probe for more throughput."""
+        with self._cond:
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self._cond.notify()
+
+
+class AsyncAdaptiveConcurrency(AdaptiveConcurrency):
+    """`AdaptiveConcurrency` for the coroutines of a single event loop.
+
+    `slot` is an asynchronous context manager; the waiting coroutines do not
+    block the loop.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, decrease: float = 0.5):
+        super().__init__(max_limit, min_limit, decrease)
+        # created on the first use, within the running loop
+        self._released: asyncio.Condition | None = None
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[AsyncAdaptiveConcurrency]:
+        if self.max_limit <= 0:
+            yield self
+            return
+        if self._released is None:
+            # imported here, the sync clients and the CLI do not need asyncio
+            import asyncio
+
+            self._released = asyncio.Condition()
+        async with self._released:
+            await self._released.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        try:
+            yield self
+        finally:
+            async with self._released:
+                self.in_flight -= 1
+                self._released.notify()
+
+
+class AdaptiveBulkSize:
+    """Number of records per bulk, adapted to the upstream with AIMD.
+
+    The size is cut by `decrease` whenever the upstream rejects a bulk (400,
+    413) or does not answer it in time, and grows by `increase` records with
+    every bulk delivered within `target_latency`, up to `max_records`.
+
+    :param int max_records: Upper bound of the size.
+    :param int max_bytes: Maximum size (in bytes) of an uncompressed bulk
+        body; 0 disables the limit.
+    :param float target_latency: Delivery time (in seconds) of a bulk up to
+        which the size grows.
+    :param int min_records: Lower bound of the size.
+    :param float decrease: Factor the size of a rejected bulk is multiplied by.
+    :param (int | None) increase: Number of records the size grows by
+        (default: 5% of `max_records`).
+    """
+
+    def __init__(
+        self,
+        max_records: int,
+        max_bytes: int = 0,
+        target_latency: float = 1.0,
+        min_records: int = 1,
+        decrease: float = 0.5,
+        increase: int | None = None,
+    ):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.min_records = min_records
+        self.decrease = decrease
+        self.increase = increase or max(1, max_records // 20)
+        self.limit = float(max_records)
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        """Current maximum number of records in a bulk."""
+        return max(self.min_records, int(self.limit))
+
+    def shrink(self, rejected: int):
+        """A bulk of `rejected` records failed, make the next ones smaller.
+
+        The new size is derived from the failed bulk, so bulks that were in
+        flight together and failed for the same reason cut it only once.
+        """
+        with self._lock:
+            self.limit = max(
+                self.min_records, min(self.limit, rejected * self.decrease)
+            )
+
+    def succeeded(self, latency: float):
+        """A bulk was delivered in `latency` seconds, grow if it was fast."""
+        if latency > self.target_latency:
+            return
+        with self._lock:
+            self.limit = min(self.max_records, self.limit + self.increase)
+
+
+@dataclass
+class RetryPolicy:
+    """Exponential backoff with full jitter.
+
+    :param int attempts: Number of requests sent before giving up.
+    :param float base_delay: Delay (in seconds) of the first retry.
+    :param float max_delay: Upper bound of the backoff delay.
+    :param float max_retry_after: Upper bound of a `Retry-After` delay.
+    """
+
+    attempts: int = 3
+    base_delay: float = 0.1
+    max_delay: float = 10.0
+    max_retry_after: float = 60.0
+
+    @classmethod
+    def from_env(cls) -> RetryPolicy:
+        """Create a policy configured by the environment variables."""
+        return cls(
+            attempts=int(os.getenv("SHOW_ADS_RETRY_ATTEMPTS", 3)),
+            base_delay=float(os.getenv("SHOW_ADS_RETRY_BASE_DELAY", 0.1)),
+            max_delay=float(os.getenv("SHOW_ADS_RETRY_MAX_DELAY", 10.0)),
+        )
+
+    def delay(self, attempt: int, retry_after: str | None = None) -> float:
+        """Delay (in seconds) before the next attempt.
+
+        :param int attempt: Number of the failed attempt, starting from 0.
+        :param (str | None) retry_after: Value of the `Retry-After` header;
+            it takes precedence over the backoff.
+        :return: The delay.
+        :rtype: float
+        """
+        seconds = parse_retry_after(retry_after)
+        if seconds is not None:
+            return min(seconds, self.max_retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parse a `Retry-After` header, given either in seconds or as a date.
+
+    :return: Number of seconds to wait; None if the value is missing or invalid.
+    :rtype: float | None
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
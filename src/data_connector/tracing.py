@@ -0,0 +1,489 @@
+from __future__ import annotations
+
+import cProfile
+import functools
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# kinds of the spans, see the OpenTelemetry trace protocol
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+# finished spans of a trace are written once there are this many of them
+EXPORT_BATCH = 1000
+
+LOG_FORMAT = "[%(asctime)s] - %(levelname)s - [%(request_id)s] - %(message)s"
+REQUEST_ID_HEADER = "X-Request-ID"
+
+_TRACE_ID = re.compile(r"[0-9a-f]{32}")
+# request IDs taken from the clients, anything else is replaced
+_REQUEST_ID = re.compile(r"[\w.:-]{1,64}")
+
+_request_id: ContextVar[str | None] = ContextVar("request_id", default=None)
+_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+_span: ContextVar[Span | None] = ContextVar("span", default=None)
+
+# the trace file is shared by the threads of the process
+_export_lock = threading.Lock()
+# one profile at a time, the profilers of the threads would get in the way
+_profile_lock = threading.Lock()
+
+
+@dataclass
+class Span:
+    """Timed stage of a request, see `span`."""
+
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str = ""
+    kind: int = SPAN_KIND_INTERNAL
+    attributes: dict[str, Any] = field(default_factory=dict)
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: int = 0
+    error: str | None = None
+
+    def set(self, **attributes: Any):
+        self.attributes.update(attributes)
+
+    def add_time(self, key: str, seconds: float):
+        """Add to a duration attribute, for stages too short for own spans."""
+        self.attributes[key] = self.attributes.get(key, 0.0) + seconds
+
+    def fail(self, message: str):
+        self.error = message
+
+    def to_otlp(self) -> dict[str, Any]:
+        """The span in the OTLP/JSON encoding."""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": (
+                {"code": STATUS_ERROR, "message": self.error}
+                if self.error is not None
+                else {"code": STATUS_OK}
+            ),
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class _NoSpan(Span):
+    """Stands for a span outside of a traced request, records nothing."""
+
+    def set(self, **attributes: Any):
+        pass
+
+    def add_time(self, key: str, seconds: float):
+        pass
+
+    def fail(self, message: str):
+        pass
+
+
+NO_SPAN = _NoSpan("", "", "")
+
+
+class Trace:
+    """Finished spans of a request, written to the trace file in batches.
+
+    The spans are appended to the file as OTLP/JSON lines, one
+    `ExportTraceServiceRequest` per line, like the file exporter of the
+    OpenTelemetry Collector writes them; a long upload is written in several
+    lines that share the trace ID.
+
+    :param Path path: The trace file.
+    :param str trace_id: ID of the trace, 32 hex digits.
+    """
+
+    def __init__(self, path: Path, trace_id: str):
+        self.path = path
+        self.trace_id = trace_id
+        self._spans: list[Span] = []
+        # spans are finished by the threads sending the bulks as well
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self._spans.append(span)
+            if len(self._spans) < EXPORT_BATCH:
+                return
+            spans, self._spans = self._spans, []
+        self._export(spans)
+
+    def flush(self):
+        with self._lock:
+            spans, self._spans = self._spans, []
+        if spans:
+            self._export(spans)
+
+    def _export(self, spans: list[Span]):
+        line = json.dumps(
+            {
+                "resourceSpans": [
+                    {
+                        "resource": {
+                            "attributes": _otlp_attributes(
+                                {
+                                    "service.name": "data-connector",
+                                    "process.pid": os.getpid(),
+                                }
+                            )
+                        },
+                        "scopeSpans": [
+                            {
+                                "scope": {"name": __name__},
+                                "spans": [span.to_otlp() for span in spans],
+                            }
+                        ],
+                    }
+                ]
+            }
+        )
+        try:
+            with _export_lock, open(self.path, "a") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            # the request itself must not fail on the tracing
+            logging.error(f"Failed to write the spans to {self.path}: {e}")
+
+
+def _otlp_attributes(attributes: dict[str, Any]) -> list[dict[str, Any]]:
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            encoded = {"boolValue": value}
+        elif isinstance(value, int):
+            # 64-bit integers are strings in the JSON encoding
+            encoded = {"intValue": str(value)}
+        elif isinstance(value, float):
+            encoded = {"doubleValue": value}
+        else:
+            encoded = {"stringValue": str(value)}
+        result.append({"key": key, "value": encoded})
+    return result
+
+
+def trace_filepath() -> Path | None:
+    """The trace file, `TRACE_FILEPATH` environment variable; None if disabled."""
+    filepath = os.getenv("TRACE_FILEPATH")
+    return Path(filepath) if filepath else None
+
+
+def request_id() -> str | None:
+    """ID of the request (or the job) being processed; None outside of one."""
+    return _request_id.get()
+
+
+def active() -> bool:
+    """Check if the spans of the current request are recorded."""
+    return _trace.get() is not None
+
+
+@contextmanager
+def request(
+    name: str, request_id: str | None = None, **attributes: Any
+) -> Iterator[str]:
+    """Context of a request, a background job or a CLI command.
+
+    The request ID is added to the log records, see `RequestIdFilter`. If
+    `TRACE_FILEPATH` is set, the block is the root span of a trace and the
+    spans of the request are written to the file; the trace ID is the request
+    ID if it has the form of one, so the logs and the traces can be joined.
+
+    :param str name: Name of the root span.
+    :param (str | None) request_id: ID sent by the client, a new one is
+        generated if it is missing or not a safe token.
+    :param Any attributes: Attributes of the root span.
+    :return: The request ID.
+    :rtype: Iterator[str]
+    """
+    if not request_id or not _REQUEST_ID.fullmatch(request_id):
+        request_id = uuid.uuid4().hex
+    id_token = _request_id.set(request_id)
+    try:
+        path = trace_filepath()
+        if path is None:
+            yield request_id
+            return
+        trace_id = request_id
+        if not _TRACE_ID.fullmatch(trace_id):
+            trace_id = uuid.uuid4().hex
+        trace = Trace(path, trace_id)
+        trace_token = _trace.set(trace)
+        try:
+            with span(
+                name, SPAN_KIND_SERVER, **{"request.id": request_id, **attributes}
+            ):
+                yield request_id
+        finally:
+            _trace.reset(trace_token)
+            trace.flush()
+    finally:
+        _request_id.reset(id_token)
+
+
+@contextmanager
+def span(
+    name: str, kind: int = SPAN_KIND_INTERNAL, **attributes: Any
+) -> Iterator[Span]:
+    """Time a stage of the current request.
+
+    The span is a child of the innermost open span. Outside of a traced
+    request nothing is recorded and `NO_SPAN` is given, so the call sites do
+    not check whether the tracing is enabled.
+
+    :param str name: Name of the stage.
+    :param int kind: Kind of the span, `SPAN_KIND_CLIENT` for upstream calls.
+    :param Any attributes: Attributes of the span.
+    :return: The span; its attributes can be set until it ends.
+    :rtype: Iterator[Span]
+    """
+    trace = _trace.get()
+    if trace is None:
+        yield NO_SPAN
+        return
+    parent = _span.get()
+    current = Span(
+        name,
+        trace.trace_id,
+        uuid.uuid4().hex[:16],
+        parent.span_id if parent is not None else "",
+        kind,
+        attributes,
+    )
+    token = _span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.fail(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _span.reset(token)
+        current.end_ns = time.time_ns()
+        trace.add(current)
+
+
+def traced(items: Iterable[T], name: str) -> Iterator[T]:
+    """Yield the items, time the production of every item in a span.
+
+    Meant for lazy pipelines, e.g. the bulks read from an upload: the span
+    covers the parsing and the validation of the records of a bulk. The
+    span of the last step, which finds out there are no more items, is
+    recorded as well.
+
+    :param Iterable[T] items: The items.
+    :param str name: Name of the spans.
+    :return: Iterator of the items.
+    :rtype: Iterator[T]
+    """
+    if not active():
+        yield from items
+        return
+    it = iter(items)
+    end = object()
+    while True:
+        with span(name) as current:
+            item = next(it, end)
+            if item is not end and hasattr(item, "__len__"):
+                current.set(records=len(item))
+        if item is end:
+            return
+        yield item
+
+
+def timed(function: Callable[..., T], key: str) -> Callable[..., T]:
+    """Add the time spent in `function` to the `key` attribute of the open span.
+
+    For functions called once per row, where a span per call would cost
+    more than the call itself; only wrap them when `active`.
+
+    :param Callable function: The function.
+    :param str key: Name of the attribute, in seconds.
+    :return: The wrapped function.
+    :rtype: Callable
+    """
+
+    def wrapper(*args: Any, **kwargs: Any) -> T:
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current = _span.get()
+            if current is not None:
+                current.add_time(key, time.perf_counter() - started)
+
+    return wrapper
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds the `request_id` attribute to the log records, "-" outside a request."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get() or "-"
+        return True
+
+
+def install_log_filter(logger: logging.Logger | None = None):
+    """Add `RequestIdFilter` to the handlers of the logger (default: root)."""
+    for handler in (logger or logging.getLogger()).handlers:
+        handler.addFilter(RequestIdFilter())
+
+
+def profile_dirpath() -> Path | None:
+    """Directory of the profiles, `PROFILE_DIRPATH` environment variable."""
+    dirpath = os.getenv("PROFILE_DIRPATH")
+    return Path(dirpath) if dirpath else None
+
+
+@contextmanager
+def profiled(name: str) -> Iterator[Path | None]:
+    """Profile the block with cProfile if `PROFILE_DIRPATH` is set.
+
+    Only a sample of the blocks is profiled, `PROFILE_SAMPLE_RATE`
+    environment variable (default: 1, all of them), and only one at a time;
+    the others run without the profiler overhead. The statistics are written
+    to `{PROFILE_DIRPATH}/{name}_{request ID}.prof`, readable by `pstats`.
+    The profiler follows the thread that enters the block, the bulks sent by
+    the worker threads show up as the time spent waiting for them.
+
+    :param str name: Name of the profiled operation, e.g. `bulk`.
+    :return: Path of the profile; None if the block is not profiled.
+    :rtype: Iterator[Path | None]
+    """
+    dirpath = profile_dirpath()
+    rate = float(os.getenv("PROFILE_SAMPLE_RATE", 1))
+    if dirpath is None or random.random() >= rate:
+        yield None
+        return
+    if not _profile_lock.acquire(blocking=False):
+        logging.debug(f"Profile of {name} skipped, another one is running.")
+        yield None
+        return
+    try:
+        path = dirpath / f"{name}_{request_id() or uuid.uuid4().hex}.prof"
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield path
+        finally:
+            profiler.disable()
+            dirpath.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(path)
+            logging.info(f"Profile of {name} written to {path}.")
+    finally:
+        _profile_lock.release()
+
+
+def traced_command(name: str) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Run a CLI command in a `request` context and `profiled`.
+
+    :param str name: Name of the command, used for the root span and the
+        profile.
+    :return: The decorator.
+    :rtype: Callable
+    """
+
+    def decorator(function: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> T:
+            with request(name), profiled(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class WSGIMiddleware:
+    """Runs every request of a WSGI app in a `request` context.
+
+    The request ID is taken from the `X-Request-ID` header and returned in
+    the same header of the response.
+
+    :param Callable app: The WSGI app.
+    """
+
+    def __init__(self, app: Callable):
+        self.app = app
+
+    def __call__(self, environ: dict[str, Any], start_response: Callable):
+        method = environ.get("REQUEST_METHOD", "")
+        path = environ.get("PATH_INFO", "")
+        with request(
+            f"{method} {path}",
+            environ.get("HTTP_X_REQUEST_ID"),
+            **{"http.method": method, "http.target": path},
+        ) as rid:
+            root = _span.get()
+
+            def start(status: str, headers: list, exc_info: Any = None):
+                if root is not None:
+                    root.set(**{"http.status_code": int(status.split()[0])})
+                return start_response(
+                    status, [*headers, (REQUEST_ID_HEADER, rid)], exc_info
+                )
+
+            # the body is produced by the handler, the response is complete
+            return self.app(environ, start)
+
+
+class ASGIMiddleware:
+    """Runs every HTTP request of an ASGI app in a `request` context.
+
+    Counterpart of `WSGIMiddleware`.
+
+    :param Callable app: The ASGI app.
+    """
+
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope: dict[str, Any], receive: Callable, send: Callable):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        sent_id = headers.get(REQUEST_ID_HEADER.lower().encode())
+        method, path = scope["method"], scope["path"]
+        with request(
+            f"{method} {path}",
+            sent_id.decode(errors="replace") if sent_id else None,
+            **{"http.method": method, "http.target": path},
+        ) as rid:
+            root = _span.get()
+
+            async def send_with_id(message: dict[str, Any]):
+                if message["type"] == "http.response.start":
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (REQUEST_ID_HEADER.lower().encode(), rid.encode()),
+                    ]
+                    if root is not None:
+                        root.set(**{"http.status_code": message["status"]})
+                await send(message)
+
+            await self.app(scope, receive, send_with_id)
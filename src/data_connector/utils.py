@@ -1,11 +1,25 @@
 from __future__ import annotations
 
-import logging
-import os
-from datetime import date
-from pathlib import Path
+import gzip
+import io
+import json
+from dataclasses import dataclass
+from functools import lru_cache
+from importlib.util import find_spec
+from itertools import islice
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, TypeVar
 
-from data_connector.record import Record
+from data_connector import tracing
+from data_connector.encoder import BULK_ENVELOPE_BYTES, record_bytes
+from data_connector.metrics import ParseTally
+from data_connector.record import Record, RecordBatch, ValidationPolicy
+from data_connector.spill import get_spill_store
+from data_connector.throttle import AdaptiveBulkSize
+
+T = TypeVar("T")
+
+# number of Parquet rows converted to records at once
+PARQUET_BATCH_SIZE = 64 * 1024
 
 
 def parse_line(line: str) -> Record | None:
@@ -18,38 +32,436 @@ def parse_line(line: str) -> Record | None:
     """
     data = line.strip().split(",")
 
-    # can throw an exception
+    # can throw an exception; nothing is logged, this runs for every row
+    try:
+        return Record(data[0], int(data[1]), data[2], int(data[3]))
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def parse_file(
+    file, policy: ValidationPolicy, first_line: int = 1
+) -> Iterator[Record]:
+    """Parse a file and lazily yield the records that pass the validation.
+
+    The file is read line by line, so only the line being processed is held
+    in memory no matter how big the file is. Lines that cannot be parsed are
+    counted as `format` rejections of the policy; the rejections are reported
+    by the policy, see `ValidationPolicy.report`.
+
+    :param file: File opened in binary mode.
+    :param ValidationPolicy policy: Validation rules of the records.
+    :param int first_line: Number of the first line, if the file is not read
+        from its beginning.
+    :return: Iterator of the valid records.
+    :rtype: Iterator[Record]
+    """
+    tally = ParseTally(policy.rejections)
+    check = policy.check
+    if tracing.active():
+        # the rows are validated one by one, the time adds up in the open span
+        check = tracing.timed(check, "validate.seconds")
     try:
-        rec = Record(data[0], int(data[1]), data[2], int(data[3]))
-        logging.info(f"Record {rec.cookie} loaded.")
-        return rec
+        for number, line in enumerate(file, first_line):
+            tally.add()
+            text = line.decode().strip()
+            rec = parse_line(text)
+            if rec is None:
+                policy.reject("format", number, row=text)
+            elif check(rec, number):
+                yield rec
+    finally:
+        tally.flush()
+
+
+def _to_record(name, age, cookie, banner_id) -> Record | None:
+    """Build a record from the values of a JSON object or a Parquet row."""
+    if not isinstance(name, str) or not isinstance(cookie, str):
+        return None
+    try:
+        return Record(name, int(age), cookie, int(banner_id))
     except (TypeError, ValueError):
-        logging.warning(f"Error while parsing data: {data}")
         return None
 
 
-def parse_file(file, min_age: int | None, max_age: int | None) -> list[Record]:
-    """Parse a file and return a buffer of records."""
-    buffer: list[Record] = []
-    for line in file:
-        rec = parse_line(line.decode().strip())
-        if rec and rec.validate(min_age, max_age):
-            buffer.append(rec)
-    return buffer
+def record_from_json(data: Any) -> Record | None:
+    """Build a record from a JSON object with the keys of `/send_record`.
+
+    :param Any data: The decoded JSON value.
+    :return: The record; None if the value is not an object with the `name`,
+        `age`, `cookie` and `banner_id` keys of the right types.
+    :rtype: Record | None
+    """
+    try:
+        return _to_record(
+            data["name"], data["age"], data["cookie"], data["banner_id"]
+        )
+    except (KeyError, TypeError):
+        return None
+
+
+def parse_ndjson(file, policy: ValidationPolicy) -> Iterator[Record]:
+    """Counterpart of `parse_file` for newline delimited JSON.
+
+    Every line holds one object with the `name`, `age`, `cookie` and
+    `banner_id` keys, the same as the body of `/send_record`. Empty lines are
+    skipped.
+
+    :param file: File opened in binary mode.
+    :param ValidationPolicy policy: Validation rules of the records.
+    :return: Iterator of the valid records.
+    :rtype: Iterator[Record]
+    """
+    tally = ParseTally(policy.rejections)
+    try:
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            tally.add()
+            try:
+                rec = record_from_json(json.loads(line))
+            except ValueError:
+                rec = None
+            if rec is None:
+                text = line.decode(errors="replace").strip()
+                policy.reject("format", number, row=text)
+            elif policy.check(rec, number):
+                yield rec
+    finally:
+        tally.flush()
+
+
+def _parquet_columns(names: list[str]) -> list[str | None]:
+    """Columns holding the name, age, cookie and banner ID, None if missing.
+
+    The names are matched regardless of the case and underscores, so both
+    `banner_id` and `BannerId` (the CSV header) are found.
+    """
+    columns = {name.lower().replace("_", ""): name for name in names}
+    return [columns.get(key) for key in ("name", "age", "cookie", "bannerid")]
+
+
+def parse_parquet(file, policy: ValidationPolicy) -> Iterator[Record]:
+    """Counterpart of `parse_file` for Parquet files, requires `pyarrow`.
+
+    The file is read one row group at a time, in batches of
+    `PARQUET_BATCH_SIZE` rows; rows with a missing column or a null value are
+    counted as `format` rejections. The line numbers are the row numbers,
+    starting at 1.
+
+    :param file: Seekable file opened in binary mode.
+    :param ValidationPolicy policy: Validation rules of the records.
+    :return: Iterator of the valid records.
+    :rtype: Iterator[Record]
+    """
+    import pyarrow.parquet as pq  # optional dependency, imported on first use
+
+    tally = ParseTally(policy.rejections)
+    parquet = pq.ParquetFile(file)
+    columns = _parquet_columns(parquet.schema_arrow.names)
+    number = 0
+    try:
+        for batch in parquet.iter_batches(
+            batch_size=PARQUET_BATCH_SIZE,
+            columns=[column for column in columns if column is not None],
+        ):
+            values = [
+                batch.column(column).to_pylist() if column else [None] * len(batch)
+                for column in columns
+            ]
+            tally.add(len(batch))
+            for row in zip(*values):
+                number += 1
+                rec = _to_record(*row)
+                if rec is None:
+                    policy.reject("format", number, row=",".join(map(str, row)))
+                elif policy.check(rec, number):
+                    yield rec
+    finally:
+        tally.flush()
+
+
+def _gunzip(file: BinaryIO) -> BinaryIO:
+    return gzip.GzipFile(fileobj=file, mode="rb")
+
+
+def _unzstd(file: BinaryIO) -> BinaryIO:
+    import zstandard  # optional dependency, imported on first use
+
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        file, read_across_frames=True, closefd=False
+    )
+    # the decompressing reader cannot be iterated by lines
+    return io.BufferedReader(reader)
+
+
+def _decompressed(
+    decompress: Callable[[BinaryIO], BinaryIO],
+    parse: Callable[[BinaryIO, ValidationPolicy], Iterator[Record]],
+) -> Callable[[BinaryIO, ValidationPolicy], Iterator[Record]]:
+    """Parser of a compressed file, decompressed as it is read."""
+
+    def parse_decompressed(
+        file: BinaryIO, policy: ValidationPolicy
+    ) -> Iterator[Record]:
+        with decompress(file) as stream:
+            yield from parse(stream, policy)
+
+    return parse_decompressed
+
+
+def batched(iterable: Iterable[T], size: int) -> Iterator[list[T]]:
+    """Split an iterable into lists of at most `size` items.
+
+    The items are consumed lazily; a batch is yielded as soon as it fills up.
+    An empty iterable yields no batches.
+
+    :param Iterable[T] iterable: Source of the items.
+    :param int size: Maximum number of items in a batch.
+    :return: Iterator of the batches.
+    :rtype: Iterator[list[T]]
+    """
+    it = iter(iterable)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+def batched_records(records: Iterable[Record], size: int) -> Iterator[RecordBatch]:
+    """Collect records into column-wise batches of at most `size` records.
+
+    Same as `batched`, but the records are not kept as objects once they are
+    added to a batch.
+
+    :param Iterable[Record] records: Source of the records.
+    :param int size: Maximum number of records in a batch.
+    :return: Iterator of the batches.
+    :rtype: Iterator[RecordBatch]
+    """
+    batch = RecordBatch()
+    for rec in records:
+        batch.append(rec)
+        if len(batch) >= size:
+            yield batch
+            batch = RecordBatch()
+    if len(batch):
+        yield batch
+
+
+def adaptive_batches(
+    records: Iterable[Record], sizer: AdaptiveBulkSize
+) -> Iterator[RecordBatch]:
+    """Collect records into column-wise batches sized by `sizer`.
+
+    A batch is cut once it holds `sizer.size` records, or before a record
+    that would take its body over `sizer.max_bytes`. The size is read again
+    for every batch, so it follows the responses of the upstream. An empty
+    batch is never yielded.
+
+    :param Iterable[Record] records: Source of the records.
+    :param AdaptiveBulkSize sizer: The bulk size.
+    :return: Iterator of the batches.
+    :rtype: Iterator[RecordBatch]
+    """
+    batch = RecordBatch()
+    nbytes = BULK_ENVELOPE_BYTES
+    limit = sizer.size
+    for rec in records:
+        if sizer.max_bytes:
+            rec_bytes = record_bytes(rec.cookie, rec.banner_id)
+            if len(batch) and nbytes + rec_bytes > sizer.max_bytes:
+                yield batch
+                batch, nbytes, limit = RecordBatch(), BULK_ENVELOPE_BYTES, sizer.size
+            nbytes += rec_bytes
+        batch.append(rec)
+        if len(batch) >= limit:
+            yield batch
+            batch, nbytes, limit = RecordBatch(), BULK_ENVELOPE_BYTES, sizer.size
+    if len(batch):
+        yield batch
+
+
+def split_batch(
+    batch: RecordBatch, max_records: int, max_bytes: int = 0
+) -> Iterator[RecordBatch]:
+    """Split a batch into parts of at most `max_records` records.
+
+    The body of every part is kept under `max_bytes` (0 disables the limit);
+    a record over the limit on its own makes a part of one record.
+
+    :param RecordBatch batch: The batch to split.
+    :param int max_records: Maximum number of records in a part.
+    :param int max_bytes: Maximum size of an uncompressed bulk body.
+    :return: Iterator of the parts, the batch itself if it fits; nothing if
+        the batch is empty.
+    :rtype: Iterator[RecordBatch]
+    """
+    if not len(batch):
+        return
+    if len(batch) <= max_records and not max_bytes:
+        yield batch
+        return
+    start = 0
+    nbytes = BULK_ENVELOPE_BYTES
+    for i, (cookie, banner_id) in enumerate(zip(batch.cookies, batch.banner_ids)):
+        rec_bytes = record_bytes(cookie, banner_id) if max_bytes else 0
+        if i > start and (
+            i - start >= max_records or (max_bytes and nbytes + rec_bytes > max_bytes)
+        ):
+            yield batch.slice(start, i)
+            start, nbytes = i, BULK_ENVELOPE_BYTES
+        nbytes += rec_bytes
+    if start == 0:
+        yield batch
+    elif start < len(batch):
+        yield batch.slice(start, len(batch))
+
+
+@lru_cache(maxsize=None)
+def _installed(module: str) -> bool:
+    return find_spec(module) is not None
+
+
+@dataclass(frozen=True)
+class Reader:
+    """Parser of one input format, see `find_reader`.
+
+    :param str name: Name of the format.
+    :param tuple[str, ...] extensions: File name suffixes of the format.
+    :param tuple[str, ...] content_types: Media types of the format.
+    :param Callable parse: Lazily yields the valid records of a file opened in
+        binary mode, same as `parse_file`.
+    :param bool seekable: The parser seeks in the file, it cannot read an
+        upload as it arrives.
+    :param (str | None) requires: Optional module the parser needs.
+    """
+
+    name: str
+    extensions: tuple[str, ...]
+    content_types: tuple[str, ...]
+    parse: Callable[[BinaryIO, ValidationPolicy], Iterator[Record]]
+    seekable: bool = False
+    requires: str | None = None
+
+    @property
+    def available(self) -> bool:
+        return self.requires is None or _installed(self.requires)
+
+
+READERS: list[Reader] = []
+
+
+def register_reader(reader: Reader):
+    """Add an input format accepted by the endpoints and the CLI."""
+    READERS.append(reader)
+
+
+def find_reader(filename: str, content_type: str | None = None) -> Reader | None:
+    """Pick the reader of a file by its name, or by its content type.
+
+    The longest matching file name suffix wins (`.csv.gz` over `.csv`); the
+    content type is used only if the name does not match any reader. Readers
+    whose optional module is not installed are skipped.
+
+    :param str filename: Name of the file.
+    :param (str | None) content_type: Media type of the file, if known.
+    :return: The reader; None if the format is not supported.
+    :rtype: Reader | None
+    """
+    name = filename.lower()
+    matches = [
+        (len(extension), reader)
+        for reader in READERS
+        for extension in reader.extensions
+        if name.endswith(extension) and reader.available
+    ]
+    if matches:
+        return max(matches, key=lambda match: match[0])[1]
+    if content_type:
+        content_type = content_type.split(";", 1)[0].strip().lower()
+        for reader in READERS:
+            if content_type in reader.content_types and reader.available:
+                return reader
+    return None
+
+
+def supported_formats() -> str:
+    """Comma separated names of the accepted formats."""
+    return ", ".join(reader.name for reader in READERS if reader.available)
+
+
+CSV_READER = Reader("csv", (".csv",), ("text/csv", "application/csv"), parse_file)
+register_reader(CSV_READER)
+register_reader(
+    Reader(
+        "csv.gz",
+        (".csv.gz",),
+        ("application/gzip", "application/x-gzip"),
+        _decompressed(_gunzip, parse_file),
+    )
+)
+register_reader(
+    Reader(
+        "csv.zst",
+        (".csv.zst", ".csv.zstd"),
+        ("application/zstd",),
+        _decompressed(_unzstd, parse_file),
+        requires="zstandard",
+    )
+)
+NDJSON_READER = Reader(
+    "ndjson",
+    (".ndjson", ".jsonl"),
+    ("application/x-ndjson", "application/ndjson", "application/jsonl"),
+    parse_ndjson,
+)
+register_reader(NDJSON_READER)
+register_reader(
+    Reader(
+        "ndjson.gz",
+        (".ndjson.gz", ".jsonl.gz"),
+        (),
+        _decompressed(_gunzip, parse_ndjson),
+    )
+)
+register_reader(
+    Reader(
+        "ndjson.zst",
+        (".ndjson.zst", ".jsonl.zst"),
+        (),
+        _decompressed(_unzstd, parse_ndjson),
+        requires="zstandard",
+    )
+)
+register_reader(
+    Reader(
+        "parquet",
+        (".parquet",),
+        ("application/vnd.apache.parquet", "application/x-parquet"),
+        parse_parquet,
+        seekable=True,
+        requires="pyarrow",
+    )
+)
 
 
 def allowed_file_extension(filename: str) -> bool:
-    """Check if the given file is CSV format."""
-    return "." in filename and filename.rsplit(".", 1)[1].lower() == "csv"
+    """Check if a reader of the file format is registered, see `find_reader`."""
+    return find_reader(filename) is not None
 
 
-def store_unsent_records(lof_records: list[Record]):
+def store_unsent_records(lof_records: Iterable[Record]):
     """Save (unsent) records to the CSV file for later resend.
 
-    The data are stored in a file at `FAILED_RECORDS_DIRPATH/unsent_{date}.csv`.
+    The data are stored in a file at `FAILED_RECORDS_DIRPATH/unsent_{date}.csv`,
+    see `SpillStore`.
+    """
+    get_spill_store().append(lof_records)
+
+
+def store_rejected_records(lof_records: Iterable[Record], reasons: Iterable[str]):
+    """Save records the ShowAds API refused, with the reasons.
+
+    The data are stored in a file at `FAILED_RECORDS_DIRPATH/rejected_{date}.csv`,
+    they are not resent, see `SpillStore.append_rejected`.
     """
-    failed_records_dirpath = os.getenv("FAILED_RECORDS_DIRPATH", "/tmp")
-    filepath = Path(f"{failed_records_dirpath}") / f"unsent_{date.today()}.csv"
-    with open(filepath, "a+") as f:
-        for record in lof_records:
-            f.write(f"{record.to_csv_string()}\n")
+    get_spill_store().append_rejected(lof_records, reasons)
@@ -4,13 +4,16 @@ import logging
 import os
 
 from data_connector import create_app
+from data_connector.tracing import LOG_FORMAT, install_log_filter
 
 # set logging level
 log = logging.getLogger(__name__)
 level = os.getenv('LOGLEVEL', 'WARNING').upper()
 if level not in {'DEBUG', "INFO", "WARNING", "ERROR", "CRITICAL"}:
     level="WARNING"
-logging.basicConfig(level=level, format="[%(asctime)s] - %(levelname)s - %(message)s")
+logging.basicConfig(level=level, format=LOG_FORMAT)
+# the ID of the request being processed, see LOG_FORMAT
+install_log_filter()
 
 # required environment varilables check
 if not os.getenv("API_URL"):
@@ -9,7 +9,7 @@ import requests_mock
 from flask import Flask
 from flask.testing import FlaskClient, FlaskCliRunner
 
-from data_connector.show_ads_api_wrapper import OPT_DICT
+from data_connector.show_ads_api_wrapper import set_client
 from data_connector import create_app
 
 
@@ -33,8 +33,8 @@ def bulk_callback(request: requests.Request, context: requests_mock.Context) ->
 
 @pytest.fixture
 def mock_ok() -> Iterator[requests_mock.Mocker]:
-    # nullify the token
-    OPT_DICT["access_token"] = ""
+    # start with a fresh client without a token
+    set_client(None)
 
     mock = requests_mock.Mocker()
     mock.register_uri(
@@ -51,8 +51,8 @@ def mock_ok() -> Iterator[requests_mock.Mocker]:
 
 @pytest.fixture
 def mock_fail() -> Iterator[requests_mock.Mocker]:
-    # nullify the token
-    OPT_DICT["access_token"] = ""
+    # start with a fresh client without a token
+    set_client(None)
 
     mock = requests_mock.Mocker()
     mock.register_uri("POST", f"{os.getenv('API_URL')}/auth", json={}, status_code=500)
@@ -71,6 +71,31 @@ def app() -> Iterator[Flask]:
     yield app
 
 
+@pytest.fixture
+def coalescing_app(monkeypatch) -> Iterator[Flask]:
+    monkeypatch.setenv("COALESCE_RECORDS", "1")
+    monkeypatch.setenv("COALESCE_FLUSH_MS", "20")
+    app = create_app()
+    yield app
+    app.extensions["record_coalescer"].close()
+
+
+@pytest.fixture
+def jobs_app(monkeypatch, tmp_path) -> Iterator[Flask]:
+    monkeypatch.setenv("BULK_JOB_WORKERS", "2")
+    monkeypatch.setenv("BULK_JOB_SPOOL_DIRPATH", str(tmp_path))
+    app = create_app()
+    yield app
+    app.extensions["bulk_jobs"].shutdown()
+
+
+@pytest.fixture
+def streaming_app(monkeypatch) -> Iterator[Flask]:
+    monkeypatch.setenv("BULK_STREAM_UPLOADS", "1")
+    app = create_app()
+    yield app
+
+
 @pytest.fixture
 def client(app: Flask) -> FlaskClient:
     return app.test_client()
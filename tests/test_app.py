@@ -1,9 +1,17 @@
+import gzip
+import io
+import json
+import time
 from pathlib import Path
 
+import pytest
 from flask.testing import FlaskCliRunner
 from flask_restx.api import HTTPStatus
 
-from data_connector.commands import upload_file
+from data_connector.commands import replay_unsent_records, upload_file
+from data_connector.record import Record
+from data_connector.spill import get_spill_store
+from data_connector.utils import READERS, Reader
 
 
 def test_send_record_api(client, mock_ok):
@@ -40,6 +48,22 @@ def test_send_record_api(client, mock_ok):
         assert "did not pass" in res.json["message"]
 
 
+def test_send_record_api_coalesced(coalescing_app, mock_ok):
+    client = coalescing_app.test_client()
+    coalescer = coalescing_app.extensions["record_coalescer"]
+    with mock_ok as mock:
+        for i in range(5):
+            res = client.post(
+                "/send_record",
+                json={"name": "Mario", "age": 18, "cookie": f"id{i}", "banner_id": 10},
+            )
+            assert res.status_code == HTTPStatus.ACCEPTED
+            assert res.json["message"] == f"Record id{i} queued for sending to ShowAPI."
+        coalescer.close()
+        assert coalescer.sent == 5
+        assert not any(r.path == "/banners/show" for r in mock.request_history)
+
+
 def test_send_bulk_api(client, mock_ok):
     filepath = Path(__file__).parent / "resources" / "test_data.csv"
     dummy = Path(__file__).parent / "resources" / "dummy.txt"
@@ -52,6 +76,21 @@ def test_send_bulk_api(client, mock_ok):
             res = client.post("/send_record/bulk", data={"file": (f, str(filepath))})
             assert res.status_code == HTTPStatus.ACCEPTED
             assert res.json["sent"] == 3
+            report = res.json["rejections"]
+            assert report["rejected"] == 5
+            assert report["rules"] == {"format": 1, "name": 2, "age": 1, "banner_id": 1}
+            assert report["examples"][0] == {
+                "rule": "format",
+                "message": "Malformed row.",
+                "line": 1,
+                "row": "Name,Age,Cookie,BannerId",
+            }
+            assert report["examples"][1] == {
+                "rule": "name",
+                "message": "An invalid name.",
+                "line": 2,
+                "cookie": "dddd",
+            }
 
         with open(filepath, "rb") as f:
             res = client.post(
@@ -76,7 +115,261 @@ def test_send_bulk_api(client, mock_ok):
             assert res.json["sent"] == 0
 
 
-def test_cli_upload_file(cli: FlaskCliRunner, mock_ok):
+def test_send_bulk_api_formats(client, mock_ok):
+    filepath = Path(__file__).parent / "resources" / "test_data.csv"
+    ndjson = "\n".join(
+        json.dumps({"name": "K M Valid", "age": age, "cookie": "id", "banner_id": 1})
+        for age in (17, 25, 40)
+    ).encode()
+    with mock_ok:
+        data = gzip.compress(filepath.read_bytes())
+        res = client.post(
+            "/send_record/bulk", data={"file": (io.BytesIO(data), "data.csv.gz")}
+        )
+        assert res.status_code == HTTPStatus.ACCEPTED
+        assert res.json["sent"] == 3
+
+        # picked by the content type of the file part
+        res = client.post(
+            "/send_record/bulk",
+            data={"file": (io.BytesIO(ndjson), "export", "application/x-ndjson")},
+        )
+        assert res.status_code == HTTPStatus.ACCEPTED
+        assert res.json["sent"] == 2
+        assert res.json["rejections"]["rules"] == {"age": 1}
+
+        res = client.post(
+            "/send_record/bulk",
+            data={"file": (io.BytesIO(ndjson), "export", "application/octet-stream")},
+        )
+        assert res.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+        assert "ndjson" in res.json["message"]
+
+
+def _encode_upload(reader: Reader, rows: list[tuple]) -> bytes:
+    """File of the rows in the format of the reader."""
+    if reader.name == "parquet":
+        pa = pytest.importorskip("pyarrow")
+        pq = pytest.importorskip("pyarrow.parquet")
+        columns = zip(*rows)
+        table = pa.table(dict(zip(("name", "age", "cookie", "banner_id"), columns)))
+        parquet = io.BytesIO()
+        pq.write_table(table, parquet)
+        return parquet.getvalue()
+    if reader.name.startswith("ndjson"):
+        keys = ("name", "age", "cookie", "banner_id")
+        data = "".join(json.dumps(dict(zip(keys, row))) + "\n" for row in rows)
+    else:
+        data = "".join(",".join(map(str, row)) + "\n" for row in rows)
+    if reader.name.endswith(".gz"):
+        return gzip.compress(data.encode())
+    if reader.name.endswith(".zst"):
+        zstandard = pytest.importorskip("zstandard")
+        return zstandard.ZstdCompressor().compress(data.encode())
+    return data.encode()
+
+
+@pytest.mark.parametrize("reader", READERS, ids=lambda reader: reader.name)
+def test_send_bulk_api_streamed_formats(streaming_app, mock_ok, reader):
+    if not reader.available:
+        pytest.skip(f"{reader.requires} is not installed")
+    client = streaming_app.test_client()
+    rows = [("K M Valid", 25, f"a{i}", 1) for i in range(2000)] + [
+        ("K B Valid", 17, "b", 2)
+    ]
+    data = _encode_upload(reader, rows)
+    with mock_ok:
+        res = client.post(
+            "/send_record/bulk",
+            data={"file": (io.BytesIO(data), f"data{reader.extensions[0]}")},
+        )
+    assert res.status_code == HTTPStatus.ACCEPTED
+    assert res.json["sent"] == 2000
+    assert res.json["rejections"]["rules"] == {"age": 1}
+
+
+def test_send_bulk_api_streamed(streaming_app, mock_ok, caplog):
+    client = streaming_app.test_client()
+    filepath = Path(__file__).parent / "resources" / "test_data.csv"
+    dummy = Path(__file__).parent / "resources" / "dummy.txt"
+    with mock_ok:
+        with open(dummy, "rb") as f:
+            res = client.post("/send_record/bulk", data={"file": (f, str(dummy))})
+            assert res.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+
+        res = client.post("/send_record/bulk", data={"min_age": 30})
+        assert res.status_code == HTTPStatus.BAD_REQUEST
+
+        with open(filepath, "rb") as f:
+            res = client.post("/send_record/bulk", data={"file": (f, str(filepath))})
+            assert res.status_code == HTTPStatus.ACCEPTED
+            assert res.json["sent"] == 3
+
+        # the filters precede the file part
+        with open(filepath, "rb") as f:
+            res = client.post(
+                "/send_record/bulk",
+                data={"min_age": 27, "max_age": 30, "file": (f, str(filepath))},
+            )
+            assert res.status_code == HTTPStatus.ACCEPTED
+            assert res.json["sent"] == 0
+
+        with open(filepath, "rb") as f:
+            res = client.post(
+                "/send_record/bulk?max_age=30", data={"file": (f, str(filepath))}
+            )
+            assert res.status_code == HTTPStatus.ACCEPTED
+            assert res.json["sent"] == 2
+
+        # too late to filter the records that were already sent
+        body = (
+            b"--xyz\r\n"
+            b'Content-Disposition: form-data; name="file"; filename="data.csv"\r\n'
+            b"\r\n" + filepath.read_bytes() + b"\r\n"
+            b"--xyz\r\n"
+            b'Content-Disposition: form-data; name="max_age"\r\n'
+            b"\r\n30\r\n"
+            b"--xyz--\r\n"
+        )
+        res = client.post(
+            "/send_record/bulk",
+            data=body,
+            content_type="multipart/form-data; boundary=xyz",
+        )
+        assert res.status_code == HTTPStatus.ACCEPTED
+        assert res.json["sent"] == 3
+        assert "Age filters sent after the file were ignored" in caplog.text
+
+        # the body ends in the middle of the file part
+        data = b"".join(
+            f"Name,{20 + i % 30},cookie{i},{i % 100}\n".encode() for i in range(3000)
+        )
+        body = (
+            b"--xyz\r\n"
+            b'Content-Disposition: form-data; name="file"; filename="data.csv"\r\n'
+            b"\r\n" + data
+        )
+        res = client.post(
+            "/send_record/bulk",
+            data=body,
+            content_type="multipart/form-data; boundary=xyz",
+        )
+        assert res.status_code == HTTPStatus.BAD_REQUEST
+        assert res.json["message"] == "Malformed multipart body."
+
+
+def test_send_bulk_api_streamed_send_error(streaming_app, mock_ok, monkeypatch):
+    client = streaming_app.test_client()
+
+    def broken_send(records):
+        raise ValueError("not a multipart error")
+
+    monkeypatch.setattr("data_connector.api.send_data", broken_send)
+    body = (
+        b"--xyz\r\n"
+        b'Content-Disposition: form-data; name="file"; filename="data.csv"\r\n'
+        b"\r\nName,20,cookie,1\n\r\n--xyz--\r\n"
+    )
+    with mock_ok:
+        res = client.post(
+            "/send_record/bulk",
+            data=body,
+            content_type="multipart/form-data; boundary=xyz",
+        )
+    # only a malformed body is the client's fault
+    assert res.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+def test_send_bulk_api_job(jobs_app, mock_ok):
+    client = jobs_app.test_client()
+    filepath = Path(__file__).parent / "resources" / "test_data.csv"
+    with mock_ok:
+        with open(filepath, "rb") as f:
+            res = client.post("/send_record/bulk", data={"file": (f, str(filepath))})
+        assert res.status_code == HTTPStatus.ACCEPTED
+        job_id = res.json["job_id"]
+        assert res.headers["Location"] == f"/jobs/{job_id}"
+
+        for _ in range(100):
+            res = client.get(f"/jobs/{job_id}")
+            assert res.status_code == HTTPStatus.OK
+            if res.json["status"] == "done":
+                break
+            time.sleep(0.05)
+        # the header line counts as a rejected row
+        assert res.json["status"] == "done"
+        assert res.json["parsed"] == 8
+        assert res.json["rejected"] == 5
+        assert res.json["sent"] == 3
+        assert res.json["spilled"] == 0
+        assert res.json["rejections"]["rules"]["name"] == 2
+
+    res = client.get("/jobs/unknown")
+    assert res.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_send_batch_api(client, mock_ok):
+    records = [
+        {"name": "Mario", "age": 20, "cookie": f"id{i}", "banner_id": 10}
+        for i in range(2500)
+    ]
+    records[1]["age"] = 10
+    records[2] = {"name": "Mario"}
+    with mock_ok as mock:
+        res = client.post("/send_record/batch", json=records)
+        assert res.status_code == HTTPStatus.ACCEPTED
+        assert (res.json["sent"], res.json["failed"]) == (2498, 0)
+        assert res.json["rejections"]["rules"] == {"age": 1, "format": 1}
+        results = res.json["results"]
+        assert len(results) == 2500
+        assert results[0] == {"cookie": "id0", "status": "sent"}
+        assert results[1] == {
+            "cookie": "id1",
+            "status": "rejected",
+            "rule": "age",
+            "message": "Ignored due to age.",
+        }
+        assert results[2]["rule"] == "format"
+        # one upstream request per bulk
+        bulks = [r for r in mock.request_history if r.path == "/banners/show/bulk"]
+        assert [len(r.json()["Data"]) for r in bulks] == [1000, 1000, 498]
+
+        ndjson = "\n".join(json.dumps(rec) for rec in records[:5]) + "\n{broken\n"
+        res = client.post(
+            "/send_record/batch?min_age=25",
+            data=ndjson,
+            content_type="application/x-ndjson",
+        )
+        assert res.status_code == HTTPStatus.ACCEPTED
+        assert res.json["sent"] == 0
+        assert [r["rule"] for r in res.json["results"]] == ["age"] * 2 + [
+            "format",
+            "age",
+            "age",
+            "format",
+        ]
+        assert res.json["rejections"]["examples"][-1]["row"] == "{broken"
+
+        res = client.post("/send_record/batch", json={"name": "Mario"})
+        assert res.status_code == HTTPStatus.BAD_REQUEST
+        res = client.post("/send_record/batch", data="a,b", content_type="text/csv")
+        assert res.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+
+
+def test_send_batch_api_failed_bulk(client, mock_fail, monkeypatch, tmp_path):
+    monkeypatch.setenv("FAILED_RECORDS_DIRPATH", str(tmp_path))
+    records = [
+        {"name": "Mario", "age": 20, "cookie": f"id{i}", "banner_id": 10}
+        for i in range(3)
+    ]
+    with mock_fail:
+        res = client.post("/send_record/batch", json=records)
+    assert res.status_code == HTTPStatus.ACCEPTED
+    assert (res.json["sent"], res.json["failed"]) == (0, 3)
+    assert {r["status"] for r in res.json["results"]} == {"failed"}
+
+
+def test_cli_upload_file(cli: FlaskCliRunner, mock_ok, tmp_path):
     filepath = Path(__file__).parent / "resources" / "test_data.csv"
 
     result = cli.invoke(upload_file, ["file.txt"])
@@ -85,18 +378,58 @@ def test_cli_upload_file(cli: FlaskCliRunner, mock_ok):
     with mock_ok:
         result = cli.invoke(upload_file, [str(filepath)])
         assert result.exit_code == 0
-        assert result.output.strip() == "Successfully sent 3 of records."
+        assert result.output.splitlines() == [
+            "Successfully sent 3 of records.",
+            "Rows 5 rejected (age: 1, banner_id: 1, format: 1, name: 2).",
+            "  line 1: Malformed row. Name,Age,Cookie,BannerId",
+            "  line 2: An invalid name.",
+            "  line 4: An invalid name.",
+            "  line 6: Ignored due to age.",
+            "  line 8: Banner ID out of range.",
+        ]
 
         result = cli.invoke(upload_file, ["-mi", 8, str(filepath)])
         assert result.exit_code == 0
-        assert result.output.strip() == "Successfully sent 4 of records."
+        assert result.output.splitlines()[0] == "Successfully sent 4 of records."
 
         result = cli.invoke(upload_file, ["-ma", 30, str(filepath)])
         assert result.exit_code == 0
         # default min age is set to 18
-        assert result.output.strip() == "Successfully sent 2 of records."
+        assert result.output.splitlines()[0] == "Successfully sent 2 of records."
 
         result = cli.invoke(upload_file, ["-mi", 20, "-ma", 30, str(filepath)])
         assert result.exit_code == 0
         # default min age is set to 18
-        assert result.output.strip() == "Successfully sent 2 of records."
+        assert result.output.splitlines()[0] == "Successfully sent 2 of records."
+
+        result = cli.invoke(upload_file, ["-c", 4, str(filepath)])
+        assert result.exit_code == 0
+        assert result.output.splitlines()[0] == "Successfully sent 3 of records."
+
+        result = cli.invoke(upload_file, ["-w", 3, "-ma", 30, str(filepath)])
+        assert result.exit_code == 0
+        assert result.output.splitlines()[0] == "Successfully sent 2 of records."
+
+        gzipped = tmp_path / "data.csv.gz"
+        gzipped.write_bytes(gzip.compress(filepath.read_bytes()))
+        result = cli.invoke(upload_file, ["-w", 3, str(gzipped)])
+        assert result.exit_code == 0
+        assert result.output.splitlines()[:2] == [
+            "--workers is ignored, csv.gz files are read by one process.",
+            "Successfully sent 3 of records.",
+        ]
+
+
+def test_cli_replay_unsent(cli: FlaskCliRunner, mock_ok, monkeypatch, tmp_path):
+    monkeypatch.setenv("FAILED_RECORDS_DIRPATH", str(tmp_path))
+    store = get_spill_store()
+    store.append(Record("name", 20, f"cookie{i}", 1) for i in range(1500))
+
+    with mock_ok:
+        result = cli.invoke(replay_unsent_records, ["-c", 2])
+        assert result.exit_code == 0
+        assert (
+            result.output.strip()
+            == "Successfully resent 1500 of records, 0 of records left."
+        )
+    assert not store.spill_files()
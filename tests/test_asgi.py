@@ -0,0 +1,287 @@
+import asyncio
+import json
+import threading
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+pytest.importorskip("starlette")
+pytest.importorskip("httpx")  # used by the Starlette test client
+
+from starlette.testclient import TestClient
+
+from data_connector.asgi import create_asgi_app
+from data_connector.async_show_ads_api_wrapper import AsyncShowAdsClient, send_data
+from data_connector.dedup import SQLiteDedupCache
+from data_connector.record import Record
+from data_connector.spill import get_spill_store
+from data_connector.throttle import RetryPolicy
+
+
+# closes the connection instead of a response
+DROP = 599
+
+
+class MockShowAds:
+    """ShowAds stand-in served from a background event loop."""
+
+    def __init__(self):
+        # statuses of the first record/bulk requests, then 200
+        self.statuses: list[int] = []
+        self.calls: dict[str, int] = {}
+        self.records = 0
+        self.url = ""
+
+    async def handle(self, request: web.Request) -> web.Response:
+        path = request.path
+        self.calls[path] = self.calls.get(path, 0) + 1
+        if path == "/auth":
+            return web.json_response({"AccessToken": "access-token"})
+        if request.headers.get("Authorization") != "Bearer access-token":
+            return web.json_response({}, status=401)
+        if self.statuses:
+            status = self.statuses.pop(0)
+            if status == DROP:
+                request.transport.close()
+            return web.json_response({}, status=status)
+        body = json.loads(await request.read())
+        self.records += len(body["Data"]) if path.endswith("/bulk") else 1
+        return web.json_response({})
+
+
+@pytest.fixture
+def upstream() -> Iterator[MockShowAds]:
+    mock = MockShowAds()
+    app = web.Application()
+    app.router.add_post("/{path:.*}", mock.handle)
+    runner = web.AppRunner(app)
+    loop = asyncio.new_event_loop()
+
+    async def start():
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        mock.url = f"http://{host}:{port}"
+
+    loop.run_until_complete(start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield mock
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def make_client(upstream: MockShowAds) -> AsyncShowAdsClient:
+    return AsyncShowAdsClient(
+        upstream.url, "project-key", retry_policy=RetryPolicy(base_delay=0)
+    )
+
+
+def test_asgi_send_record(upstream):
+    with TestClient(create_asgi_app(lambda: make_client(upstream))) as client:
+        res = client.post("/send_record", json={})
+        assert res.status_code == 400
+
+        res = client.post(
+            "/send_record",
+            json={"name": "Mario", "age": 10, "cookie": "id", "banner_id": 10},
+        )
+        assert res.status_code == 202
+        assert "did not pass" in res.json()["message"]
+
+        res = client.post(
+            "/send_record",
+            json={"name": "Mario", "age": 18, "cookie": "id", "banner_id": 10},
+        )
+        assert res.status_code == 202
+        assert res.json()["message"] == "Record id sent to ShowAPI."
+    assert upstream.records == 1
+
+
+def test_asgi_send_bulk(upstream):
+    filepath = Path(__file__).parent / "resources" / "test_data.csv"
+    dummy = Path(__file__).parent / "resources" / "dummy.txt"
+    with TestClient(create_asgi_app(lambda: make_client(upstream))) as client:
+        with open(dummy, "rb") as f:
+            res = client.post("/send_record/bulk", files={"file": (dummy.name, f)})
+            assert res.status_code == 415
+
+        res = client.post("/send_record/bulk", data={"max_age": "30"})
+        assert res.status_code == 400
+
+        with open(filepath, "rb") as f:
+            res = client.post("/send_record/bulk", files={"file": (filepath.name, f)})
+            assert res.status_code == 202
+            assert res.json()["sent"] == 3
+
+        with open(filepath, "rb") as f:
+            res = client.post(
+                "/send_record/bulk",
+                data={"max_age": "30"},
+                files={"file": (filepath.name, f)},
+            )
+            assert res.status_code == 202
+            assert res.json()["sent"] == 2
+
+
+def test_asgi_send_batch(upstream):
+    records = [
+        {"name": "Mario", "age": 20, "cookie": f"id{i}", "banner_id": 10}
+        for i in range(1500)
+    ]
+    records[0]["banner_id"] = 100
+    with TestClient(create_asgi_app(lambda: make_client(upstream))) as client:
+        res = client.post("/send_record/batch", json=records)
+        assert res.status_code == 202
+        assert res.json()["sent"] == 1499
+        assert res.json()["results"][0]["rule"] == "banner_id"
+        assert res.json()["results"][1] == {"cookie": "id1", "status": "sent"}
+
+        res = client.post(
+            "/send_record/batch?max_age=30",
+            content="\n".join(json.dumps(rec) for rec in records[:10]),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        assert res.status_code == 202
+        assert res.json()["sent"] == 9
+
+        res = client.post("/send_record/batch", json={})
+        assert res.status_code == 400
+    assert upstream.records == 1508
+    assert upstream.calls["/banners/show/bulk"] == 3
+
+
+def test_async_client_concurrent_records(upstream):
+    # one token request serves all the concurrent records, the 401 and the
+    # 500 are retried
+    upstream.statuses = [500, 401]
+
+    async def run() -> list[int]:
+        client = make_client(upstream)
+        try:
+            return await asyncio.gather(
+                *(
+                    client.send_record(Record("Mario", 20, f"id{i}", 10))
+                    for i in range(200)
+                )
+            )
+        finally:
+            await client.close()
+
+    assert sum(asyncio.run(run())) == 200
+    assert upstream.records == 200
+    assert upstream.calls["/auth"] == 2
+
+
+def test_async_client_connection_error(upstream, monkeypatch, tmp_path):
+    monkeypatch.setenv("FAILED_RECORDS_DIRPATH", str(tmp_path))
+    # the first bulk is retried, all the attempts of the second one fail
+    upstream.statuses = [DROP, 200, DROP, DROP, DROP]
+
+    async def run() -> list[int]:
+        client = make_client(upstream)
+        records = [Record("Mario", 20, f"id{i}", 10) for i in range(10)]
+        try:
+            return [await client.send_bulk(i, records) for i in range(2)]
+        finally:
+            await client.close()
+
+    assert asyncio.run(run()) == [10, 0]
+    assert upstream.calls["/banners/show/bulk"] == 5
+    get_spill_store(tmp_path).flush()
+    (unsent,) = tmp_path.glob("unsent_*.csv")
+    assert len(unsent.read_text().splitlines()) == 10
+
+
+def test_async_send_data(upstream):
+    async def run() -> int:
+        client = make_client(upstream)
+        try:
+            records = (Record("Mario", 20, f"id{i}", 10) for i in range(2500))
+            return await send_data(client, records, concurrency=2)
+        finally:
+            await client.close()
+
+    assert asyncio.run(run()) == 2500
+    assert upstream.calls["/banners/show/bulk"] == 3
+
+
+def test_async_send_data_split_on_payload_too_large(upstream):
+    upstream.statuses = [413]
+
+    async def run() -> int:
+        client = make_client(upstream)
+        try:
+            records = (Record("Mario", 20, f"id{i}", 10) for i in range(1000))
+            return await send_data(client, records)
+        finally:
+            await client.close()
+
+    assert asyncio.run(run()) == 1000
+    assert upstream.records == 1000
+    # the refused bulk and its two halves
+    assert upstream.calls["/banners/show/bulk"] == 3
+
+
+def test_asgi_request_id_and_spans(upstream, monkeypatch, tmp_path):
+    trace_path = tmp_path / "trace.jsonl"
+    monkeypatch.setenv("TRACE_FILEPATH", str(trace_path))
+    with TestClient(create_asgi_app(lambda: make_client(upstream))) as client:
+        res = client.post(
+            "/send_record",
+            json={"name": "Mario", "age": 20, "cookie": "id", "banner_id": 1},
+            headers={"X-Request-ID": "req-7"},
+        )
+    assert res.status_code == 202
+    assert res.headers["X-Request-ID"] == "req-7"
+    with open(trace_path) as f:
+        spans = [
+            span
+            for line in f
+            for resource in json.loads(line)["resourceSpans"]
+            for scope in resource["scopeSpans"]
+            for span in scope["spans"]
+        ]
+    root = spans[-1]
+    assert root["name"] == "POST /send_record"
+    request_id = {"key": "request.id", "value": {"stringValue": "req-7"}}
+    assert request_id in root["attributes"]
+    # the token and the record requests
+    upstream_spans = [span for span in spans if span["name"] == "upstream"]
+    assert len(upstream_spans) == 2
+    assert all(span["parentSpanId"] == root["spanId"] for span in upstream_spans)
+
+
+def test_async_client_sqlite_dedup_off_loop(upstream, tmp_path):
+    threads = set()
+
+    class Recorded(SQLiteDedupCache):
+        def add(self, keys):
+            threads.add(threading.get_ident())
+            super().add(keys)
+
+        def _lookup(self, keys):
+            threads.add(threading.get_ident())
+            return super()._lookup(keys)
+
+    async def run() -> list[int]:
+        client = make_client(upstream)
+        client.dedup = Recorded(str(tmp_path / "dedup.db"), 60, 1000)
+        records = [Record("Mario", 20, f"id{i}", 10) for i in range(10)]
+        try:
+            sent = [await client.send_bulk(0, records) for _ in range(2)]
+            sent.append(await client.send_record(records[0]))
+            return sent
+        finally:
+            await client.close()
+
+    # the duplicates count as sent
+    assert asyncio.run(run()) == [10, 10, 1]
+    assert upstream.records == 10
+    # the queries did not block the loop
+    assert threads and threading.get_ident() not in threads
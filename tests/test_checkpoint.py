@@ -0,0 +1,277 @@
+import json
+import runpy
+import time
+import uuid
+from dataclasses import asdict
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from data_connector.checkpoint import (
+    Checkpoint,
+    CheckpointBulk,
+    checkpoint_path,
+    send_file_checkpointed,
+)
+from data_connector import create_app, jobs
+from data_connector.commands import upload_file
+from data_connector.jobs import JobManager
+from data_connector.record import Record, RecordBatch, ValidationPolicy
+from data_connector.utils import parse_file
+
+
+class Interrupted(Exception):
+    pass
+
+
+def _write_csv(path: Path, rows: int) -> int:
+    """Write the rows, return the number of the valid ones."""
+    with open(path, "w") as f:
+        f.write("Name,Age,Cookie,BannerId\n")
+        for i in range(rows):
+            name = "Valid Name" if i % 3 else "Invalid 1"
+            f.write(f"{name},{15 + i % 50},cookie{i},{i % 120}\n")
+    with open(path, "rb") as f:
+        return sum(1 for _ in parse_file(f, ValidationPolicy.from_args()))
+
+
+def _crashed_job(spool_dir: Path, path: Path, status: str, csv: bool = True) -> str:
+    """Spool the file as a job left in `status` by a crashed process."""
+    job_id = uuid.uuid4().hex
+    spooled = spool_dir / f"job_{job_id}.csv"
+    spooled.write_bytes(path.read_bytes())
+    if csv:
+        checkpoint = Checkpoint.start(spooled, ValidationPolicy.from_args())
+        checkpoint.save(spool_dir / f"job_{job_id}.checkpoint.json")
+    with open(spool_dir / f"job_{job_id}.json", "w") as f:
+        json.dump({"job_id": job_id, "status": status}, f)
+    return job_id
+
+
+def _sent_cookies(mock) -> list[str]:
+    return [
+        rec["VisitorCookie"]
+        for r in mock.request_history
+        if r.path == "/banners/show/bulk"
+        for rec in r.json()["Data"]
+    ]
+
+
+def _interrupt_after(bulks: int, snapshots: list, state: Path):
+    def on_bulk(size: int, sent: int):
+        # the checkpoint is stored before the callback
+        snapshots.append(Checkpoint.load(state))
+        if len(snapshots) == bulks:
+            raise Interrupted
+
+    return on_bulk
+
+
+def test_checkpoint_confirm_out_of_order():
+    checkpoint = Checkpoint(100, 0, {})
+    batch = RecordBatch.from_records([Record("Name", 20, "c", 1)] * 2)
+    checkpoint.confirm(CheckpointBulk(1, batch, 80, 8), 1)
+    assert (checkpoint.offset, checkpoint.next_bulk) == (0, 0)
+    assert checkpoint.confirmed == {1: [80, 8]}
+
+    checkpoint.confirm(CheckpointBulk(0, batch, 40, 4), 2)
+    assert (checkpoint.offset, checkpoint.line, checkpoint.next_bulk) == (80, 8, 2)
+    assert checkpoint.confirmed == {}
+    assert (checkpoint.accepted, checkpoint.sent) == (4, 3)
+
+
+def test_resume_after_interruption(tmp_path, mock_ok):
+    path = tmp_path / "data.csv"
+    nof_valid = _write_csv(path, 5000)
+    state = tmp_path / "state.json"
+    snapshots = []
+
+    with mock_ok:
+        with pytest.raises(Interrupted):
+            send_file_checkpointed(
+                path,
+                ValidationPolicy.from_args(),
+                state,
+                on_bulk=_interrupt_after(2, snapshots, state),
+            )
+        checkpoint = Checkpoint.load(state)
+        assert (checkpoint.next_bulk, checkpoint.sent) == (2, 2000)
+
+        policy = ValidationPolicy.from_args()
+        assert send_file_checkpointed(path, policy, state, resume=True) == nof_valid
+        cookies = _sent_cookies(mock_ok)
+    # nothing is sent twice
+    assert len(cookies) == len(set(cookies)) == nof_valid
+    assert not state.exists()
+    # the line numbers continue after the checkpoint
+    assert policy.examples[0]["line"] > checkpoint.line
+
+
+def test_resume_skips_bulks_finished_out_of_order(tmp_path, mock_ok):
+    path = tmp_path / "data.csv"
+    nof_valid = _write_csv(path, 5000)
+    state = tmp_path / "state.json"
+    snapshots = []
+
+    with mock_ok:
+        with pytest.raises(Interrupted):
+            send_file_checkpointed(
+                path,
+                ValidationPolicy.from_args(),
+                state,
+                on_bulk=_interrupt_after(2, snapshots, state),
+            )
+        # bulk 1 finished while bulk 0 was still in flight
+        first, second = snapshots
+        crashed = Checkpoint(
+            **{**asdict(first), "offset": 0, "line": 0, "next_bulk": 0}
+        )
+        crashed.confirmed = {1: [second.offset, second.line]}
+        crashed.save(state)
+        before = len(_sent_cookies(mock_ok))
+
+        sent = send_file_checkpointed(
+            path, ValidationPolicy.from_args(), state, resume=True
+        )
+        cookies = _sent_cookies(mock_ok)[before:]
+    assert sent == nof_valid
+    # bulk 0 is sent again, bulk 1 is not
+    assert len(cookies) == len(set(cookies)) == nof_valid - 1000
+
+
+def test_resume_rejects_changed_file(tmp_path, mock_ok):
+    path = tmp_path / "data.csv"
+    _write_csv(path, 3000)
+    state = tmp_path / "state.json"
+    with mock_ok:
+        with pytest.raises(Interrupted):
+            send_file_checkpointed(
+                path,
+                ValidationPolicy.from_args(),
+                state,
+                on_bulk=_interrupt_after(1, [], state),
+            )
+        with pytest.raises(ValueError):
+            send_file_checkpointed(
+                path, ValidationPolicy.from_args(30), state, resume=True
+            )
+        _write_csv(path, 3001)
+        with pytest.raises(ValueError):
+            send_file_checkpointed(
+                path, ValidationPolicy.from_args(), state, resume=True
+            )
+
+
+def test_cli_upload_file_resume(cli, mock_ok, monkeypatch, tmp_path):
+    monkeypatch.setenv("CHECKPOINT_DIRPATH", str(tmp_path / "state"))
+    (tmp_path / "state").mkdir()
+    path = tmp_path / "data.csv"
+    nof_valid = _write_csv(path, 5000)
+    state = checkpoint_path(path)
+    assert state.parent == tmp_path / "state"
+
+    with mock_ok:
+        with pytest.raises(Interrupted):
+            send_file_checkpointed(
+                path,
+                ValidationPolicy.from_args(),
+                on_bulk=_interrupt_after(1, [], state),
+            )
+        result = cli.invoke(upload_file, ["--checkpoint", str(path)])
+        assert result.exit_code == 1
+        assert "Use --resume to continue it" in result.output
+
+        result = cli.invoke(upload_file, ["--resume", str(path)])
+        assert result.exit_code == 0
+        assert result.output.splitlines()[0] == (
+            f"Successfully sent {nof_valid} of records."
+        )
+        assert len(_sent_cookies(mock_ok)) == nof_valid
+    assert not state.exists()
+
+
+def test_cli_upload_file_without_checkpoint(cli, mock_ok, monkeypatch, tmp_path):
+    monkeypatch.delenv("CHECKPOINT_DIRPATH", raising=False)
+    path = tmp_path / "data.csv"
+    nof_valid = _write_csv(path, 2000)
+    # left by an interrupted checkpointed upload
+    state = checkpoint_path(path)
+    state.write_text("{}")
+
+    with mock_ok:
+        # e.g. a cron run, the input directory does not have to be writable
+        result = cli.invoke(upload_file, [str(path)])
+        assert result.exit_code == 0
+        assert result.output.splitlines()[0] == (
+            f"Successfully sent {nof_valid} of records."
+        )
+    assert state.read_text() == "{}"
+    assert len(list(tmp_path.glob("*.checkpoint.json"))) == 1
+
+
+def test_resume_interrupted_jobs(tmp_path, mock_ok):
+    path = tmp_path / "data.csv"
+    nof_valid = _write_csv(path, 3000)
+    manager = JobManager(2, tmp_path / "spool")
+
+    def crashed_job(status: str, csv: bool = True) -> str:
+        return _crashed_job(manager.spool_dir, path, status, csv)
+
+    running, queued = crashed_job("running"), crashed_job("queued")
+    other_format = crashed_job("running", csv=False)
+    corrupt = crashed_job("running")
+    (manager.spool_dir / f"job_{corrupt}.checkpoint.json").write_text("{")
+    done = crashed_job("done")
+    # still processed by a live process
+    held = crashed_job("running")
+    claim = manager._claim(held)
+
+    with mock_ok:
+        resumed = manager.resume_interrupted()
+        assert sorted(job.id for job in resumed) == sorted([running, queued])
+        for job_id in (running, queued):
+            for _ in range(100):
+                if manager.get(job_id)["status"] == "done":
+                    break
+                time.sleep(0.05)
+            status = manager.get(job_id)
+            assert status["status"] == "done"
+            assert status["sent"] == nof_valid
+            assert not (manager.spool_dir / f"job_{job_id}.csv").exists()
+    manager.shutdown()
+    manager._release(held, claim)
+
+    assert manager.get(other_format)["status"] == "failed"
+    assert manager.get(corrupt)["status"] == "failed"
+    assert manager.get(done)["status"] == "done"
+    assert manager.get(held)["status"] == "running"
+
+
+def test_resume_only_in_server_workers(tmp_path, mock_ok, monkeypatch):
+    path = tmp_path / "data.csv"
+    nof_valid = _write_csv(path, 100)
+    spool_dir = tmp_path / "spool"
+    spool_dir.mkdir()
+    job_id = _crashed_job(spool_dir, path, "running")
+    monkeypatch.setenv("BULK_JOB_WORKERS", "1")
+    monkeypatch.setenv("BULK_JOB_SPOOL_DIRPATH", str(spool_dir))
+    hooks = runpy.run_path(str(Path(__file__).parents[1] / "gunicorn.conf.py"))
+
+    # e.g. `flask upload-file` creates the app too
+    app = create_app()
+    manager = app.extensions["bulk_jobs"]
+    assert manager.get(job_id)["status"] == "running"
+    # the job could still be processed by another process
+    with monkeypatch.context() as m:
+        m.setattr(jobs, "fcntl", None)
+        assert manager.resume_interrupted() == []
+
+    with mock_ok:
+        hooks["post_worker_init"](SimpleNamespace(wsgi=app))
+        for _ in range(100):
+            if manager.get(job_id)["status"] == "done":
+                break
+            time.sleep(0.05)
+        assert manager.get(job_id)["sent"] == nof_valid
+    manager.shutdown()
@@ -0,0 +1,29 @@
+import time
+
+from data_connector.coalescer import RecordCoalescer
+from data_connector.record import Record
+
+
+def test_flush_on_size():
+    bulks = []
+    coalescer = RecordCoalescer(
+        flush_ms=60_000, max_size=10, sender=lambda i, b: bulks.append(b) or len(b)
+    ).start()
+    for _ in range(25):
+        coalescer.submit(Record("gumba", 20, "chompchomp", 2))
+    coalescer.close()
+    assert [len(b) for b in bulks] == [10, 10, 5]
+    assert coalescer.sent == 25
+
+
+def test_flush_on_time():
+    bulks = []
+    coalescer = RecordCoalescer(
+        flush_ms=10, sender=lambda i, b: bulks.append(b) or len(b)
+    ).start()
+    coalescer.submit(Record("gumba", 20, "chompchomp", 2))
+    time.sleep(0.2)
+    # flushed before close
+    assert [len(b) for b in bulks] == [1]
+    coalescer.close()
+    assert coalescer.sent == 1
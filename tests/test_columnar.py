@@ -0,0 +1,100 @@
+import io
+import random
+from pathlib import Path
+
+from data_connector.columnar import parse_file_columnar, read_columns, validate_columns
+from data_connector.record import ValidationPolicy
+from data_connector.utils import parse_file, parse_line
+
+
+def _per_row(data: bytes, min_age, max_age) -> tuple[list[int], list[int], dict]:
+    accepted, rejected = [], []
+    policy = ValidationPolicy.from_args(min_age, max_age)
+    for i, line in enumerate(io.BytesIO(data)):
+        rec = parse_line(line.decode().strip())
+        if rec and rec.validate(policy=policy):
+            accepted.append(i)
+        else:
+            rejected.append(i)
+    # parse errors are counted by `parse_file`
+    policy.rejections["format"] = len(rejected) - sum(policy.rejections.values())
+    return accepted, rejected, +policy.rejections
+
+
+def _columnar(data: bytes, min_age, max_age, block_size) -> tuple[list[int], list[int], dict]:
+    accepted, rejected = [], []
+    policy = ValidationPolicy.from_args(min_age, max_age)
+    for cols in read_columns(io.BytesIO(data), block_size):
+        result = validate_columns(cols, policy)
+        accepted += result.accepted
+        rejected += result.rejected
+    return accepted, rejected, +policy.rejections
+
+
+def test_columnar_matches_per_row():
+    filepath = Path(__file__).parent / "resources" / "test_data.csv"
+    data = filepath.read_bytes()
+    for min_age, max_age in [(None, None), (8, None), (None, 30), (20, 30)]:
+        expected = _per_row(data, min_age, max_age)
+        assert _columnar(data, min_age, max_age, 16) == expected
+        assert _columnar(data, min_age, max_age, 1 << 20) == expected
+
+
+def test_columnar_matches_per_row_random():
+    rnd = random.Random(42)
+    names = ["K M Valid", "Prof. J F", "", "Mr A", "x1", " a b ", "\tTab"]
+    numbers = ["18", "17", "-1", "99", "100", "0", "abc", "", " 40 ", "1_0"]
+    lines = []
+    for _ in range(2000):
+        fields = [
+            rnd.choice(names),
+            rnd.choice(numbers),
+            f"cookie{rnd.randint(0, 9)}",
+            rnd.choice(numbers),
+            "extra",
+        ]
+        line = ",".join(fields[: rnd.choice([1, 3, 4, 4, 4, 4, 5])])
+        # whitespace `str.strip` removes but `int` does not accept
+        suffix = rnd.choice(["", "", " ", "\x1c", "\x1d", "\x1e", "\x1f"])
+        lines.append(line + suffix)
+    data = "\n".join(lines).encode()
+    for min_age, max_age in [(None, None), (0, 50)]:
+        expected = _per_row(data, min_age, max_age)
+        assert _columnar(data, min_age, max_age, 256) == expected
+
+    # blocks where every line has 4 fields take the fast path
+    lines = [line for line in lines if line.count(",") == 3]
+    data = "\r\n".join(lines).encode()
+    expected = _per_row(data, None, None)
+    assert _columnar(data, None, None, 256) == expected
+    assert len(expected[0]) > 0
+
+
+def test_columnar_trailing_separators():
+    data = "".join(
+        f"Mario,20,c{i},5{suffix}\n"
+        for i, suffix in enumerate(["\x1c", "\x1d", "\x1e", "\x1f", " \x1f\t"])
+    ).encode()
+    expected = _per_row(data, None, None)
+    assert expected[0] == [0, 1, 2, 3, 4]
+    assert _columnar(data, None, None, 1 << 20) == expected
+
+
+def test_parse_file_columnar():
+    filepath = Path(__file__).parent / "resources" / "test_data.csv"
+    with open(filepath, "rb") as f:
+        expected = list(parse_file(f, ValidationPolicy.from_args()))
+    with open(filepath, "rb") as f:
+        assert list(parse_file_columnar(f, ValidationPolicy.from_args())) == expected
+
+
+def test_columnar_extra_rules(monkeypatch):
+    monkeypatch.setenv("MAX_NAME_LENGTH", "5")
+    monkeypatch.setenv("MAX_BANNER_ID", "50")
+    data = b"Name,Age,Cookie,BannerId\nLonger Name,20,a,1\nShort,20,b,51\nShort,20,c,50\n"
+    assert _columnar(data, None, None, 16) == _per_row(data, None, None)
+    assert _columnar(data, None, None, 16)[2] == {
+        "format": 1,
+        "name_length": 1,
+        "banner_id": 1,
+    }
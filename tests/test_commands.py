@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from click.testing import CliRunner
+
+from data_connector.commands import main
+
+# import time of the standalone CLI (in milliseconds), about twice the time it
+# takes here; importing the app takes 350 ms
+IMPORT_BUDGET_MS = int(os.getenv("IMPORT_BUDGET_MS", 300))
+# not needed to send a file
+HEAVY_MODULES = {"flask", "flask_restx", "werkzeug", "jsonschema", "asyncio"}
+
+
+def _import_times(module: str) -> dict[str, int]:
+    """Cumulative import time (in microseconds) of the modules, by their name."""
+    src = Path(__file__).parents[1] / "src"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, "PYTHONPATH": str(src)},
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        parts = line.removeprefix("import time:").split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            times[parts[2].strip()] = int(parts[1])
+    return times
+
+
+def test_cli_import_budget():
+    runs = [_import_times("data_connector.commands") for _ in range(3)]
+    assert not HEAVY_MODULES & runs[0].keys()
+    best = min(times["data_connector.commands"] for times in runs)
+    assert best / 1000 < IMPORT_BUDGET_MS
+
+
+def test_standalone_cli(mock_ok, monkeypatch, tmp_path):
+    filepath = Path(__file__).parent / "resources" / "test_data.csv"
+    runner = CliRunner()
+    with mock_ok:
+        result = runner.invoke(main, ["upload-file", "-ma", 30, str(filepath)])
+        assert result.exit_code == 0
+        assert result.output.splitlines()[0] == "Successfully sent 2 of records."
+
+    monkeypatch.delenv("PROJECT_KEY")
+    result = runner.invoke(main, ["upload-file", str(filepath)])
+    assert result.exit_code == 1
+    assert "PROJECT_KEY not found" in result.output
@@ -0,0 +1,70 @@
+import os
+import time
+
+import pytest
+
+from data_connector.dedup import (
+    DedupCache,
+    MemoryDedupCache,
+    SQLiteDedupCache,
+    dedup_key,
+)
+from data_connector.record import Record
+from data_connector.show_ads_api_wrapper import ShowAdsClient
+
+
+def test_memory_dedup_cache():
+    cache = MemoryDedupCache(ttl=0.05, max_entries=2)
+    assert cache.new_keys(["a", "b", "a"]) == [True, True, False]
+    cache.add(["a", "b", "c"])
+    # "a" was evicted, the cache holds 2 entries
+    assert cache.new_keys(["a", "b", "c"]) == [True, False, False]
+    time.sleep(0.06)
+    assert cache.new_keys(["b", "c"]) == [True, True]
+    assert cache.stats() == {"hits": 3, "misses": 5}
+
+
+def test_dedup_cache_is_abstract():
+    class Partial(DedupCache):
+        def add(self, keys):
+            pass
+
+    with pytest.raises(TypeError):
+        DedupCache(60, 100)
+    # a backend without the lookup fails on construction, not on first use
+    with pytest.raises(TypeError):
+        Partial(60, 100)
+
+
+def test_sqlite_dedup_cache(tmp_path):
+    path = str(tmp_path / "dedup.sqlite")
+    first = SQLiteDedupCache(path, ttl=60, max_entries=100)
+    second = SQLiteDedupCache(path, ttl=60, max_entries=100)
+    first.add([dedup_key("cookie", 1)])
+    # shared by the processes using the same database
+    assert second.new_keys([dedup_key("cookie", 1), dedup_key("cookie", 2)]) == [
+        False,
+        True,
+    ]
+    first.close()
+    second.close()
+
+
+def test_send_bulk_dedup(mock_ok):
+    client = ShowAdsClient(
+        os.getenv("API_URL"), "project-key", dedup=MemoryDedupCache(60, 1000)
+    )
+    recs = [Record("gumba", 20, f"cookie{i}", 2) for i in range(10)]
+    with mock_ok as mock:
+        assert client.send_bulk(1, recs) == 10
+        # overlapping upload, only the new records are sent
+        assert client.send_bulk(2, recs + [Record("gumba", 20, "new", 2)]) == 11
+        bodies = [r.json() for r in mock.request_history if r.path.endswith("bulk")]
+        assert len(bodies[1]["Data"]) == 1
+
+        # nothing new, no request at all
+        assert client.send_bulk(3, recs) == 10
+        assert client.send_record(recs[0]) == 1
+        assert sum(r.path.startswith("/banners") for r in mock.request_history) == 2
+    assert client.dedup.stats() == {"hits": 21, "misses": 11}
+    client.close()
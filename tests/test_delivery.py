@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import json
+
+from data_connector.delivery import (
+    DELIVERED,
+    FAILED,
+    REFRESH_TOKEN,
+    REFUSED,
+    BulkDelivery,
+    next_step,
+    retry_delay,
+)
+from data_connector.record import Record, RecordBatch
+from data_connector.throttle import (
+    CONNECTION_FAILED,
+    TIMED_OUT,
+    AdaptiveBulkSize,
+    RetryPolicy,
+)
+
+
+def _batch(size: int) -> RecordBatch:
+    return RecordBatch.from_records(
+        [Record("Mario", 20, f"id{i}", 10) for i in range(size)]
+    )
+
+
+def test_next_step():
+    assert next_step(200, "bulk 0", None) == DELIVERED
+    assert next_step(401, "bulk 0", None) == REFRESH_TOKEN
+    assert next_step(400, "bulk 0", None) == next_step(413, "bulk 0", None) == REFUSED
+    for status in (CONNECTION_FAILED, TIMED_OUT, 404, 429, 500):
+        assert next_step(status, "bulk 0", 1.0) == FAILED
+
+    policy = RetryPolicy(attempts=3, base_delay=1, max_delay=1)
+    assert retry_delay(policy, 503, 0, "2") == 2
+    assert retry_delay(policy, 404, 0, "2") == 0
+    # the last attempt
+    assert retry_delay(policy, 503, 2, "2") == 0
+
+
+def test_bulk_delivery_bisects_without_io():
+    sizer = AdaptiveBulkSize(1000)
+    delivery = BulkDelivery(0, _batch(8), sizer, dedup=True)
+    delivery.skip_duplicates([i != 1 for i in range(8)])
+    # the upstream refuses the record id5
+    sent = []
+    while (payload := delivery.next_payload()) is not None:
+        cookies = [r["VisitorCookie"] for r in json.loads(payload.body)["Data"]]
+        sent.append(cookies)
+        status = 400 if "id5" in cookies else 200
+        delivery.finish_part(status, "invalid" if status == 400 else "", 0.1)
+
+    assert sent[0] == ["id0", "id2", "id3", "id4", "id5", "id6", "id7"]
+    assert sent[1:] == [
+        ["id0", "id2", "id3"],
+        ["id4", "id5", "id6", "id7"],
+        ["id4", "id5"],
+        ["id4"],
+        ["id5"],
+        ["id6", "id7"],
+    ]
+    result = delivery.bulk_result()
+    assert result.delivered == [True, True, True, True, True, False, True, True]
+    assert result.rejected == {5: "Bad request: invalid"}
+    assert delivery.delivered_keys() == [
+        key for key in delivery.keys if not key.startswith("id5")
+    ]
+    # one refused record shrinks the size once
+    assert sizer.size < 1000
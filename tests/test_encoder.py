@@ -0,0 +1,36 @@
+import gzip
+import json
+
+from data_connector import encoder
+from data_connector.encoder import encode_bulk, encode_record
+from data_connector.record import Record, RecordBatch
+
+
+def _batch() -> RecordBatch:
+    return RecordBatch.from_records(
+        Record("Valid Customer", 50, f"cookie{i}", i % 100) for i in range(50)
+    )
+
+
+def test_encode_bulk(monkeypatch):
+    expected = _batch().transform_data()
+    assert json.loads(encode_bulk(_batch()).body) == expected
+
+    # stdlib fallback
+    monkeypatch.setattr(encoder, "orjson", None)
+    payload = encode_bulk(_batch())
+    assert json.loads(payload.body) == expected
+    assert payload.headers == {"Content-Type": "application/json"}
+
+
+def test_encode_gzip():
+    payload = encode_bulk(_batch(), compress=True)
+    assert payload.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(payload.body)) == _batch().transform_data()
+
+
+def test_encode_record(monkeypatch):
+    rec = Record("Valid Customer", 50, "cookie", 9)
+    assert json.loads(encode_record(rec).body) == rec.transform_data()
+    monkeypatch.setattr(encoder, "orjson", None)
+    assert json.loads(encode_record(rec).body) == rec.transform_data()
@@ -0,0 +1,145 @@
+import json
+import os
+import re
+from collections import Counter as TallyCounter
+from pathlib import Path
+
+from flask_restx.api import HTTPStatus
+
+from data_connector import metrics
+from data_connector.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    ParseTally,
+    Registry,
+    export,
+)
+
+
+def sample(text: str, name: str, **labels: str) -> float:
+    """Value of a sample in the exported text, 0 if it is missing."""
+    label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+    pattern = re.escape(f"{name}{{{label_text}}}" if labels else name) + r" (\S+)"
+    match = re.search(f"^{pattern}$", text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+
+def test_render_merges_snapshots(monkeypatch):
+    registry = Registry()
+    monkeypatch.setattr(metrics, "REGISTRY", registry)
+    requests = Counter("requests_total", "Requests.", ("status",))
+    depth = Gauge("depth", "Queue depth.")
+    latency = Histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+
+    requests.inc(2, status="200")
+    depth.set(3)
+    latency.observe(0.05)
+    latency.observe(0.5)
+    mine = registry.snapshot()
+    # snapshot of a process that is gone, only its gauges are dropped
+    other = json.loads(json.dumps(mine))
+    other["pid"] = 2**22 + 1
+
+    text = registry.render([mine, other])
+    assert "# TYPE requests_total counter" in text
+    assert sample(text, "requests_total", status="200") == 4
+    assert sample(text, "depth") == 3
+    assert sample(text, "latency_seconds_bucket", le="0.1") == 2
+    assert sample(text, "latency_seconds_bucket", le="1.0") == 4
+    assert sample(text, "latency_seconds_bucket", le="+Inf") == 4
+    assert sample(text, "latency_seconds_count") == 4
+    assert sample(text, "latency_seconds_sum") == 1.1
+
+
+def test_parse_tally():
+    before = export()
+    rejections = TallyCounter()
+    tally = ParseTally(rejections, every=10)
+    for i in range(25):
+        tally.add()
+        if i % 5 == 0:
+            rejections["age"] += 1
+    # flushed twice so far
+    text = export()
+    assert sample(text, "data_connector_rows_parsed_total") - sample(
+        before, "data_connector_rows_parsed_total"
+    ) == 20
+    tally.flush()
+    text = export()
+    assert sample(text, "data_connector_rows_parsed_total") - sample(
+        before, "data_connector_rows_parsed_total"
+    ) == 25
+    assert sample(text, "data_connector_rows_rejected_total", rule="age") - sample(
+        before, "data_connector_rows_rejected_total", rule="age"
+    ) == 5
+
+
+def test_export_shared_directory(monkeypatch, tmp_path):
+    monkeypatch.setenv("METRICS_DIRPATH", str(tmp_path))
+    base = export()
+    parsed = sample(base, "data_connector_rows_parsed_total")
+    # snapshot of another worker
+    other = {
+        "pid": os.getpid() + 1,
+        "metrics": {"data_connector_rows_parsed_total": [[[], 7.0]]},
+    }
+    (tmp_path / "metrics_other.json").write_text(json.dumps(other))
+
+    text = export()
+    assert sample(text, "data_connector_rows_parsed_total") == parsed + 7
+    assert len(list(tmp_path.glob(f"metrics_{os.getpid()}_*.json"))) == 1
+
+
+def test_export_reused_pid(monkeypatch, tmp_path):
+    monkeypatch.setenv("METRICS_DIRPATH", str(tmp_path))
+    registry = Registry()
+    monkeypatch.setattr(metrics, "REGISTRY", registry)
+    requests = Counter("requests_total", "Requests.")
+    depth = Gauge("depth", "Queue depth.")
+
+    # a worker that is gone
+    monkeypatch.setattr(metrics, "_process", (os.getpid(), "old", 1.0))
+    requests.inc(5)
+    depth.set(3)
+    metrics.write_snapshot(tmp_path)
+    # a new worker got its PID
+    monkeypatch.setattr(metrics, "_process", (os.getpid(), "new", 2.0))
+    registry.reset()
+    requests.inc(1)
+    depth.set(1)
+
+    text = export()
+    assert len(list(tmp_path.glob("metrics_*.json"))) == 2
+    # the counters do not go backwards, the gauges of the old worker are dropped
+    assert sample(text, "requests_total") == 6
+    assert sample(text, "depth") == 1
+
+
+def test_metrics_api(client, mock_ok):
+    filepath = Path(__file__).parent / "resources" / "test_data.csv"
+    before = client.get("/metrics").text
+    with mock_ok:
+        with open(filepath, "rb") as f:
+            res = client.post("/send_record/bulk", data={"file": (f, str(filepath))})
+            assert res.json["sent"] == 3
+
+    res = client.get("/metrics")
+    assert res.status_code == HTTPStatus.OK
+    assert res.mimetype == "text/plain"
+
+    def delta(name: str, **labels: str) -> float:
+        return sample(res.text, name, **labels) - sample(before, name, **labels)
+
+    assert delta("data_connector_rows_parsed_total") == 8
+    assert delta("data_connector_rows_rejected_total", rule="format") == 1
+    assert delta("data_connector_bulk_size_count") == 1
+    assert (
+        delta(
+            "data_connector_upstream_request_duration_seconds_count",
+            endpoint="/banners/show/bulk",
+            status="200",
+        )
+        == 1
+    )
+    assert delta("data_connector_token_refreshes_total", result="success") == 1
@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import io
+
+from data_connector.multipart import MultipartUpload
+
+
+def multipart_body(boundary: str, parts: list[tuple[str, str | None, bytes]]) -> bytes:
+    body = b""
+    for name, filename, data in parts:
+        disposition = f'form-data; name="{name}"'
+        if filename:
+            disposition += f'; filename="{filename}"'
+        body += f"--{boundary}\r\nContent-Disposition: {disposition}\r\n\r\n".encode()
+        body += data + b"\r\n"
+    return body + f"--{boundary}--\r\n".encode()
+
+
+def test_multipart_upload():
+    data = b"".join(f"Name {i},{i},cookie{i},{i % 100}\n".encode() for i in range(5000))
+    body = multipart_body(
+        "xyz",
+        [
+            ("min_age", None, b"20"),
+            ("file", "data.csv", data),
+            ("max_age", None, b"30"),
+            ("other", "other.csv", b"skipped"),
+        ],
+    )
+    stream = io.BytesIO(body)
+    # tiny chunks, the parts are split at arbitrary places
+    upload = MultipartUpload(stream, b"xyz", chunk_size=97)
+    assert upload.open_file()
+    assert upload.filename == "data.csv"
+    assert upload.fields == {"min_age": "20"}
+    # the body is read as the file is consumed
+    assert stream.tell() < len(body)
+
+    read = b""
+    while chunk := upload.read(1000):
+        assert len(chunk) <= 1000
+        read += chunk
+    assert read == data
+    assert upload.close() == {"max_age": "30"}
+
+
+def test_multipart_upload_no_file():
+    body = multipart_body("xyz", [("min_age", None, b"20")])
+    upload = MultipartUpload(io.BytesIO(body), b"xyz")
+    assert not upload.open_file()
+    assert upload.fields == {"min_age": "20"}
+    assert upload.read() == b""
@@ -1,23 +1,64 @@
+import json
 import logging
 
-from data_connector.record import Record
+from data_connector.record import Record, RecordBatch, ValidationPolicy
 
 
 def test_validate_record(caplog):
-    caplog.set_level(logging.WARNING)
-    assert not Record("invalid1", 18, "uuid", 0).validate()
-    assert "Skipping record" in caplog.text
-    assert "An invalid name." in caplog.text
+    caplog.set_level(logging.DEBUG)
+    policy = ValidationPolicy.from_args()
+    assert not Record("invalid1", 18, "uuid1", 0).validate(policy=policy)
+    assert not Record("invalid age", 9, "uuid2", 0).validate(policy=policy)
+    assert not Record("invalid banner id", 18, "uuid3", 101).validate(policy=policy)
+    assert Record("valid customer", 18, "uuid", 0).validate(policy=policy)
+    assert Record("valid customer", 18, "uuid", 0).validate()
+    # nothing is logged per record, the rejections are reported at once
+    assert caplog.text == ""
+    assert policy.report() == {
+        "rejected": 3,
+        "rules": {"name": 1, "age": 1, "banner_id": 1},
+        "examples": [
+            {"rule": "name", "message": "An invalid name.", "cookie": "uuid1"},
+            {"rule": "age", "message": "Ignored due to age.", "cookie": "uuid2"},
+            {
+                "rule": "banner_id",
+                "message": "Banner ID out of range.",
+                "cookie": "uuid3",
+            },
+        ],
+    }
 
-    assert not Record("invalid age", 9, "uuid", 0).validate()
-    assert "Skipping record" in caplog.text
-    assert "Ignored due to age." in caplog.text
 
-    assert not Record("invalid banner id", 18, "uuid", 101).validate()
-    assert "Skipping record" in caplog.text
-    assert "Banner ID out of range." in caplog.text
+def test_rejection_examples_limit():
+    policy = ValidationPolicy(max_examples=2)
+    for i in range(5):
+        policy.reject("age", i + 1, f"cookie{i}")
+    assert policy.rejections == {"age": 5}
+    assert [e["line"] for e in policy.examples] == [1, 2]
 
-    assert Record("valid customer", 18, "uuid", 0).validate()
+    merged = ValidationPolicy(max_examples=3)
+    merged.merge({"age": 5}, policy.examples, line_offset=10)
+    merged.merge({"name": 1}, [{"rule": "name", "message": "", "line": 1}] * 2)
+    assert merged.rejections == {"age": 5, "name": 1}
+    assert [e["line"] for e in merged.examples] == [11, 12, 1]
+    assert merged.summary() == "6 rejected (age: 5, name: 1)"
+
+
+def test_validation_policy(monkeypatch):
+    monkeypatch.setenv("MAX_AGE_FILTER", "40")
+    monkeypatch.setenv("MAX_NAME_LENGTH", "10")
+    policy = ValidationPolicy.from_args(20)
+    assert policy.min_age == 20
+    assert policy.max_age == 40
+
+    # the environment is not read again once the policy is built
+    monkeypatch.delenv("MAX_AGE_FILTER")
+    assert not Record("too old", 41, "uuid", 0).validate(policy=policy)
+    assert not Record("too young", 19, "uuid", 0).validate(policy=policy)
+    assert not Record("a very long name", 30, "uuid", 0).validate(policy=policy)
+    assert not Record("invalid1", 30, "uuid", 0).validate(policy=policy)
+    assert Record("valid", 30, "uuid", 0).validate(policy=policy)
+    assert policy.rejections == {"age": 2, "name_length": 1, "name": 1}
 
 
 def test_transform():
@@ -26,3 +67,18 @@ def test_transform():
     assert {"VisitorCookie", "BannerId"} == set(data.keys())
     assert data["VisitorCookie"] == "cookie"
     assert data["BannerId"] == 9
+
+
+def test_record_batch():
+    recs = [Record("Valid Customer", 50, f"cookie{i}", i) for i in range(10)]
+    batch = RecordBatch.from_records(recs)
+    assert len(batch) == 10
+    assert list(batch) == recs
+    data = batch.transform_data()["Data"]
+    assert data == [r.transform_data() for r in recs]
+    assert json.loads(batch.to_json()) == {"Data": data}
+    batch = RecordBatch.from_records([Record("a", 1, 'c"\u00e9', 1)])
+    assert json.loads(batch.to_json()) == {
+        "Data": [{"VisitorCookie": 'c"\u00e9', "BannerId": 1}]
+    }
+    assert not hasattr(recs[0], "__dict__")
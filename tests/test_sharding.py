@@ -0,0 +1,74 @@
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from data_connector import sharding
+from data_connector.record import ValidationPolicy
+from data_connector.sharding import send_file_sharded, shard_ranges
+from data_connector.utils import parse_file
+
+
+def _write_csv(path: Path, rows: int):
+    with open(path, "w") as f:
+        f.write("Name,Age,Cookie,BannerId\n")
+        for i in range(rows):
+            name = "Valid Name" if i % 3 else "Invalid 1"
+            f.write(f"{name},{15 + i % 50},cookie{i},{i % 120}\n")
+
+
+def test_shard_ranges(tmp_path):
+    path = tmp_path / "data.csv"
+    _write_csv(path, 1000)
+    data = path.read_bytes()
+    ranges = shard_ranges(path, 4)
+    assert len(ranges) == 4
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start and data[start - 1 : start] == b"\n"
+
+    small = tmp_path / "small.csv"
+    small.write_bytes(b"a,1,b,2\n")
+    assert shard_ranges(small, 4) == [(0, 8)]
+    empty = tmp_path / "empty.csv"
+    empty.write_bytes(b"")
+    assert shard_ranges(empty, 4) == []
+
+
+def test_send_file_sharded(tmp_path, mock_ok):
+    path = tmp_path / "data.csv"
+    _write_csv(path, 5000)
+    expected = ValidationPolicy.from_args()
+    with open(path, "rb") as f:
+        nof_valid = sum(1 for _ in parse_file(f, expected))
+
+    policy = ValidationPolicy.from_args()
+    with mock_ok:
+        assert send_file_sharded(path, policy, workers=3, concurrency=2) == nof_valid
+    assert policy.rejections == expected.rejections
+    # the examples are taken in the order of the file
+    assert [(e["line"], e["rule"]) for e in policy.examples] == [
+        (e["line"], e["rule"]) for e in expected.examples
+    ]
+
+
+_parse_shard = sharding._parse_shard
+
+
+def _dying_parser(path, shard, *args):
+    # killed before it sends anything, e.g. by the OOM killer
+    if shard == 1:
+        os._exit(1)
+    _parse_shard(path, shard, *args)
+
+
+def test_send_file_sharded_worker_died(tmp_path, mock_ok, monkeypatch):
+    path = tmp_path / "data.csv"
+    _write_csv(path, 5000)
+    monkeypatch.setattr(sharding, "_parse_shard", _dying_parser)
+    monkeypatch.setattr(sharding, "WORKER_POLL_INTERVAL", 0.1)
+    started = time.monotonic()
+    with mock_ok, pytest.raises(RuntimeError, match="shard 1 .* exited with code 1"):
+        send_file_sharded(path, ValidationPolicy.from_args(), workers=3)
+    assert time.monotonic() - started < 10
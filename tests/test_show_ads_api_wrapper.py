@@ -1,20 +1,66 @@
 from __future__ import annotations
 
+import threading
+
+import os
+
+import requests
+
+from data_connector.delivery import MAX_SPLIT_REQUESTS
 from data_connector.record import Record
 from data_connector.show_ads_api_wrapper import (
-    OPT_DICT,
+    ShowAdsClient,
+    get_client,
     send_bulk,
     send_data,
     send_record,
+    set_client,
     update_access_token,
 )
+from data_connector.spill import get_spill_store
+from data_connector.throttle import (
+    AdaptiveBulkSize,
+    AdaptiveConcurrency,
+    RetryPolicy,
+)
 
 
 def test_update_access_token(mock_ok):
-    assert not OPT_DICT["access_token"]
+    assert not get_client().access_token
     with mock_ok:
         update_access_token()
-    assert OPT_DICT["access_token"]
+    assert get_client().access_token
+
+
+def test_token_single_flight(mock_ok):
+    client = get_client()
+    barrier = threading.Barrier(8)
+
+    def refresh():
+        barrier.wait()
+        client.update_access_token(stale_token="")
+
+    with mock_ok as mock:
+        threads = [threading.Thread(target=refresh) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # only the first thread fetched the token
+        assert mock.call_count == 1
+    assert client.access_token == "access-token"
+
+
+def test_token_refresh_ahead_of_expiry(mock_ok):
+    client = ShowAdsClient(
+        get_client().base_url, "project-key", token_ttl=60, refresh_margin=120
+    )
+    with mock_ok as mock:
+        client.get_access_token()
+        # the token expires within the margin, so it is fetched again
+        client.get_access_token()
+        assert mock.call_count == 2
+    client.close()
 
 
 def test_send_record(mock_ok):
@@ -29,14 +75,284 @@ def test_send_bulk(mock_ok):
         assert send_bulk(1, recs) == len(recs)
 
 
+def test_send_bulk_payload_reused(mock_fail):
+    recs = [Record("gumba", 20, "chompchomp", 2) for _ in range(10)]
+    client = ShowAdsClient(
+        get_client().base_url,
+        "project-key",
+        compress=True,
+        retry_policy=RetryPolicy(base_delay=0),
+    )
+    with mock_fail as mock:
+        assert client.send_bulk(1, recs) == 0
+        bodies = [
+            r.body for r in mock.request_history if r.path == "/banners/show/bulk"
+        ]
+        assert len(bodies) == 3 and len(set(bodies)) == 1
+        assert all(
+            r.headers["Content-Encoding"] == "gzip"
+            for r in mock.request_history
+            if r.path == "/banners/show/bulk"
+        )
+    client.close()
+
+
 def test_send_data(mock_ok):
     recs = [Record("gumba", 20, "chompchomp", 2) for _ in range(1200)]
     with mock_ok:
         assert send_data(recs) == len(recs)
 
 
+def test_send_data_streams(mock_ok):
+    def records():
+        for i in range(2500):
+            if i == 1500:
+                # the first bulk leaves before the rest is generated
+                assert mock.call_count > 0
+            yield Record("gumba", 20, "chompchomp", 2)
+
+    with mock_ok as mock:
+        assert send_data(records()) == 2500
+        # auth + 3 bulks, no empty trailing bulk
+        assert mock.call_count == 4
+
+
+def test_send_data_concurrent(mock_ok):
+    recs = [Record("gumba", 20, "chompchomp", 2) for _ in range(5500)]
+    with mock_ok:
+        assert send_data(iter(recs), concurrency=4) == len(recs)
+
+
 def test_send_fail(mock_fail):
     recs = [Record("gumba", 20, "chompchomp", 2) for _ in range(1200)]
     with mock_fail:
         assert send_record(recs[0]) == 0
         assert send_data(recs) == 0
+        assert send_data(recs, concurrency=2) == 0
+
+
+def test_send_bulk_retry_after(mock_ok):
+    recs = [Record("gumba", 20, "chompchomp", 2) for _ in range(10)]
+    limiter = AdaptiveConcurrency(8)
+    client = ShowAdsClient(
+        os.getenv("API_URL"),
+        "project-key",
+        retry_policy=RetryPolicy(base_delay=10),
+        concurrency_limiter=limiter,
+    )
+    with mock_ok as mock:
+        mock.register_uri(
+            "POST",
+            f"{os.getenv('API_URL')}/banners/show/bulk",
+            [
+                {"status_code": 429, "headers": {"Retry-After": "0"}},
+                {"status_code": 200},
+            ],
+        )
+        # Retry-After takes precedence over the 10s backoff
+        assert client.send_bulk(1, recs) == len(recs)
+    assert limiter.limit < 8
+    client.close()
+
+
+def test_send_bulk_bad_request_not_retried(mock_ok, monkeypatch, tmp_path):
+    monkeypatch.setenv("FAILED_RECORDS_DIRPATH", str(tmp_path))
+    recs = [Record("gumba", 20, f"chomp{i}", 2) for i in range(10)]
+    with mock_ok as mock:
+        mock.register_uri(
+            "POST", f"{os.getenv('API_URL')}/banners/show/bulk", status_code=400
+        )
+        assert send_bulk(1, recs) == 0
+        bodies = [
+            r.body for r in mock.request_history if r.path == "/banners/show/bulk"
+        ]
+    # bisected down to the single records, no payload is sent twice
+    assert len(bodies) == len(set(bodies)) == 2 * len(recs) - 1
+    # the upstream refuses everything, the records are stored for a resend
+    get_spill_store(tmp_path).flush()
+    (unsent,) = tmp_path.glob("unsent_*.csv")
+    assert len(unsent.read_text().splitlines()) == len(recs)
+    assert not list(tmp_path.glob("rejected_*.csv"))
+
+
+def test_send_bulk_upstream_refuses_everything(mock_ok, monkeypatch, tmp_path):
+    monkeypatch.setenv("FAILED_RECORDS_DIRPATH", str(tmp_path))
+    recs = [Record("gumba", 20, f"chomp{i}", 2) for i in range(1000)]
+    client = ShowAdsClient(
+        os.getenv("API_URL"), "project-key", retry_policy=RetryPolicy(base_delay=0)
+    )
+    with mock_ok as mock:
+        mock.register_uri(
+            "POST", f"{os.getenv('API_URL')}/banners/show/bulk", status_code=400
+        )
+        result = client.deliver_bulk(1, recs)
+        # the bulk and at most MAX_SPLIT_REQUESTS of its halves
+        assert len(_bulk_sizes(mock)) == 1 + MAX_SPLIT_REQUESTS
+    client.close()
+
+    assert result.sent == 0 and not result.rejected
+    assert all(result.unsent())
+    get_spill_store(tmp_path).flush()
+    (unsent,) = tmp_path.glob("unsent_*.csv")
+    assert len(unsent.read_text().splitlines()) == len(recs)
+    assert not list(tmp_path.glob("rejected_*.csv"))
+
+
+def _bulk_sizes(mock) -> list[int]:
+    return [
+        len(r.json()["Data"])
+        for r in mock.request_history
+        if r.path == "/banners/show/bulk"
+    ]
+
+
+def test_send_bulk_split_on_payload_too_large(mock_ok):
+    recs = [Record("gumba", 20, f"chomp{i}", 2) for i in range(1000)]
+    sizer = AdaptiveBulkSize(1000)
+    client = ShowAdsClient(os.getenv("API_URL"), "project-key", bulk_sizer=sizer)
+    with mock_ok as mock:
+        mock.register_uri(
+            "POST",
+            f"{os.getenv('API_URL')}/banners/show/bulk",
+            [{"status_code": 413}, {"status_code": 413}, {"status_code": 200}],
+        )
+        assert client.send_bulk(1, recs) == 1000
+        # the halves are sent again, the first half is split once more
+        assert _bulk_sizes(mock) == [1000, 500, 250, 250, 500]
+    # shrunk by the 413s, grown back by the fast deliveries
+    assert 250 < sizer.size < 1000
+    client.close()
+
+
+def test_send_bulk_timeout(mock_ok, monkeypatch, tmp_path):
+    monkeypatch.setenv("FAILED_RECORDS_DIRPATH", str(tmp_path))
+    recs = [Record("gumba", 20, f"chomp{i}", 2) for i in range(100)]
+    sizer = AdaptiveBulkSize(100)
+    client = ShowAdsClient(
+        os.getenv("API_URL"),
+        "project-key",
+        retry_policy=RetryPolicy(base_delay=0),
+        bulk_sizer=sizer,
+        timeout=0.1,
+    )
+    with mock_ok as mock:
+        mock.register_uri(
+            "POST",
+            f"{os.getenv('API_URL')}/banners/show/bulk",
+            exc=requests.exceptions.ReadTimeout,
+        )
+        assert client.send_bulk(1, recs) == 0
+        # every attempt timed out
+        assert len(_bulk_sizes(mock)) == 3
+    assert sizer.size == 50
+    client.close()
+
+
+def test_send_bulk_connection_error(mock_ok, monkeypatch, tmp_path):
+    monkeypatch.setenv("FAILED_RECORDS_DIRPATH", str(tmp_path))
+    recs = [Record("gumba", 20, f"chomp{i}", 2) for i in range(100)]
+    sizer = AdaptiveBulkSize(100)
+    client = ShowAdsClient(
+        os.getenv("API_URL"),
+        "project-key",
+        retry_policy=RetryPolicy(base_delay=0),
+        bulk_sizer=sizer,
+    )
+    url = os.getenv("API_URL")
+    with mock_ok as mock:
+        mock.register_uri(
+            "POST",
+            f"{url}/banners/show/bulk",
+            [{"exc": requests.exceptions.ConnectionError}, {"json": {}}],
+        )
+        # retried
+        assert client.send_bulk(1, recs) == 100
+        assert len(_bulk_sizes(mock)) == 2
+
+        mock.register_uri(
+            "POST", f"{url}/banners/show/bulk", exc=requests.exceptions.ConnectionError
+        )
+        mock.register_uri(
+            "POST", f"{url}/banners/show", exc=requests.exceptions.ConnectionError
+        )
+        assert client.send_bulk(2, recs) == 0
+        assert len(_bulk_sizes(mock)) == 5
+        assert client.send_record(Record("gumba", 20, "chomp100", 2)) == 0
+    # a lost connection says nothing about the size of the bulk
+    assert sizer.size == 100
+    client.close()
+
+    # spilled for a later resend
+    get_spill_store(tmp_path).flush()
+    (unsent,) = tmp_path.glob("unsent_*.csv")
+    assert len(unsent.read_text().splitlines()) == 101
+    assert not list(tmp_path.glob("rejected_*.csv"))
+
+
+def test_send_data_upstream_unreachable(monkeypatch, tmp_path):
+    monkeypatch.setenv("FAILED_RECORDS_DIRPATH", str(tmp_path))
+    recs = [Record("gumba", 20, f"chomp{i}", 2) for i in range(100)]
+    # nothing listens on the port, not even the token can be fetched
+    client = ShowAdsClient(
+        "http://127.0.0.1:1", "project-key", retry_policy=RetryPolicy(base_delay=0)
+    )
+    set_client(client)
+    assert send_data(recs) == 0
+    assert not client.access_token
+    set_client(None)
+
+    # spilled for a later resend
+    get_spill_store(tmp_path).flush()
+    (unsent,) = tmp_path.glob("unsent_*.csv")
+    assert len(unsent.read_text().splitlines()) == 100
+
+
+def test_send_data_bulk_limits(mock_ok):
+    recs = [Record("gumba", 20, f"chomp{i}", 2) for i in range(1000)]
+    client = ShowAdsClient(
+        os.getenv("API_URL"),
+        "project-key",
+        bulk_sizer=AdaptiveBulkSize(300, max_bytes=8000),
+    )
+    set_client(client)
+    with mock_ok as mock:
+        assert send_data(recs) == 1000
+        bodies = [
+            r.body for r in mock.request_history if r.path == "/banners/show/bulk"
+        ]
+    assert all(len(body) <= 8000 for body in bodies)
+    assert 0 not in _bulk_sizes(mock) and max(_bulk_sizes(mock)) <= 300
+
+
+def test_send_bulk_bisects_poison_records(mock_ok, monkeypatch, tmp_path):
+    monkeypatch.setenv("FAILED_RECORDS_DIRPATH", str(tmp_path))
+    recs = [Record("gumba", 20, f"chomp{i}", 2) for i in range(1000)]
+    recs[123].cookie = "poison"
+    recs[877].cookie = "poison"
+
+    def bulk_callback(request, context):
+        poisoned = "poison" in request.text
+        context.status_code = 400 if poisoned else 200
+        return {"Message": "Invalid VisitorCookie."} if poisoned else {}
+
+    with mock_ok as mock:
+        mock.register_uri(
+            "POST", f"{os.getenv('API_URL')}/banners/show/bulk", json=bulk_callback
+        )
+        result = get_client().deliver_bulk(1, recs)
+        requests_sent = sum(
+            r.path == "/banners/show/bulk" for r in mock.request_history
+        )
+    assert result.sent == 998
+    assert sorted(result.rejected) == [123, 877]
+    assert "Invalid VisitorCookie." in result.rejected[123]
+    # O(log n) requests per poison record instead of one per record
+    assert requests_sent <= 1 + 2 * 2 * 10
+    assert get_client().bulk_sizer.size == 500
+
+    get_spill_store(tmp_path).flush()
+    assert not list(tmp_path.glob("unsent_*.csv"))
+    (rejected,) = tmp_path.glob("rejected_*.csv")
+    lines = rejected.read_text().splitlines()
+    assert len(lines) == 2
+    assert lines[0].startswith("gumba,20,poison,2,Bad request: ")
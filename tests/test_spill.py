@@ -0,0 +1,87 @@
+import os
+import multiprocessing
+
+from data_connector.record import Record
+from data_connector.replay import replay_unsent
+from data_connector.spill import SpillStore
+
+
+def _append_many(dirpath, worker: int):
+    store = SpillStore(dirpath, fsync_records=10)
+    for i in range(50):
+        store.append(Record("worker", worker, f"cookie{i}", 1) for _ in range(20))
+    store.close()
+
+
+def test_spill_store_processes(tmp_path):
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=_append_many, args=(tmp_path, w)) for w in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    (path,) = SpillStore(tmp_path).spill_files()
+    lines = path.read_text().splitlines()
+    assert len(lines) == 4 * 50 * 20
+    # no line was interleaved with another one
+    assert all(len(line.split(",")) == 4 for line in lines)
+
+
+def test_spill_store_compact(tmp_path):
+    store = SpillStore(tmp_path)
+    store.append(Record("name", 20, f"cookie{i}", 1) for i in range(3))
+    (path,) = store.spill_files()
+    offsets = [offset for offset, _ in store.entries(path)]
+    store.mark_delivered(path, offsets[:2])
+    assert [line for _, line in store.entries(path)] == [b"name,20,cookie2,1\n"]
+
+    # appends after a compaction go to the new file
+    assert store.compact(path) == 1
+    store.append([Record("name", 20, "cookie3", 1)])
+    assert path.read_text() == "name,20,cookie2,1\nname,20,cookie3,1\n"
+    assert not store.index_path(path).exists()
+
+    store.mark_delivered(path, [offset for offset, _ in store.entries(path)])
+    assert store.compact(path) == 0
+    assert not path.exists()
+
+
+def test_replay_unsent(tmp_path, mock_ok, mock_fail):
+    store = SpillStore(tmp_path)
+    store.append(Record("name", 20, f"cookie{i}", 1) for i in range(2500))
+    (path,) = store.spill_files()
+    with open(path, "a") as f:
+        f.write("broken line\n")
+
+    # the API is still down, the records stay where they are
+    with mock_fail:
+        result = replay_unsent(store=store, concurrency=2)
+    assert (result.delivered, result.failed, result.left) == (0, 2500, 2501)
+
+    with mock_ok:
+        result = replay_unsent(store=store, concurrency=2)
+    assert (result.delivered, result.invalid, result.left) == (2500, 1, 1)
+    assert path.read_text() == "broken line\n"
+
+
+def test_replay_moves_refused_records(tmp_path, mock_ok):
+    store = SpillStore(tmp_path)
+    store.append(Record("name", 20, f"cookie{i}", 1) for i in range(1500))
+    store.append([Record("name", 20, "poison", 1)])
+    (path,) = store.spill_files()
+
+    def bulk_callback(request, context):
+        context.status_code = 400 if "poison" in request.text else 200
+        return {}
+
+    with mock_ok as mock:
+        mock.register_uri(
+            "POST", f"{os.getenv('API_URL')}/banners/show/bulk", json=bulk_callback
+        )
+        result = replay_unsent(store=store)
+    assert (result.delivered, result.rejected, result.failed) == (1500, 1, 0)
+    assert result.left == 0 and not path.exists()
+    store.flush()
+    (rejected,) = tmp_path.glob("rejected_*.csv")
+    assert rejected.read_text() == "name,20,poison,1,Bad request: {}\n"
@@ -0,0 +1,73 @@
+import time
+from email.utils import formatdate
+
+from data_connector.throttle import (
+    AdaptiveBulkSize,
+    AdaptiveConcurrency,
+    RetryPolicy,
+    TokenBucket,
+    parse_retry_after,
+)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=100, capacity=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    # the first token is in the bucket, the other ten take 10 ms each
+    assert time.monotonic() - start >= 0.09
+
+    # no limit
+    TokenBucket(0).acquire(1000)
+
+
+def test_adaptive_concurrency():
+    limiter = AdaptiveConcurrency(max_limit=8)
+    limiter.throttled()
+    assert limiter.limit == 4
+    limiter.throttled()
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.limit == 1
+    for _ in range(100):
+        limiter.succeeded()
+    assert limiter.limit == 8
+
+    with limiter.slot():
+        assert limiter.in_flight == 1
+    assert limiter.in_flight == 0
+
+
+def test_adaptive_bulk_size():
+    sizer = AdaptiveBulkSize(1000, target_latency=0.5, min_records=10)
+    sizer.shrink(1000)
+    assert sizer.size == 500
+    # bulks that were in flight together cut the size once
+    sizer.shrink(1000)
+    assert sizer.size == 500
+    sizer.shrink(500)
+    sizer.shrink(10)
+    assert sizer.size == 10
+
+    # slow responses keep the size
+    sizer.succeeded(1.0)
+    assert sizer.size == 10
+    for _ in range(30):
+        sizer.succeeded(0.1)
+    assert sizer.size == 1000
+
+
+def test_retry_policy():
+    policy = RetryPolicy(base_delay=1, max_delay=3)
+    for attempt in range(5):
+        assert 0 <= policy.delay(attempt) <= min(3, 2**attempt)
+    assert policy.delay(0, "2") == 2
+    assert policy.delay(0, "3600") == policy.max_retry_after
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("5") == 5
+    assert parse_retry_after("garbage") is None
+    assert 0 < parse_retry_after(formatdate(time.time() + 30, usegmt=True)) <= 30
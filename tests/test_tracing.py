@@ -0,0 +1,118 @@
+import json
+import logging
+import pstats
+from pathlib import Path
+
+from flask_restx.api import HTTPStatus
+
+from data_connector import tracing
+from data_connector.commands import upload_file
+
+
+def _write_csv(path: Path, rows: int):
+    with open(path, "w") as f:
+        f.write("Name,Age,Cookie,BannerId\n")
+        for i in range(rows):
+            f.write(f"Valid Name,{20 + i % 40},cookie{i},{i % 100}\n")
+
+
+def _spans(path: Path) -> list[dict]:
+    spans = []
+    with open(path) as f:
+        for line in f:
+            for resource in json.loads(line)["resourceSpans"]:
+                for scope in resource["scopeSpans"]:
+                    spans.extend(scope["spans"])
+    return spans
+
+
+def _attributes(span: dict) -> dict:
+    return {a["key"]: next(iter(a["value"].values())) for a in span["attributes"]}
+
+
+def test_request_id_header(client, mock_ok):
+    with mock_ok:
+        res = client.post("/send_record", json={}, headers={"X-Request-ID": "abc-1"})
+        assert res.headers["X-Request-ID"] == "abc-1"
+        # generated if missing or unsafe
+        res = client.post("/send_record", json={})
+        assert len(res.headers["X-Request-ID"]) == 32
+        res = client.post("/send_record", json={}, headers={"X-Request-ID": "a b"})
+        assert res.headers["X-Request-ID"] != "a b"
+
+
+def test_request_id_in_logs(caplog):
+    caplog.handler.addFilter(tracing.RequestIdFilter())
+    with caplog.at_level(logging.INFO):
+        logging.info("outside")
+        with tracing.request("job", "job-1") as request_id:
+            logging.info("inside")
+    assert request_id == "job-1"
+    assert [r.request_id for r in caplog.records] == ["-", "job-1"]
+    assert tracing.request_id() is None
+
+
+def test_bulk_upload_spans(client, mock_ok, monkeypatch, tmp_path):
+    trace_path = tmp_path / "trace.jsonl"
+    monkeypatch.setenv("TRACE_FILEPATH", str(trace_path))
+    monkeypatch.setenv("SEND_CONCURRENCY", "2")
+    csv_path = tmp_path / "data.csv"
+    _write_csv(csv_path, 2500)
+    request_id = "0123456789abcdef0123456789abcdef"
+
+    with mock_ok, open(csv_path, "rb") as f:
+        res = client.post(
+            "/send_record/bulk",
+            data={"file": (f, "data.csv")},
+            headers={"X-Request-ID": request_id},
+        )
+    assert res.status_code == HTTPStatus.ACCEPTED
+    assert res.json["sent"] == 2500
+
+    spans = _spans(trace_path)
+    # the request ID is the trace ID
+    assert {span["traceId"] for span in spans} == {request_id}
+    by_id = {span["spanId"]: span for span in spans}
+    (root,) = [span for span in spans if "parentSpanId" not in span]
+    assert root["name"] == "POST /send_record/bulk"
+    assert root["kind"] == tracing.SPAN_KIND_SERVER
+    assert _attributes(root)["http.status_code"] == "202"
+
+    names = [span["name"] for span in spans]
+    # the last read finds out the file is over
+    assert names.count("read_bulk") == 4
+    assert names.count("send_bulk") == names.count("encode") == 3
+    # the worker threads send the bulks in the context of the request
+    for span in spans:
+        if span["name"] in ("read_bulk", "send_bulk"):
+            assert span["parentSpanId"] == root["spanId"]
+        elif span["name"] == "encode":
+            assert by_id[span["parentSpanId"]]["name"] == "send_bulk"
+        elif span["name"] == "upstream":
+            assert by_id[span["parentSpanId"]]["name"] == "send_bulk"
+    read = [span for span in spans if span["name"] == "read_bulk"]
+    assert [_attributes(span).get("records") for span in read] == [
+        "1000",
+        "1000",
+        "500",
+        None,
+    ]
+    assert all(_attributes(span)["validate.seconds"] > 0 for span in read[:3])
+
+
+def test_upload_file_profile(cli, mock_ok, monkeypatch, tmp_path):
+    monkeypatch.setenv("PROFILE_DIRPATH", str(tmp_path / "profiles"))
+    csv_path = tmp_path / "data.csv"
+    _write_csv(csv_path, 100)
+    with mock_ok:
+        result = cli.invoke(upload_file, [str(csv_path)])
+        assert result.exit_code == 0
+
+        (profile,) = (tmp_path / "profiles").glob("upload-file_*.prof")
+        stats = pstats.Stats(str(profile))
+        assert any(func[2] == "parse_file" for func in stats.stats)
+
+        # none of the uploads is sampled
+        monkeypatch.setenv("PROFILE_SAMPLE_RATE", "0")
+        assert cli.invoke(upload_file, [str(csv_path)]).exit_code == 0
+        assert len(list((tmp_path / "profiles").glob("*.prof"))) == 1
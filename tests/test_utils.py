@@ -1,7 +1,25 @@
+import gzip
+import io
+import json
 from pathlib import Path
 
-from data_connector.record import Record
-from data_connector.utils import allowed_file_extension, parse_file, parse_line
+import pytest
+
+from data_connector.encoder import encode_bulk
+from data_connector.record import Record, RecordBatch, ValidationPolicy
+from data_connector.throttle import AdaptiveBulkSize
+from data_connector.utils import (
+    adaptive_batches,
+    allowed_file_extension,
+    batched,
+    batched_records,
+    find_reader,
+    parse_file,
+    parse_line,
+    split_batch,
+)
+
+TEST_DATA = Path(__file__).parent / "resources" / "test_data.csv"
 
 
 def test_parse_line():
@@ -17,10 +35,12 @@ def test_parse_line():
 
 
 def test_parse_file():
-    filepath = Path(__file__).parent / "resources" / "test_data.csv"
-    with open(filepath, "rb") as f:
-        buffer = parse_file(f, None, None)
+    with open(TEST_DATA, "rb") as f:
+        policy = ValidationPolicy.from_args()
+        buffer = list(parse_file(f, policy))
     assert len(buffer) == 3
+    # header line, name, age and banner ID rejections
+    assert policy.rejections == {"format": 1, "name": 2, "age": 1, "banner_id": 1}
     assert buffer[0].cookie == "jjjj"
     assert buffer[1].cookie == "ffff"
 
@@ -28,3 +48,126 @@ def test_parse_file():
 def test_allowed_file_extension():
     assert not allowed_file_extension("file.txt")
     assert allowed_file_extension("file.csv")
+    assert allowed_file_extension("FILE.CSV.GZ")
+    assert allowed_file_extension("file.jsonl")
+    assert not allowed_file_extension("file.gz")
+
+
+def test_find_reader():
+    assert find_reader("data.csv").name == "csv"
+    assert find_reader("data.csv.gz").name == "csv.gz"
+    assert find_reader("data.ndjson.gz").name == "ndjson.gz"
+    # the file name takes precedence over the content type
+    assert find_reader("data.csv", "application/x-ndjson").name == "csv"
+    assert find_reader("blob", "application/x-ndjson; charset=utf-8").name == "ndjson"
+    assert find_reader("blob", "application/octet-stream") is None
+    assert find_reader("") is None
+
+
+def _parse(filename: str, data: bytes) -> tuple[list[str], ValidationPolicy]:
+    policy = ValidationPolicy.from_args()
+    reader = find_reader(filename)
+    return [rec.cookie for rec in reader.parse(io.BytesIO(data), policy)], policy
+
+
+def test_parse_compressed_csv():
+    cookies, policy = _parse("data.csv.gz", gzip.compress(TEST_DATA.read_bytes()))
+    assert cookies == ["jjjj", "ffff", "ffff"]
+    assert policy.rejections == {"format": 1, "name": 2, "age": 1, "banner_id": 1}
+
+    zstandard = pytest.importorskip("zstandard")
+    data = zstandard.ZstdCompressor().compress(TEST_DATA.read_bytes())
+    assert _parse("data.csv.zst", data)[0] == cookies
+
+
+def test_parse_ndjson():
+    lines = [
+        json.dumps({"name": "K M Valid", "age": 25, "cookie": "a", "banner_id": 28}),
+        json.dumps({"name": "K M Valid", "age": 17, "cookie": "b", "banner_id": 28}),
+        "",
+        "not json",
+        json.dumps({"name": "K M Valid", "age": 25, "cookie": "c"}),
+        json.dumps(["K M Valid", 25, "d", 28]),
+        json.dumps({"name": "K M Valid", "age": "30", "cookie": "e", "banner_id": 1}),
+    ]
+    cookies, policy = _parse("data.ndjson", "\n".join(lines).encode())
+    assert cookies == ["a", "e"]
+    assert policy.rejections == {"age": 1, "format": 3}
+    assert [e["line"] for e in policy.examples] == [2, 4, 5, 6]
+
+
+def test_parse_parquet():
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    table = pa.table(
+        {
+            "Name": ["K M Valid", "K M Valid", None, "Prof. J F"],
+            "Age": [25, 17, 30, 79],
+            "Cookie": ["a", "b", "c", "d"],
+            "BannerId": [28, 28, 1, 113],
+        }
+    )
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, row_group_size=2)
+    cookies, policy = _parse("data.parquet", buffer.getvalue())
+    assert cookies == ["a"]
+    assert policy.rejections == {"age": 1, "format": 1, "name": 1}
+    assert policy.examples[1] == {
+        "rule": "format",
+        "message": "Malformed row.",
+        "line": 3,
+        "row": "None,30,c,1",
+    }
+
+    # a missing column rejects every row
+    buffer = io.BytesIO()
+    pq.write_table(table.drop(["Age"]), buffer)
+    cookies, policy = _parse("data.parquet", buffer.getvalue())
+    assert cookies == []
+    assert policy.rejections == {"format": 4}
+
+
+def test_batched():
+    assert [len(b) for b in batched(range(2500), 1000)] == [1000, 1000, 500]
+    assert [len(b) for b in batched(range(2000), 1000)] == [1000, 1000]
+    assert list(batched([], 1000)) == []
+
+
+def test_batched_records():
+    recs = (Record("Name", 18, f"Cookie{i}", 20) for i in range(2500))
+    batches = list(batched_records(recs, 1000))
+    assert [len(b) for b in batches] == [1000, 1000, 500]
+    assert batches[2].cookies[-1] == "Cookie2499"
+
+
+def test_adaptive_batches():
+    sizer = AdaptiveBulkSize(1000)
+    recs = [Record("Name", 18, f"Cookie{i}", 20) for i in range(2000)]
+    assert [len(b) for b in adaptive_batches(recs, sizer)] == [1000, 1000]
+    assert list(adaptive_batches([], sizer)) == []
+
+    sizer.shrink(600)
+    assert [len(b) for b in adaptive_batches(recs, sizer)] == [300] * 6 + [200]
+
+    sizer = AdaptiveBulkSize(1000, max_bytes=4000)
+    batches = list(adaptive_batches(recs, sizer))
+    assert sum(map(len, batches)) == 2000
+    assert all(len(encode_bulk(b).body) <= 4000 for b in batches)
+    assert len(encode_bulk(batches[0]).body) > 3900
+
+
+def test_split_batch():
+    batch = RecordBatch.from_records(
+        Record("Name", 18, f"Cookie{i}", 20) for i in range(250)
+    )
+    assert list(split_batch(batch, 1000)) == [batch]
+    parts = list(split_batch(batch, 100))
+    assert [len(p) for p in parts] == [100, 100, 50]
+    assert parts[2].cookies[0] == "Cookie200"
+
+    parts = list(split_batch(batch, 1000, max_bytes=1000))
+    assert sum(map(len, parts)) == 250
+    assert all(len(encode_bulk(p).body) <= 1000 for p in parts)
+    # a record over the limit is sent on its own
+    assert [len(p) for p in split_batch(batch.slice(0, 3), 1000, 10)] == [1, 1, 1]
+    assert list(split_batch(RecordBatch(), 1000, 10)) == []